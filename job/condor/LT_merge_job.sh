@@ -0,0 +1,38 @@
+#!/bin/bash
+
+echo "Starting Job" 
+
+OUTPUT=$1
+echo "The OUTPUT is: ${OUTPUT}" 
+
+# Comma separated inputs, transferred to the working directory by condor
+INPUTS=$(echo $2 | tr ',' '\n' | xargs -n1 basename | tr '\n' ' ')
+echo "The INPUTS are: ${INPUTS}" 
+
+MERGE_ARGS=$3
+echo "The MERGE_ARGS are: ${MERGE_ARGS}" 
+
+echo "Merging on `whoami`@`hostname`"
+start=`date +%s`
+
+# The sensor ids come from the detector db snapshot shipped with the job (DETDB in
+# lt_merge.sub), invisible_cities is only needed to read the database when there is
+# none and for the root, which writes the tables with it
+DETECTOR=$(echo ${MERGE_ARGS} | sed -n 's/.*--detector \([^ ]*\).*/\1/p')
+if [[ "${MERGE_ARGS}" == *--final* ]] || [ ! -f ${DETECTOR:-next100}/snapshot.json ]; then
+	echo "Setting Up IC" 
+	source /software/IC/setup_IC.sh
+fi
+
+python3 lt_merge.py ${OUTPUT} ${INPUTS} ${MERGE_ARGS}
+
+ls -ltrh
+
+echo "FINISHED....EXITING" 
+
+end=`date +%s`
+let deltatime=end-start
+let hours=deltatime/3600
+let minutes=(deltatime/60)%60
+let seconds=deltatime%60
+printf "Time spent: %d:%02d:%02d\n" $hours $minutes $seconds
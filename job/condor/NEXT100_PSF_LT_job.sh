@@ -41,7 +41,7 @@ cat ${CONFIG}
 echo "Running NEXUS" 
 nexus -n $N_EVENTS ${INIT}
 echo "Compressing file" 
-python3 compress_files.py NEXUS_OUTPUT
+python3 compress_files.py NEXUS_OUTPUT --jobid ${JOBID}
 
 ls -ltrh
 
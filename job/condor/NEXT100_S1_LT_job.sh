@@ -8,6 +8,15 @@ echo "The JOBID number is: ${JOBID}"
 JOBNAME=$2
 echo "The JOBNAME number is: ${JOBNAME}" 
 
+# full: transfer the slimmed nexus file, partial: transfer the light table partial sums
+MODE=${3:-full}
+echo "The MODE is: ${MODE}" 
+
+# z range of the job, set by lt_planner.py
+ZMIN=$4
+ZMAX=$5
+echo "The z range is: ${ZMIN:-all}-${ZMAX:-all}" 
+
 echo "JOBID $JOBID running on `whoami`@`hostname`"
 start=`date +%s`
 
@@ -33,6 +42,17 @@ sed -i "s#.*nphotons.*#/Generator/ScintGenerator/nphotons ${N_PHOTONS}#" ${CONFI
 sed -i "s#.*random_seed.*#/nexus/random_seed ${SEED}#" ${CONFIG}
 sed -i "s#.*start_id.*#/nexus/persistency/start_id ${EID}#" ${CONFIG}
 
+# z range of the job's slab (notebooks/lt_planner.py --slab-width), the whole region if not given.
+# Only for a generator that can be restricted in z, with the zmin and zmax lines in the config
+if [ -n "${ZMIN}" ]; then
+	if ! grep -q "ScintGenerator/zmin" ${CONFIG}; then
+		echo "${CONFIG} has no z range for the generator, cannot generate in ${ZMIN}-${ZMAX} mm"
+		exit 1
+	fi
+	sed -i "s#.*ScintGenerator/zmin.*#/Generator/ScintGenerator/zmin ${ZMIN} mm#" ${CONFIG}
+	sed -i "s#.*ScintGenerator/zmax.*#/Generator/ScintGenerator/zmax ${ZMAX} mm#" ${CONFIG}
+fi
+
 # Print out the config and init files
 cat ${INIT}
 cat ${CONFIG}
@@ -40,8 +60,19 @@ cat ${CONFIG}
 # NEXUS
 echo "Running NEXUS" 
 nexus -n $N_EVENTS ${INIT}
-echo "Slimming file" 
-python3 compress_files.py NEXUS_OUTPUT
+if [ "${MODE}" == "partial" ]; then
+	# The PMT ids come from the detector db snapshot shipped with the job (DETDB in lt.sub),
+	# invisible_cities is only needed to read the database when there is none
+	if [ ! -f next100/snapshot.json ]; then
+		echo "No next100 snapshot, setting Up IC" 
+		source /software/IC/setup_IC.sh
+	fi
+	echo "Reducing file to the light table partial" 
+	python3 lt_partial.py NEXUS_OUTPUT S1 ${JOBID}
+else
+	echo "Slimming file" 
+	python3 compress_files.py NEXUS_OUTPUT --jobid ${JOBID}
+fi
 
 ls -ltrh
 
@@ -0,0 +1,42 @@
+#!/bin/bash
+#SBATCH -J LT_merge # A single job name for the array
+#SBATCH -c 1 # Number of cores
+#SBATCH --mem 4000 # Memory request
+#SBATCH -t 0-2:00 # Maximum execution time (D-HH:MM)
+#SBATCH -o LT_merge_%A_%a.out # Standard output
+#SBATCH -e LT_merge_%A_%a.err # Standard error
+
+# One level of the reduction tree written by notebooks/lt_reduce_tree.py --backend slurm.
+# Submitted by submit_reduce.sh from the tree directory, with the level file and the merge options
+
+start=`date +%s`
+
+HOME=/home/argon/Projects/Krishan/LightTableGen/
+
+LEVEL=$1
+MERGE_ARGS=$2
+
+# The sensor ids come from the detector db snapshot in config/detdb (lt_detdb.py),
+# invisible_cities is only needed to read the database when there is none and for
+# the root, which writes the tables with it
+DETECTOR=$(echo ${MERGE_ARGS} | sed -n 's/.*--detector \([^ ]*\).*/\1/p')
+if [[ "${MERGE_ARGS}" == *--final* ]] || [ ! -f $HOME/config/detdb/${DETECTOR:-next100}/snapshot.json ]; then
+	echo "Setting up IC"
+	source /home/argon/Projects/Krishan/IC/setup_IC.sh
+fi
+
+# Get the nth node of the level: output and file with its inputs
+line=$(sed -n "${SLURM_ARRAY_TASK_ID}{p;q;}" ${LEVEL})
+read OUTPUT INPUTS <<< "${line}"
+echo "Merging ${INPUTS} into ${OUTPUT}"
+
+python3 $HOME/notebooks/lt_merge.py ${OUTPUT} --inputs-from ${INPUTS} ${MERGE_ARGS}
+
+echo "FINISHED....EXITING"
+
+end=`date +%s`
+let deltatime=end-start
+let hours=deltatime/3600
+let minutes=(deltatime/60)%60
+let seconds=deltatime%60
+printf "Time spent: %d:%02d:%02d\n" $hours $minutes $seconds
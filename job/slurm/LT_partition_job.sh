@@ -0,0 +1,42 @@
+#!/bin/bash
+#SBATCH -J LT_partition # A single job name for the array
+#SBATCH -c 1 # Number of cores
+#SBATCH --mem 4000 # Memory request, set from --max-memory by submit_partition.sh
+#SBATCH -t 0-4:00 # Maximum execution time (D-HH:MM)
+#SBATCH -o LT_partition_%A_%a.out # Standard output
+#SBATCH -e LT_partition_%A_%a.err # Standard error
+
+# One partition (merge) or the stitch of the partitioned merge written by notebooks/lt_partition.py --backend slurm.
+# Submitted by submit_partition.sh with the mode and the lt_partition.py arguments
+
+start=`date +%s`
+
+HOME=/home/argon/Projects/Krishan/LightTableGen/
+
+MODE=$1
+ARGS=$2
+
+# The sensor ids come from the detector db snapshot in config/detdb (lt_detdb.py),
+# invisible_cities is only needed to read the database when there is none and for
+# the stitch, which writes the tables with it
+DETECTOR=$(echo ${ARGS} | sed -n 's/.*--detector \([^ ]*\).*/\1/p')
+if [[ "${MODE}" != "merge" ]] || [ ! -f $HOME/config/detdb/${DETECTOR:-next100}/snapshot.json ]; then
+	echo "Setting up IC"
+	source /home/argon/Projects/Krishan/IC/setup_IC.sh
+fi
+
+if [[ "${MODE}" == "merge" ]]; then
+	echo "Merging partition ${SLURM_ARRAY_TASK_ID}"
+	python3 $HOME/notebooks/lt_partition.py merge ${ARGS} --partition ${SLURM_ARRAY_TASK_ID}
+else
+	python3 $HOME/notebooks/lt_partition.py stitch ${ARGS}
+fi
+
+echo "FINISHED....EXITING"
+
+end=`date +%s`
+let deltatime=end-start
+let hours=deltatime/3600
+let minutes=(deltatime/60)%60
+let seconds=deltatime%60
+printf "Time spent: %d:%02d:%02d\n" $hours $minutes $seconds
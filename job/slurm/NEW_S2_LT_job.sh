@@ -7,7 +7,14 @@
 #SBATCH -o NEW_S2_LT_%A_%a.out # Standard output
 #SBATCH -e NEW_S2_LT_%A_%a.err # Standard error
 
-echo "Initialising NEXUS environment" 2>&1 | tee -a log_nexus_"${SLURM_ARRAY_TASK_ID}".txt
+# Job id: the array index plus the first job id given by lt_planner.py (0 by default)
+JOBID=$((${1:-0} + ${SLURM_ARRAY_TASK_ID}))
+
+# z range of the job's slab (lt_planner.py --slab-width), the whole region if not given
+ZMIN=$2
+ZMAX=$3
+
+echo "Initialising NEXUS environment" 2>&1 | tee -a log_nexus_"${JOBID}".txt
 start=`date +%s`
 
 # Set the configurable variables
@@ -20,31 +27,41 @@ INIT=NEW_S2_LT.init.mac
 
 # Create the directory
 cd $SCRATCH/guenette_lab/Users/$USER/
-mkdir -p $JOBNAME/jobid_"${SLURM_ARRAY_TASK_ID}"
-cd $JOBNAME/jobid_"${SLURM_ARRAY_TASK_ID}"
+mkdir -p $JOBNAME/jobid_"${JOBID}"
+cd $JOBNAME/jobid_"${JOBID}"
 
 # Copy the files over
 cp ~/packages/LightTableGen/config/NEW_S2* .
 
 # Change the output file na,e
-sed -i "s#.*outputFile.*#/nexus/persistency/outputFile NEW_S2_LT_${SLURM_ARRAY_TASK_ID}.next#" ${CONFIG}
+sed -i "s#.*outputFile.*#/nexus/persistency/outputFile NEW_S2_LT_${JOBID}.next#" ${CONFIG}
 sed -i "s#.*nphotons.*#/Generator/ScintGenerator/nphotons ${N_PHOTONS}#" ${CONFIG}
 
+# Only for a generator that can be restricted in z, with the zmin and zmax lines in the config
+if [ -n "${ZMIN}" ]; then
+	if ! grep -q "ScintGenerator/zmin" ${CONFIG}; then
+		echo "${CONFIG} has no z range for the generator, cannot generate in ${ZMIN}-${ZMAX} mm" 2>&1 | tee -a log_nexus_"${JOBID}".txt
+		exit 1
+	fi
+	sed -i "s#.*ScintGenerator/zmin.*#/Generator/ScintGenerator/zmin ${ZMIN} mm#" ${CONFIG}
+	sed -i "s#.*ScintGenerator/zmax.*#/Generator/ScintGenerator/zmax ${ZMAX} mm#" ${CONFIG}
+fi
+
 # Setup nexus and run
-echo "Setting Up NEXUS" 2>&1 | tee -a log_nexus_"${SLURM_ARRAY_TASK_ID}".txt
+echo "Setting Up NEXUS" 2>&1 | tee -a log_nexus_"${JOBID}".txt
 source ~/packages/nexus/setup_nexus.sh
 
 for i in $(eval echo "{1..${FILES_PER_JOB}}"); do
 
 	# Replace the seed in the file	
-	SEED=$((${N_EVENTS}*${FILES_PER_JOB}*(${SLURM_ARRAY_TASK_ID} - 1) + ${N_EVENTS}*${i}))
-	echo "The seed number is: ${SEED}" 2>&1 | tee -a log_nexus_"${SLURM_ARRAY_TASK_ID}".txt
+	SEED=$((${N_EVENTS}*${FILES_PER_JOB}*(${JOBID} - 1) + ${N_EVENTS}*${i}))
+	echo "The seed number is: ${SEED}" 2>&1 | tee -a log_nexus_"${JOBID}".txt
 	sed -i "s#.*random_seed.*#/nexus/random_seed ${SEED}#" ${CONFIG}
 	sed -i "s#.*start_id.*#/nexus/persistency/start_id ${SEED}#" ${CONFIG}
 	
 	# NEXUS
-	echo "Running NEXUS" 2>&1 | tee -a log_nexus_"${SLURM_ARRAY_TASK_ID}".txt
-	nexus -n $N_EVENTS ${INIT} 2>&1 | tee -a log_nexus_"${SLURM_ARRAY_TASK_ID}".txt
+	echo "Running NEXUS" 2>&1 | tee -a log_nexus_"${JOBID}".txt
+	nexus -n $N_EVENTS ${INIT} 2>&1 | tee -a log_nexus_"${JOBID}".txt
 
 	echo; echo; echo;
 done
@@ -52,16 +69,16 @@ done
 # Cleaning up
 
 # Remove the config files if not the first jobid
-if [ ${SLURM_ARRAY_TASK_ID} -ne 1 ]; then
-	rm -v *.conf 2>&1 | tee -a log_nexus_"${SLURM_ARRAY_TASK_ID}".txt
-	rm -v *.mac 2>&1 | tee -a log_nexus_"${SLURM_ARRAY_TASK_ID}".txt
+if [ ${JOBID} -ne 1 ]; then
+	rm -v *.conf 2>&1 | tee -a log_nexus_"${JOBID}".txt
+	rm -v *.mac 2>&1 | tee -a log_nexus_"${JOBID}".txt
 fi
 
-echo "FINISHED....EXITING" 2>&1 | tee -a log_nexus_"${SLURM_ARRAY_TASK_ID}".txt
+echo "FINISHED....EXITING" 2>&1 | tee -a log_nexus_"${JOBID}".txt
 
 end=`date +%s`
 let deltatime=end-start
 let hours=deltatime/3600
 let minutes=(deltatime/60)%60
 let seconds=deltatime%60
-printf "Time spent: %d:%02d:%02d\n" $hours $minutes $seconds | tee -a log_nexus_"${SLURM_ARRAY_TASK_ID}".txt
\ No newline at end of file
+printf "Time spent: %d:%02d:%02d\n" $hours $minutes $seconds | tee -a log_nexus_"${JOBID}".txt
\ No newline at end of file
@@ -0,0 +1,108 @@
+'''
+Benchmark of the light table queries.
+
+Times LightTable.query on point clouds like the ones the reconstruction
+evaluates per event (npoints spread along a track in z), reporting the
+latency per event and the throughput in points/s for the nearest bin and
+the trilinear interpolation. The pandas nearest-bin lookup on the
+LT/LightTable frame (pd.cut + merge) is timed for comparison.
+
+To run:
+python bench_lt_query.py [table.h5] [npoints ...]
+
+Without a table file a NEXT100 S1 sized table with random values is
+written to bench_lt_query.h5.
+'''
+
+import sys
+import time
+import numpy  as np
+import pandas as pd
+import tables as tb
+
+from lt_accumulator import LTAccumulator, make_binning
+from lt_dense       import write_dense
+from lt_table       import LightTable
+
+# S1 binning and the NEXT100 PMTs
+xmin=-500; xmax=500; xbw=20
+zmin=0; zmax=1200; zbw=20
+sensorids = np.arange(60)
+
+nevents = 200 # events per point cloud size
+
+
+def make_table(filename, rng):
+    acc      = LTAccumulator(sensorids, make_binning(xmin, xmax, xbw, zmin, zmax, zbw))
+    acc.N[:] = 10
+    acc.mean = rng.exponential(1e-4, acc.mean.shape)
+
+    config = pd.DataFrame({"parameter" : ["detector", "signal_type"], "value" : ["next100", "S1"]})
+    with tb.open_file(filename, "w") as h5out:
+        write_dense(h5out, acc, "S1", config)
+
+    lt, _ = acc.aggregate("S1")
+    lt = lt.pivot_table(index=["x", "y", "z"], columns="sensor_id", values="charge")
+    lt.columns = [f"PmtR11410_{s}" for s in lt.columns]
+    lt = lt.reset_index()
+    lt.to_hdf(filename, key="LT/LightTable", mode="a")
+
+
+def make_events(rng, lt, npoints):
+    # Points of a track: a random (x, y, z) start and a short step per point
+    x0 = rng.uniform(-400, 400, (nevents, 1))
+    y0 = rng.uniform(-400, 400, (nevents, 1))
+    z0 = rng.uniform(lt.zbins[0], lt.zbins[-1] - 100, (nevents, 1))
+    s  = np.linspace(0, 1, npoints)
+    return [(x, y, z) for x, y, z in zip(x0 + 50*s, y0 + 50*s, z0 + 100*s)]
+
+
+def query_pandas(lt, df, x, y, z):
+    # What the consumers do now: bin the points and merge with the table
+    pts = pd.DataFrame({"x" : pd.cut(x, lt.xbins, labels=lt.xbins_centre, include_lowest=True).astype(float),
+                        "y" : pd.cut(y, lt.ybins, labels=lt.ybins_centre, include_lowest=True).astype(float),
+                        "z" : pd.cut(z, lt.zbins, labels=lt.zbins_centre, include_lowest=True).astype(float)})
+    return pts.merge(df, on=["x", "y", "z"], how="left")
+
+
+def report(name, times, npoints):
+    times = np.array(times)
+    print(f"{npoints:7d} points {name:8s}: {1e3*np.median(times):8.3f} ms/event "
+          f"(p99 {1e3*np.percentile(times, 99):8.3f} ms), {npoints*len(times)/times.sum():.3g} points/s")
+
+
+if __name__ == "__main__":
+    args     = sys.argv[1:]
+    filename = args.pop(0) if args and args[0].endswith(".h5") else "bench_lt_query.h5"
+    sizes    = [int(n) for n in args] or [100, 1000, 10000, 100000]
+    rng      = np.random.default_rng(0)
+
+    if filename == "bench_lt_query.h5":
+        make_table(filename, rng)
+
+    with LightTable(filename) as lt:
+        print(f"Table {lt.shape} (x, y, z, sensor)")
+
+        start = time.perf_counter()
+        df    = pd.read_hdf(filename, "LT/LightTable")
+        print(f"pandas load of LT/LightTable: {time.perf_counter() - start:.3f} s")
+
+        for npoints in sizes:
+            events = make_events(rng, lt, npoints)
+
+            for method in ["nearest", "linear"]:
+                times = []
+                for x, y, z in events:
+                    start = time.perf_counter()
+                    lt.query(x, y, z, method=method)
+                    times.append(time.perf_counter() - start)
+                report(method, times, npoints)
+
+            times = []
+            for x, y, z in events[:20]:
+                start = time.perf_counter()
+                query_pandas(lt, df, x, y, z)
+                times.append(time.perf_counter() - start)
+            report("pandas", times, npoints)
+
+        print(f"slab cache: {lt.hits} hits, {lt.misses} misses")
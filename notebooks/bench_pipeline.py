@@ -0,0 +1,205 @@
+'''
+End to end benchmark of the light table pipeline on synthetic files.
+
+Writes synthetic nexus files (lt_synthetic.py) for each scale and times
+each stage of the table building, for the original pandas chain of
+lt_creator_slim.py:
+read, filter, time-sum, join, bin, aggregate, pivot, write
+and for the accumulators used now, where filter, time-sum, join and bin
+are one step (bin_response):
+read, bin, accumulate, aggregate, pivot, write
+The peak memory of each stage is measured with tracemalloc (numpy and
+pandas allocations), in a second pass so it does not slow the timing.
+
+To run:
+python bench_pipeline.py --scales 4 16 64 --signal-type S1 S2
+
+The files are kept in --workdir and reused by later runs.
+'''
+
+import os
+import time
+import argparse
+import resource
+import tracemalloc
+import numpy  as np
+import pandas as pd
+
+from lt_accumulator import LTAccumulator, make_binning
+from lt_binning     import bin_response
+from lt_io          import load_config, load_file
+from lt_synthetic   import make_files, pmt_name
+
+# Binning of lt_creator_slim.py
+binnings = {"S1" : (-490-65.33/2, 490+65.33/2, 65.33, -5, 1190, 20),
+            "S2" : (-500, 500, 20, -12, 2, 1)}
+
+sensorids = np.arange(60)
+
+
+class Stages:
+    '''
+    Time (and with memory, tracemalloc peak) spent in each stage, summed
+    over the calls.
+    '''
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.time   = {}
+        self.peak   = {}
+
+    def run(self, stage, fn, *args):
+        if self.memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+
+        start  = time.perf_counter()
+        result = fn(*args)
+        self.time[stage] = self.time.get(stage, 0) + time.perf_counter() - start
+
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1] - base
+            self.peak[stage] = max(self.peak.get(stage, 0), peak)
+        return result
+
+
+def read_pandas(filename):
+    parts = pd.read_hdf(filename, 'MC/particles')
+    parts = parts[['event_id', 'initial_x', 'initial_y', 'initial_z']]
+    _, nphotons  = load_config(filename)
+    sns_response = pd.read_hdf(filename, "MC/sns_response")
+    return parts, nphotons, sns_response
+
+
+def filter_pandas(sns_response):
+    return sns_response[np.isin(sns_response["sensor_id"].values, sensorids)]
+
+
+def time_sum_pandas(pmt_response):
+    return pmt_response.groupby(["sensor_id", "event_id"])["charge"].sum().to_frame().reset_index()
+
+
+def join_pandas(pmt_response, parts):
+    return pmt_response.merge(parts, on="event_id", how='inner')
+
+
+def bin_pandas(pmt_response, binning):
+    b = binning
+    pmt_response['x'] = pd.cut(x=pmt_response['initial_x'], bins=b.xbins, labels=b.xbins_centre, include_lowest=True)
+    pmt_response['y'] = pd.cut(x=pmt_response['initial_y'], bins=b.ybins, labels=b.ybins_centre, include_lowest=True)
+    pmt_response['z'] = pd.cut(x=pmt_response['initial_z'], bins=b.zbins, labels=b.zbins_centre, include_lowest=True)
+    return pmt_response.drop(columns=['initial_x', 'initial_y', 'initial_z'])
+
+
+def aggregate_pandas(LT_list, signal_type):
+    LT    = pd.concat(LT_list, ignore_index=True)
+    index = ["sensor_id", "x", "y"] if signal_type == "S2" else ["sensor_id", "x", "y", "z"]
+    lt    = LT.groupby(index, observed=True)["charge"].mean().to_frame().reset_index()
+    err   = LT.groupby(index, observed=True)["charge"].std ().to_frame().reset_index()
+    return lt, err
+
+
+def pivot(lt, err, signal_type):
+    # Same as lt_creator_slim.py
+    err['charge'] = 100*err['charge']/lt['charge']
+    index = ["x", "y"] if signal_type == "S2" else ["x", "y", "z"]
+
+    tables = []
+    for df in [lt, err]:
+        df = pd.pivot_table(df, values="charge", columns="sensor_id", index=index, observed=True)
+        df.columns = [f"{pmt_name}_{sid}" for sid in df.columns]
+        df = df.reset_index()
+        df[pmt_name + "_total"] = df.loc[:, df.columns.difference(index)].sum(axis=1)
+        tables.append(df)
+    return tables
+
+
+def write(outfilename, LT, ERR):
+    # df_writer needs invisible_cities, so write with pandas
+    with pd.HDFStore(outfilename, mode='w', complevel=5, complib='zlib') as store:
+        store.put('LT/LightTable', LT.astype(float), format='table')
+        store.put('LT/Error'     , ERR.astype(float), format='table')
+
+
+def run_pandas(filenames, signal_type, stages, outfilename):
+    binning = make_binning(*binnings[signal_type])
+    LT_list = []
+
+    for filename in filenames:
+        parts, nphotons, sns_response = stages.run("read", read_pandas, filename)
+
+        pmt_response = stages.run("filter"  , filter_pandas  , sns_response)
+        pmt_response = stages.run("time-sum", time_sum_pandas, pmt_response)
+        pmt_response = stages.run("join"    , join_pandas    , pmt_response, parts)
+        pmt_response = stages.run("bin"     , bin_pandas     , pmt_response, binning)
+
+        pmt_response['charge'] = pmt_response['charge']/nphotons
+        LT_list.append(pmt_response)
+
+    lt, err = stages.run("aggregate", aggregate_pandas, LT_list, signal_type)
+    LT, ERR = stages.run("pivot", pivot, lt, err, signal_type)
+    stages.run("write", write, outfilename, LT, ERR)
+
+
+def read_accumulator(filename):
+    # The chunks are read lazily, so read them here to time the I/O on its own
+    parts, nphotons, sns_response = load_file(filename, sensorids)
+    return parts, nphotons, list(sns_response)
+
+
+def run_accumulator(filenames, signal_type, stages, outfilename):
+    binning = make_binning(*binnings[signal_type])
+    acc     = LTAccumulator(sensorids, binning)
+
+    for filename in filenames:
+        parts, nphotons, sns_response = stages.run("read", read_accumulator, filename)
+
+        cells, charge = stages.run("bin", bin_response, sns_response, parts, nphotons, acc, signal_type == "S2")
+        stages.run("accumulate", acc.add, cells, charge)
+
+    lt, err = stages.run("aggregate", acc.aggregate, signal_type)
+    LT, ERR = stages.run("pivot", pivot, lt, err, signal_type)
+    stages.run("write", write, outfilename, LT, ERR)
+
+
+def report(signal_type, nfiles, nevents, path, stages):
+    total = sum(stages.time.values())
+    for stage, t in stages.time.items():
+        peak = f"{stages.peak[stage]/1024**2:9.1f}" if stage in stages.peak else f"{'-':>9}"
+        print(f"{signal_type:>4} {nfiles:6d} {nevents:8d} {path:>11} {stage:>10} {t:9.3f} {peak}")
+    print(f"{signal_type:>4} {nfiles:6d} {nevents:8d} {path:>11} {'total':>10} {total:9.3f} {'':>9} "
+          f"({nevents/total:.3g} events/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the light table pipeline on synthetic files")
+    parser.add_argument("--scales"     , default=[4, 16], type=int, nargs="+", help="number of files")
+    parser.add_argument("--nevents"    , default=100, type=int, help="events per file")
+    parser.add_argument("--signal-type", default=["S1", "S2"], nargs="+", choices=["S1", "S2"])
+    parser.add_argument("--paths"      , default=["pandas", "accumulator"], nargs="+", choices=["pandas", "accumulator"])
+    parser.add_argument("--workdir"    , default="bench_files")
+    parser.add_argument("--no-memory"  , action="store_true", help="skip the tracemalloc pass")
+    args = parser.parse_args()
+
+    runners = {"pandas" : run_pandas, "accumulator" : run_accumulator}
+
+    print(f"{'':>4} {'files':>6} {'events':>8} {'path':>11} {'stage':>10} {'time [s]':>9} {'peak [MB]':>9}")
+    for signal_type in args.signal_type:
+        for nfiles in args.scales:
+            directory = os.path.join(args.workdir, f"{signal_type}_{args.nevents}")
+            filenames = make_files(directory, nfiles, args.nevents, signal_type)
+            outfile   = os.path.join(args.workdir, "bench_out.h5")
+
+            for path in args.paths:
+                stages = Stages()
+                runners[path](filenames, signal_type, stages, outfile)
+
+                if not args.no_memory:
+                    memory = Stages(memory=True)
+                    tracemalloc.start()
+                    runners[path](filenames, signal_type, memory, outfile)
+                    tracemalloc.stop()
+                    stages.peak = memory.peak
+
+                report(signal_type, nfiles, nfiles * args.nevents, path, stages)
+
+    print(f"Process peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024:.0f} MB")
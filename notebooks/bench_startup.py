@@ -0,0 +1,72 @@
+'''
+Startup cost of the light table scripts: the time to import each module
+and to get the sensor tables from load_db or from the snapshot
+(lt_detdb.py), each in a fresh interpreter as on a grid worker.
+
+To run (from the notebooks directory):
+python bench_startup.py --repeat 5 --detdb ../config/detdb
+
+Modules that are not installed are reported as such.
+'''
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+import numpy as np
+
+# Import sets of the scripts, before and after the snapshot and lazy imports
+imports = {"matplotlib.pyplot"              : "import matplotlib.pyplot",
+           "invisible_cities load_db"       : "from invisible_cities.database import load_db",
+           "invisible_cities dst_io"        : "from invisible_cities.io.dst_io import df_writer",
+           "numpy, pandas"                  : "import numpy, pandas",
+           "tables"                         : "import tables",
+           "compress_files.py imports"      : "import argparse, numpy, pandas, lt_report",
+           "lt_partial.py imports"          : "import lt_accumulator, lt_parallel, lt_report",
+           "lt_creator_slim.py imports"     : "import tables, lt_parallel, lt_build_state, lt_dense, lt_sparse, "
+                                              "lt_pyramid, lt_adaptive, lt_report, lt_detdb"}
+
+lookups = {"load_db.DataPMT"    : "from invisible_cities.database import load_db; load_db.DataPMT('{detector}', 0)",
+           "load_db.DataSiPM"   : "from invisible_cities.database import load_db; load_db.DataSiPM('{detector}', 0)",
+           "snapshot DataPMT"   : "from lt_detdb import load_table; load_table('{detector}', 'DataPMT')",
+           "snapshot DataSiPM"  : "from lt_detdb import load_table; load_table('{detector}', 'DataSiPM')"}
+
+# Whole startup of a partial job (lt_partial.py imports and PMT ids), with invisible_cities
+# made unimportable in the snapshot run so it cannot be pulled in by any module
+startups = {"partial job with load_db"   : "import lt_accumulator, lt_parallel, lt_report; "
+                                           "from invisible_cities.database import load_db; load_db.DataPMT('{detector}', 0)",
+            "partial job without IC"     : "import sys; sys.modules['invisible_cities'] = None; "
+                                           "import lt_accumulator, lt_parallel, lt_report; "
+                                           "from lt_detdb import load_table; load_table('{detector}', 'DataPMT')"}
+
+
+def run(code, repeat):
+    # Median wall time of running code in a new interpreter, None if it fails
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc  = subprocess.run([sys.executable, "-c", code], capture_output=True)
+        times.append(time.perf_counter() - start)
+        if proc.returncode != 0:
+            return None
+    return np.median(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the imports and detector database reads of the scripts")
+    parser.add_argument("--repeat"  , default=5, type=int)
+    parser.add_argument("--detector", default="next100")
+    parser.add_argument("--detdb"   , help="directory of the snapshots (sets LT_DETDB)")
+    args = parser.parse_args()
+
+    if args.detdb is not None:
+        os.environ["LT_DETDB"] = os.path.abspath(args.detdb)
+
+    base = run("pass", args.repeat)
+    print(f"{'interpreter':>30} {base*1e3:8.0f} ms")
+
+    for name, code in list(imports.items()) + [(k, v.format(detector=args.detector))
+                                               for k, v in list(lookups.items()) + list(startups.items())]:
+        t = run(code, args.repeat)
+        print(f"{name:>30} " + (f"{(t - base)*1e3:8.0f} ms" if t is not None else "  not available"))
@@ -0,0 +1,87 @@
+'''
+Benchmark of the Step-2 merge of the (N, sum, sum2) partials.
+
+Compares the old merge in lt_creator_S1S2_2.py (concat + groupby of the
+growing table for every file) with folding each partial into the dense
+accumulator. The partials are made in memory with the S2 binning so only
+the merge is timed.
+
+To run:
+python bench_step2_merge.py [npartials ...]
+
+The old merge is quadratic in the number of partials, so by default it is
+only run up to 1000 partials.
+'''
+
+import sys
+import time
+import numpy  as np
+import pandas as pd
+
+from lt_accumulator import LTAccumulator, make_binning
+from lt_binning     import bin_partial
+
+# S2 binning and the NEXT100 PMTs
+xmin=-500; xmax=500; xbw=20
+zmin=-12; zmax=2; zbw=1
+sensorids = np.arange(60)
+
+old_max = 1000 # largest number of partials to run the old merge on
+
+binning = make_binning(xmin, xmax, xbw, zmin, zmax, zbw)
+
+
+def make_partial(rng, nevents=100):
+    # One Step-1 job: nevents events, each seen by every PMT
+    ix = rng.integers(0, len(binning.xbins_centre), nevents)
+    iy = rng.integers(0, len(binning.ybins_centre), nevents)
+    iz = rng.integers(0, len(binning.zbins_centre), nevents)
+
+    q  = rng.exponential(1e-4, (len(sensorids), nevents))
+    df = pd.DataFrame({"sensor_id" : np.repeat(sensorids, nevents),
+                       "x"         : np.tile(binning.xbins_centre[ix], len(sensorids)),
+                       "y"         : np.tile(binning.ybins_centre[iy], len(sensorids)),
+                       "z"         : np.tile(binning.zbins_centre[iz], len(sensorids)),
+                       "N"         : 1,
+                       "sum"       : q.ravel(),
+                       "sum2"      : q.ravel()**2})
+
+    return df.groupby(['sensor_id', 'x', 'y', 'z']).agg({'N': 'sum', 'sum': 'sum', 'sum2': 'sum'}).reset_index()
+
+
+def merge_old(partials):
+    LT = pd.DataFrame()
+    for lt in partials:
+        LT = pd.concat([LT, lt])
+        LT = LT.groupby(['sensor_id', 'x', 'y', 'z']).agg({'N': 'sum', 'sum': 'sum', 'sum2': 'sum'}).reset_index()
+    return LT
+
+
+def merge_new(partials):
+    acc = LTAccumulator(sensorids, binning)
+    for lt in partials:
+        acc.add_sums(bin_partial(lt, acc), lt["N"].values, lt["sum"].values, lt["sum2"].values)
+    return acc
+
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or [1000, 10000]
+    rng   = np.random.default_rng(0)
+
+    # Reuse a pool of partials so making them does not dominate
+    pool = [make_partial(rng) for _ in range(100)]
+
+    for npartials in sizes:
+        partials = [pool[i % len(pool)] for i in range(npartials)]
+        nrows    = sum(len(p) for p in partials)
+
+        start = time.perf_counter()
+        merge_new(partials)
+        t_new = time.perf_counter() - start
+        print(f"{npartials:6d} partials, {nrows:9d} rows: accumulator {t_new:8.2f} s ({nrows/t_new:.3g} rows/s)")
+
+        if npartials <= old_max:
+            start = time.perf_counter()
+            merge_old(partials)
+            t_old = time.perf_counter() - start
+            print(f"{npartials:6d} partials, {nrows:9d} rows: concat+groupby {t_old:8.2f} s (x{t_old/t_new:.1f})")
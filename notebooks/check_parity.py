@@ -0,0 +1,146 @@
+'''
+Checks on synthetic files (lt_synthetic.py) that the accumulators give the
+tables of the original pandas code:
+- pandas:   build_table against the groupby/merge chain of lt_creator_slim.py
+            (kept in bench_pipeline.py), mean and std of each (sensor, bin)
+- workers:  build_table with nworkers processes against nworkers=1, which
+            must be identical, and the table and number of events of the
+            files with a secondary particle row per event
+- step2:    the lt_partial.py partials (fold_shard + to_partial) merged as
+            in lt_creator_S1S2_2.py against the old concat/groupby of the
+            partials and its mean and std (ddof=0)
+
+To run (from the notebooks directory):
+python check_parity.py --nfiles 4 --nevents 200 --nworkers 2
+
+The exit status is 1 if a check fails.
+'''
+
+import os
+import sys
+import shutil
+import argparse
+import numpy  as np
+import pandas as pd
+
+from lt_accumulator  import LTAccumulator, make_binning
+from lt_binning      import bin_partial
+from lt_parallel     import build_table, fold_shard
+from lt_synthetic    import make_files
+from bench_pipeline  import binnings, sensorids, read_pandas, filter_pandas, time_sum_pandas, join_pandas, bin_pandas, aggregate_pandas
+from bench_step2_merge import merge_old
+
+rtol = 1e-9
+
+
+def compare(name, a, b, index, atol=0.):
+    '''
+    Print and return whether two (index, charge) frames have the same rows
+    and charges within rtol (or atol).
+    '''
+    a = a.astype({k : float for k in index}).set_index(index)["charge"].astype(float)
+    b = b.astype({k : float for k in index}).set_index(index)["charge"].astype(float)
+    a, b = a.align(b, join="outer")
+
+    same = np.allclose(a.values, b.values, rtol=rtol, atol=atol, equal_nan=True)
+    diff = np.nanmax(np.abs(a.values - b.values)) if len(a) else 0.
+    print(f"{name:>30}: {len(a)} rows, largest difference {diff:.2g} {'ok' if same else 'FAILED'}")
+    return same
+
+
+def with_secondaries(filename, directory):
+    # Copy of a file with a second MC/particles row (particle_id 2) for each event, as in the nexus files
+    os.makedirs(directory, exist_ok=True)
+    outname = os.path.join(directory, os.path.basename(filename))
+    shutil.copy(filename, outname)
+
+    parts = pd.read_hdf(filename, "MC/particles")
+    parts = pd.concat([parts, parts.assign(particle_id=2)]).sort_values("event_id", kind="stable")
+    parts.to_hdf(outname, key="MC/particles", format="table", mode="a")
+    return outname
+
+
+def pandas_chain(filenames, signal_type, binning):
+    # lt_creator_slim.py before the accumulators
+    LT_list = []
+    for filename in filenames:
+        parts, nphotons, sns_response = read_pandas(filename)
+        pmt_response = time_sum_pandas(filter_pandas(sns_response))
+        pmt_response = bin_pandas(join_pandas(pmt_response, parts), binning)
+        pmt_response['charge'] = pmt_response['charge']/nphotons
+        LT_list.append(pmt_response)
+    return aggregate_pandas(LT_list, signal_type)
+
+
+def check_pandas(filenames, signal_type, binning):
+    index   = ["sensor_id", "x", "y"] if signal_type == "S2" else ["sensor_id", "x", "y", "z"]
+    lt, err = pandas_chain(filenames, signal_type, binning)
+
+    acc = build_table(filenames, sensorids, binning, sum_z=signal_type == "S2")
+    new_lt, new_err = acc.aggregate(signal_type)
+    return (compare(f"{signal_type} pandas mean", new_lt , lt , index) &
+            compare(f"{signal_type} pandas std" , new_err, err, index))
+
+
+def check_workers(filenames, signal_type, binning, nworkers):
+    sum_z  = signal_type == "S2"
+    serial = build_table(filenames, sensorids, binning, sum_z, nworkers=1       , files_per_shard=1)
+    multi  = build_table(filenames, sensorids, binning, sum_z, nworkers=nworkers, files_per_shard=1)
+
+    same = all(np.array_equal(getattr(serial, a), getattr(multi, a), equal_nan=True) for a in ["N", "mean", "M2"])
+    print(f"{signal_type + f' nworkers={nworkers} vs 1':>30}: {'identical' if same else 'FAILED'}")
+
+    # Secondary particles change neither the table nor the number of events
+    directory = os.path.join(os.path.dirname(filenames[0]), "secondaries")
+    copies    = [with_secondaries(f, directory) for f in filenames]
+    acc, counted = fold_shard(copies, sensorids, binning, sum_z)
+    nevents = sum(pd.read_hdf(f, "MC/particles")["event_id"].nunique() for f in filenames)
+
+    events = counted == nevents and all(np.array_equal(getattr(serial, a), getattr(acc, a), equal_nan=True)
+                                        for a in ["N", "mean", "M2"])
+    print(f"{signal_type + ' secondaries':>30}: {counted} events counted, {nevents} in MC/particles {'ok' if events else 'FAILED'}")
+    return same and events
+
+
+def check_step2(filenames, signal_type, binning):
+    # Step 1 of lt_partial.py, always binned in z
+    partials = [fold_shard([f], sensorids, binning, sum_z=False)[0].to_partial() for f in filenames]
+
+    # Step 2 of lt_creator_S1S2_2.py before the accumulators
+    column_arr = ["sensor_id", "x", "y"] if signal_type == "S2" else ["sensor_id", "x", "y", "z"]
+    LT  = merge_old(partials)
+    old = LT.groupby(column_arr).agg({'N': 'sum', 'sum': 'sum', 'sum2': 'sum'}).reset_index()
+    old["mean"] = old["sum"] / old["N"]
+    old["std"]  = np.sqrt(old.sum2/old.N - old["mean"]**2)
+
+    acc = LTAccumulator(sensorids, binning)
+    for lt in partials:
+        acc.add_sums(bin_partial(lt, acc), lt["N"].values, lt["sum"].values, lt["sum2"].values)
+    lt, err = acc.aggregate(signal_type, ddof=0)
+
+    # The old std loses the small spreads to cancellation, so it is compared to the precision of the sums
+    atol = np.sqrt(np.finfo(float).eps) * old["mean"].abs().max()
+    return (compare(f"{signal_type} step2 mean", lt , old[column_arr].assign(charge=old["mean"]), column_arr) &
+            compare(f"{signal_type} step2 std" , err, old[column_arr].assign(charge=old["std"]) , column_arr, atol))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the accumulators against the pandas code on synthetic files")
+    parser.add_argument("--nfiles"     , default=4  , type=int)
+    parser.add_argument("--nevents"    , default=200, type=int, help="events per file")
+    parser.add_argument("--nworkers"   , default=2  , type=int)
+    parser.add_argument("--signal-type", default=["S1", "S2"], nargs="+", choices=["S1", "S2"])
+    parser.add_argument("--workdir"    , default="parity_files")
+    args = parser.parse_args()
+
+    ok = True
+    for signal_type in args.signal_type:
+        binning   = make_binning(*binnings[signal_type])
+        filenames = make_files(os.path.join(args.workdir, f"{signal_type}_{args.nevents}"), args.nfiles, args.nevents, signal_type)
+
+        ok &= check_pandas (filenames, signal_type, binning)
+        ok &= check_workers(filenames, signal_type, binning, args.nworkers)
+        ok &= check_step2  (filenames, signal_type, binning)
+
+    print("All checks passed" if ok else "Some checks FAILED")
+    sys.exit(0 if ok else 1)
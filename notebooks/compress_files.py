@@ -1,33 +1,146 @@
 # Python script to slim nexus files
-import sys
+import os
+import time
+import argparse
+import numpy  as np
 import pandas as pd
 
-# python3 <basename>
+from lt_report import Report
 
-config = pd.read_hdf(sys.argv[1]+".h5", key = 'MC/configuration')
-print(config)
+# python3 <basename> [options]
+#
+# By default all the tables are rewritten with zlib level 5 in table format.
+# For the light tables only MC/configuration, MC/particles and MC/sns_response
+# are needed, e.g.
+# python3 compress_files.py NEXUS_OUTPUT --lt-only --downcast int --complib blosc:zstd
+#
+# To compare the settings on a file:
+# python3 compress_files.py NEXUS_OUTPUT --benchmark
+#
+# The load and write stages are reported as JSON lines on stdout (see
+# lt_report.py), give --jobid to tag them on the grid.
 
-parts = pd.read_hdf(sys.argv[1]+".h5", key = 'MC/particles')
-print(parts)
+tables = ['MC/configuration', 'MC/particles', 'MC/hits', 'MC/sns_response', 'MC/sns_positions']
 
-# Same with the hits
-hits = pd.read_hdf(sys.argv[1]+".h5", key = 'MC/hits')
-print(hits)
+# Tables and columns read by the light table creators
+lt_columns = {'MC/configuration' : None,
+              'MC/particles'     : ['event_id', 'initial_x', 'initial_y', 'initial_z'],
+              'MC/sns_response'  : ['event_id', 'sensor_id', 'time_bin', 'charge']}
 
-# Same with the sensor hits
-sns_response = pd.read_hdf(sys.argv[1]+".h5", key = 'MC/sns_response')
-print(sns_response)
+# Settings compared by --benchmark: (complib, complevel, format)
+bench_settings = [('zlib'      , 5, 'table'),
+                  ('zlib'      , 1, 'table'),
+                  ('blosc:lz4' , 5, 'table'),
+                  ('blosc:zstd', 5, 'table'),
+                  ('blosc:lz4' , 5, 'fixed'),
+                  ('blosc:zstd', 5, 'fixed')]
 
-# Same with the sensor positions
-sns_positions = pd.read_hdf(sys.argv[1]+".h5", key = 'MC/sns_positions')
-print(sns_positions)
 
+def downcast(df, floats=False):
+    '''
+    Convert the integer columns to the smallest dtype holding their values
+    and, with floats, the float columns to float32.
+    '''
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_integer_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+        elif floats and pd.api.types.is_float_dtype(df[col]):
+            df[col] = df[col].astype(np.float32)
+    return df
 
-# Open the HDF5 file in write mode
-with pd.HDFStore(f"{sys.argv[1]}_slim.h5", mode='w', complevel=5, complib='zlib') as store:
-    # Write each DataFrame to the file with a unique key
-    store.put('MC/configuration', config, format='table')
-    store.put('MC/particles',parts, format='table')
-    store.put('MC/hits',hits, format='table')
-    store.put('MC/sns_response',sns_response, format='table')
-    store.put('MC/sns_positions',sns_positions, format='table')
\ No newline at end of file
+
+def load(basename, keep, columns, cast):
+    dfs = {}
+    for key in keep:
+        df = pd.read_hdf(basename+".h5", key = key)
+        if columns.get(key) is not None:
+            df = df[[c for c in columns[key] if c in df.columns]]
+        if cast != 'none' and key != 'MC/configuration':
+            df = downcast(df, floats=(cast == 'all'))
+        dfs[key] = df
+    return dfs
+
+
+def write(outfilename, dfs, complib, complevel, fmt):
+    # Open the HDF5 file in write mode
+    with pd.HDFStore(outfilename, mode='w', complevel=complevel, complib=complib) as store:
+        # Write each DataFrame to the file with a unique key
+        for key, df in dfs.items():
+            if fmt == 'fixed':
+                # Contiguous, chunked column blocks: fastest to read in one go,
+                # but the readers can no longer stream them in chunks
+                store.put(key, df, format='fixed')
+            else:
+                # Size the table chunks for the whole table
+                store.append(key, df, format='table', expectedrows=len(df))
+
+
+def read(filename):
+    with pd.HDFStore(filename, mode='r') as store:
+        for key in store.keys():
+            store[key]
+
+
+def benchmark(basename, dfs, insize):
+    print(f"{'complib':>12} {'level':>5} {'format':>6} {'write [s]':>10} {'read [s]':>9} {'size [MB]':>10} {'ratio':>6}")
+
+    outfilename = f"{basename}_bench.h5"
+    for complib, complevel, fmt in bench_settings:
+        start = time.perf_counter()
+        write(outfilename, dfs, complib, complevel, fmt)
+        t_write = time.perf_counter() - start
+
+        start = time.perf_counter()
+        read(outfilename)
+        t_read = time.perf_counter() - start
+
+        size = os.path.getsize(outfilename)
+        print(f"{complib:>12} {complevel:>5} {fmt:>6} {t_write:10.3f} {t_read:9.3f} {size/1024**2:10.2f} {insize/size:6.2f}")
+
+    os.remove(outfilename)
+
+
+parser = argparse.ArgumentParser(description="Slim and recompress a nexus file")
+parser.add_argument("basename", help="input file without the .h5 extension")
+parser.add_argument("--complib"  , default="zlib", help="compression library, e.g. zlib, blosc:lz4, blosc:zstd")
+parser.add_argument("--complevel", default=5, type=int, help="compression level")
+parser.add_argument("--format"   , default="table", choices=["table", "fixed"], help="pandas HDF5 format")
+parser.add_argument("--drop"     , default=[], nargs="*", help="tables to leave out, e.g. MC/hits")
+parser.add_argument("--lt-only"  , action="store_true", help="only keep the tables and columns used for the light tables")
+parser.add_argument("--downcast" , default="none", choices=["none", "int", "all"],
+                    help="downcast the integer columns (int) or also the floats to float32 (all)")
+parser.add_argument("--benchmark", action="store_true", help="compare the codecs and formats instead of writing the file")
+parser.add_argument("--jobid"    , default=None, type=int, help="job id written to the run report")
+args = parser.parse_args()
+
+report = Report("compress_files", jobid=args.jobid)
+
+keep    = [key for key in tables if key not in args.drop]
+columns = {}
+if args.lt_only:
+    keep    = [key for key in keep if key in lt_columns]
+    columns = lt_columns
+
+insize = os.path.getsize(args.basename+".h5")
+
+with report.stage("load", bytes=insize) as rec:
+    dfs = load(args.basename, keep, columns, args.downcast)
+    rec["rows"] = sum(len(df) for df in dfs.values())
+    if 'MC/particles' in dfs:
+        rec["events"] = dfs['MC/particles']['event_id'].nunique()
+report.add(bytes=insize, rows=rec["rows"], events=rec.get("events", 0))
+
+for key, df in dfs.items():
+    print(key)
+    print(df)
+
+if args.benchmark:
+    benchmark(args.basename, dfs, insize)
+else:
+    outfilename = f"{args.basename}_slim.h5"
+    with report.stage("write", rows=rec["rows"]) as out:
+        write(outfilename, dfs, args.complib, args.complevel, args.format)
+        out["bytes"] = os.path.getsize(outfilename)
+
+report.close()
@@ -0,0 +1,325 @@
+'''
+Streaming accumulators for building the light tables.
+
+Instead of keeping every (sensor, event) row in memory until the end, each
+file is folded into fixed size per-sensor, per-voxel arrays holding the
+count, mean and sum of squared deviations (M2). Partial accumulators are
+combined with the parallel moments update (Chan et al.), so the memory
+used depends on the table size and not on the number of events.
+
+Usage:
+binning = make_binning(xmin, xmax, xbw, zmin, zmax, zbw)
+acc = LTAccumulator(sensorids, binning)
+acc.add(acc.cell_index(sensor_id, ix, iy, iz), charge)
+lt, err = acc.aggregate(signal_type)
+
+lt and err have the same layout as the groupby mean/std frames made in
+lt_creator_slim.py, so the usual pivot can be applied to them.
+'''
+
+import numpy  as np
+import pandas as pd
+
+
+class Binning:
+    '''
+    The x, y, z bin edges and centres used by the creator scripts.
+    '''
+    def __init__(self, xbins, ybins, zbins, xbins_centre, ybins_centre, zbins_centre):
+        self.xbins = np.asarray(xbins, dtype=float)
+        self.ybins = np.asarray(ybins, dtype=float)
+        self.zbins = np.asarray(zbins, dtype=float)
+
+        self.xbins_centre = np.asarray(xbins_centre, dtype=float)
+        self.ybins_centre = np.asarray(ybins_centre, dtype=float)
+        self.zbins_centre = np.asarray(zbins_centre, dtype=float)
+
+    @property
+    def shape(self):
+        return (len(self.xbins_centre), len(self.ybins_centre), len(self.zbins_centre))
+
+    def collapse_z(self):
+        # A single z bin covering the whole z range, as for the S2 tables
+        return Binning(self.xbins, self.ybins, self.zbins[[0, -1]], self.xbins_centre, self.ybins_centre,
+                       [0.5*(self.zbins[0] + self.zbins[-1])])
+
+    def z_slice(self, z0, z1):
+        # The z bins z0 to z1 (excluded)
+        return Binning(self.xbins, self.ybins, self.zbins[z0:z1+1], self.xbins_centre, self.ybins_centre,
+                       self.zbins_centre[z0:z1])
+
+
+def make_binning(xmin, xmax, xbw, zmin, zmax, zbw):
+    # Same arithmetic as the creator scripts, y bins are set equal to x
+    xbins = np.arange(xmin, xmax+xbw, xbw)
+    zbins = np.arange(zmin, zmax+zbw, zbw)
+
+    xbins_centre = np.arange(xmin+xbw/2, xmax+xbw/2, xbw)
+    zbins_centre = np.arange(zmin+zbw/2, zmax+zbw/2, zbw)
+
+    return Binning(xbins, xbins, zbins, xbins_centre, xbins_centre, zbins_centre)
+
+
+def merge_moments(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    '''
+    Parallel update of (count, mean, M2) for two sets of samples.
+    Cells with no entries in either set are left untouched.
+    '''
+    n     = n_a + n_b
+    delta = mean_b - mean_a
+    frac  = np.divide(n_b, n, out=np.zeros(np.shape(n)), where=n > 0)
+
+    mean = mean_a + delta * frac
+    m2   = m2_a + m2_b + delta**2 * n_a * frac
+
+    return n, mean, m2
+
+
+def edge_index(fine, coarse):
+    '''
+    Position of each coarse bin edge in the fine edges. Raises a
+    ValueError if the coarse grid cannot be made from the fine one.
+    '''
+    fine, coarse = np.asarray(fine, dtype=float), np.asarray(coarse, dtype=float)
+    tol  = 1e-6 * np.min(np.diff(fine))
+    pos  = np.clip(np.searchsorted(fine, coarse - tol), 0, len(fine) - 1)
+
+    if not np.allclose(fine[pos], coarse, rtol=0, atol=tol) or np.any(np.diff(pos) <= 0):
+        raise ValueError(f"Bin edges {coarse} are not a subset of {fine}")
+    return pos
+
+
+def reduce_moments(N, mean, M2, starts, axis):
+    '''
+    Combine the (count, mean, M2) of the groups of bins starting at starts
+    along axis into one bin each.
+    '''
+    n = np.add.reduceat(N, starts, axis=axis)
+    s = np.add.reduceat(N * mean, starts, axis=axis)
+    m = np.divide(s, n, out=np.zeros(n.shape), where=n > 0)
+
+    # Mean of the group of each fine bin
+    group = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, N.shape[axis])))
+    delta = mean - np.take(m, group, axis=axis)
+
+    m2 = np.add.reduceat(M2 + N * delta**2, starts, axis=axis)
+    return n, m, m2
+
+
+# MB of temporaries used by rebin for each block of sensors
+rebin_memory = 200
+
+
+class LTAccumulator:
+    '''
+    Dense (sensor, x, y, z) accumulator of the normalised charge. With a
+    mask only the (x, y) voxels where it is True are filled.
+    '''
+    def __init__(self, sensorids, binning, mask=None):
+        self.sensorids = np.asarray(sensorids)
+        self.binning   = binning
+        self.shape     = (len(self.sensorids),) + binning.shape
+
+        self.N    = np.zeros(self.shape, dtype=np.int64)
+        self.mean = np.zeros(self.shape)
+        self.M2   = np.zeros(self.shape)
+        self.mask = None if mask is None else np.asarray(mask, dtype=bool) # see apply_mask
+        self.time = None # arrival times and time profiles, see lt_time.py
+
+        # Lookup from sensor id to the sensor axis of the arrays
+        self._order  = np.argsort(self.sensorids)
+        self._sorted = self.sensorids[self._order]
+
+    @property
+    def size(self):
+        return self.N.size
+
+    def sensor_index(self, sensor_id):
+        # Returns -1 for sensors not in the table
+        sensor_id = np.asarray(sensor_id)
+        pos   = np.searchsorted(self._sorted, sensor_id)
+        pos   = np.clip(pos, 0, len(self._sorted) - 1)
+        found = self._sorted[pos] == sensor_id
+        return np.where(found, self._order[pos], -1)
+
+    def cell_index(self, sensor_id, ix, iy, iz):
+        '''
+        Flat index into the accumulator arrays. Rows outside the table
+        (unknown sensor or a bin index of -1) get an index of -1.
+        '''
+        return self.flat_index(self.sensor_index(sensor_id), ix, iy, iz)
+
+    def flat_index(self, isns, ix, iy, iz):
+        # Same as cell_index but from the position on the sensor axis
+        isns  = np.asarray(isns, dtype=np.int64)
+        ix    = np.asarray(ix, dtype=np.int64)
+        iy    = np.asarray(iy, dtype=np.int64)
+        iz    = np.asarray(iz, dtype=np.int64)
+        valid = (isns >= 0) & (ix >= 0) & (iy >= 0) & (iz >= 0)
+
+        if self.mask is not None:
+            valid &= self.mask[np.maximum(ix, 0), np.maximum(iy, 0)]
+
+        _, nx, ny, nz = self.shape
+        cells = ((isns * nx + ix) * ny + iy) * nz + iz
+        return np.where(valid, cells, -1)
+
+    def add(self, cells, values):
+        '''
+        Fold a set of samples into the accumulator. cells are the flat
+        indices from cell_index, entries with -1 are skipped.
+        '''
+        cells  = np.asarray(cells)
+        values = np.asarray(values, dtype=float)
+        keep   = cells >= 0
+        cells, values = cells[keep], values[keep]
+
+        # Two pass mean and M2 of the new samples, only over the cells hit
+        # so the cost follows the number of samples and not the table size
+        hit, inv = np.unique(cells, return_inverse=True)
+        n    = np.bincount(inv)
+        mean = np.bincount(inv, weights=values) / n
+        d    = values - mean[inv]
+        m2   = np.bincount(inv, weights=d*d)
+
+        N, M, M2 = self.N.reshape(-1), self.mean.reshape(-1), self.M2.reshape(-1)
+        N[hit], M[hit], M2[hit] = merge_moments(N[hit], M[hit], M2[hit], n, mean, m2)
+
+    def add_sums(self, cells, n, s, s2):
+        '''
+        Fold (N, sum, sum2) partials, as written by the Step-1 jobs.
+        Cells with -1 are skipped.
+        '''
+        cells = np.asarray(cells)
+        keep  = cells >= 0
+        hit, inv = np.unique(cells[keep], return_inverse=True)
+
+        n    = np.bincount(inv, weights=np.asarray(n, dtype=float)[keep])
+        s    = np.bincount(inv, weights=np.asarray(s, dtype=float)[keep])
+        s2   = np.bincount(inv, weights=np.asarray(s2, dtype=float)[keep])
+        mean = np.divide(s, n, out=np.zeros(len(n)), where=n > 0)
+        m2   = np.maximum(s2 - s * mean, 0)
+
+        N, M, M2 = self.N.reshape(-1), self.mean.reshape(-1), self.M2.reshape(-1)
+        N[hit], M[hit], M2[hit] = merge_moments(N[hit], M[hit], M2[hit], n.astype(np.int64), mean, m2)
+
+    def add_moments(self, n, mean, m2):
+        '''
+        Fold (N, mean, M2) arrays of the same shape, in place and only over
+        the cells they fill inside the mask.
+        '''
+        n, mean, m2 = (np.asarray(a).reshape(-1) for a in (n, mean, m2))
+        hit = np.flatnonzero(n)
+        if self.mask is not None:
+            _, ix, iy, _ = np.unravel_index(hit, self.shape)
+            hit = hit[self.mask[ix, iy]]
+
+        N, M, M2 = self.N.reshape(-1), self.mean.reshape(-1), self.M2.reshape(-1)
+        N[hit], M[hit], M2[hit] = merge_moments(N[hit], M[hit], M2[hit], n[hit], mean[hit], m2[hit])
+
+    def merge(self, other):
+        self.add_moments(other.N, other.mean, other.M2)
+        if self.time is not None:
+            self.time.merge(other.time)
+        return self
+
+    def apply_mask(self, mask):
+        '''
+        Keep only the (x, y) voxels where mask is True (e.g. active_mask),
+        the others are emptied and skipped by later adds.
+        '''
+        self.mask = np.asarray(mask, dtype=bool)
+        outside   = ~self.mask
+
+        self.N   [:, outside] = 0
+        self.mean[:, outside] = 0.
+        self.M2  [:, outside] = 0.
+
+        if self.time is not None:
+            self.time.apply_mask(mask)
+        return self
+
+    def rebin(self, binning):
+        '''
+        Accumulator on a coarser grid whose bin edges are all edges of this
+        one (e.g. 20 mm bins from 5 mm ones, or a subrange). The moments of
+        the fine bins are combined exactly, as if the samples had been
+        binned on the coarse grid. The sensors are combined a block at a
+        time, so the temporaries take at most about rebin_memory MB.
+        '''
+        edges = [edge_index(fine, coarse) for fine, coarse in [(self.binning.xbins, binning.xbins),
+                                                               (self.binning.ybins, binning.ybins),
+                                                               (self.binning.zbins, binning.zbins)]]
+        out   = LTAccumulator(self.sensorids, binning)
+        block = max(1, int(rebin_memory * 1024**2 / (6 * 8 * np.prod(self.shape[1:]))))
+
+        for start in range(0, len(self.sensorids), block):
+            sl = slice(start, start + block)
+            N, mean, M2 = self.N[sl], self.mean[sl], self.M2[sl]
+
+            for axis, pos in enumerate(edges, 1):
+                index = [slice(None)] * 4
+                index[axis] = slice(pos[0], pos[-1])
+                N, mean, M2 = reduce_moments(N[tuple(index)], mean[tuple(index)], M2[tuple(index)], pos[:-1] - pos[0], axis)
+
+            out.N[sl], out.mean[sl], out.M2[sl] = N, mean, M2
+
+        # A coarse (x, y) voxel is kept if any of its fine voxels is
+        if self.mask is not None:
+            mask = self.mask[edges[0][0]:edges[0][-1], edges[1][0]:edges[1][-1]]
+            mask = np.logical_or.reduceat(mask, edges[0][:-1] - edges[0][0], axis=0)
+            out.mask = np.logical_or.reduceat(mask, edges[1][:-1] - edges[1][0], axis=1)
+        return out
+
+    def collapse_z(self):
+        '''
+        Combine all the z bins into one, as done for the S2 tables.
+        '''
+        return self.rebin(self.binning.collapse_z())
+
+    def to_partial(self):
+        '''
+        Filled cells as a (sensor_id, x, y, z, N, sum, sum2) dataframe,
+        the Step-1 format written by lt_creator_S1S2_1.py.
+        '''
+        isns, ix, iy, iz = np.nonzero(self.N)
+        n    = self.N   [isns, ix, iy, iz]
+        mean = self.mean[isns, ix, iy, iz]
+
+        return pd.DataFrame({"sensor_id" : self.sensorids[isns],
+                             "x"         : self.binning.xbins_centre[ix],
+                             "y"         : self.binning.ybins_centre[iy],
+                             "z"         : self.binning.zbins_centre[iz],
+                             "N"         : n,
+                             "sum"       : n * mean,
+                             "sum2"      : self.M2[isns, ix, iy, iz] + n * mean**2})
+
+    def std(self, ddof=1):
+        # Standard deviation, NaN where there are not more than ddof entries
+        var = np.divide(self.M2, self.N - ddof, out=np.full(self.shape, np.nan), where=self.N > ddof)
+        return np.sqrt(var)
+
+    def aggregate(self, signal_type, ddof=1):
+        '''
+        Mean and std of the charge for each filled sensor and voxel as long
+        form dataframes. For S2 the z bins are summed over and the z column
+        is dropped.
+        '''
+        acc = self.collapse_z() if signal_type == "S2" else self
+
+        isns, ix, iy, iz = np.nonzero(acc.N)
+
+        lt = pd.DataFrame({"sensor_id" : acc.sensorids[isns],
+                           "x"         : acc.binning.xbins_centre[ix],
+                           "y"         : acc.binning.ybins_centre[iy],
+                           "z"         : acc.binning.zbins_centre[iz],
+                           "charge"    : acc.mean[isns, ix, iy, iz]})
+
+        err = lt.copy()
+        err["charge"] = acc.std(ddof)[isns, ix, iy, iz]
+
+        if signal_type == "S2":
+            lt  = lt .drop(columns="z")
+            err = err.drop(columns="z")
+
+        return lt, err
@@ -0,0 +1,246 @@
+'''
+Adaptive (non-uniform) voxels for the light tables.
+
+Starting from the accumulators of a fine uniform grid, the whole volume
+is split recursively in two along each axis (an octree, or a quadtree for
+the S2 tables with one z bin, k-d style when an axis cannot be split any
+more). A cell is split when its children differ significantly for some
+sensor: the F statistic of the children means (between / within cell
+variance) is above fmin and a child mean differs from the cell mean by
+more than rel_min, and every filled child has at least min_entries
+events. So the cells stay large in the bulk where the response is flat
+and follow the fine grid near the planes and the field cage, where it is
+steep. The moments of any cell are taken from prefix sums of the fine
+grid, so the tree is built in one vectorised pass per depth.
+
+The tree is stored as flat node arrays: for each node the first child
+(-1 for a leaf), the split point in fine bins and the stride of the
+child code on each axis, and for the leaves their row in the value
+arrays. A point is looked up by binning it on the fine grid and
+descending all the points together, one depth at a time.
+
+Layout of the group (LT_adaptive by default):
+value, error, entries [leaf, sensor]   as in LT_dense
+total [leaf]
+lower, upper [leaf, 3]                 x, y, z edges of each leaf
+child, leaf [node], split, stride [node, 3]
+xbins, ..., zbins_centre, sensor_ids   the fine grid
+
+Usage:
+table = build_adaptive(acc, fmin=4, rel_min=0.02, min_entries=20)
+values, total = table.query(x, y, z)
+write_adaptive(h5out, table, config)
+'''
+
+import numpy  as np
+import tables as tb
+
+from lt_accumulator import Binning
+from lt_binning     import bin_xyz
+from lt_dense       import axes
+
+
+def prefix_sums(a):
+    # (sensor, x+1, y+1, z+1) cumulative sums with a leading zero on each axis
+    p = np.zeros((a.shape[0],) + tuple(n + 1 for n in a.shape[1:]))
+    p[:, 1:, 1:, 1:] = a.cumsum(1).cumsum(2).cumsum(3)
+    return p
+
+
+def box_sums(p, lo, hi):
+    '''
+    Sums of the fine bins in the boxes [lo, hi) (n, 3) from prefix sums,
+    shaped (sensor, n).
+    '''
+    (x0, y0, z0), (x1, y1, z1) = lo.T, hi.T
+    return (p[:, x1, y1, z1] - p[:, x0, y1, z1] - p[:, x1, y0, z1] - p[:, x1, y1, z0]
+          + p[:, x0, y0, z1] + p[:, x0, y1, z0] + p[:, x1, y0, z0] - p[:, x0, y0, z0])
+
+
+class AdaptiveTable:
+    '''
+    Adaptive voxel table: the node arrays of the tree, the leaf boxes and
+    their values.
+    '''
+    def __init__(self, binning, sensorids, child, split, stride, leaf, lower, upper, value, error, entries):
+        self.binning   = binning
+        self.sensorids = np.asarray(sensorids)
+        self.child     = child
+        self.split     = split
+        self.stride    = stride
+        self.leaf      = leaf
+        self.lower     = lower
+        self.upper     = upper
+        self.value     = value
+        self.error     = error
+        self.entries   = entries
+
+    @property
+    def nleaves(self):
+        return len(self.value)
+
+    def lookup(self, x, y, z):
+        '''
+        Leaf of each point, -1 outside the table.
+        '''
+        ix, iy, iz = bin_xyz(self.binning, x, y, z)
+        fine   = np.stack([ix, iy, iz], axis=1)
+        inside = np.all(fine >= 0, axis=1)
+
+        node   = np.zeros(len(fine), dtype=np.int64)
+        active = np.flatnonzero(inside & (self.child[node] >= 0))
+        while len(active):
+            n    = node[active]
+            code = ((fine[active] >= self.split[n]) * self.stride[n]).sum(axis=1)
+            node[active] = self.child[n] + code
+            active = active[self.child[node[active]] >= 0]
+
+        return np.where(inside, self.leaf[node], -1)
+
+    def query(self, x, y, z):
+        '''
+        Values (n, sensor) and total of the leaf of each point, NaN outside
+        the table, as LightTable.query with method="nearest".
+        '''
+        leaf   = self.lookup(x, y, z)
+        values = np.where(leaf[:, None] >= 0, self.value[np.maximum(leaf, 0)], np.nan)
+        return values, np.nansum(values, axis=1)
+
+
+def split_cells(p_n, p_s, p_q, lo, hi, depth, min_depth, fmin, rel_min, min_entries):
+    '''
+    Children boxes of a set of cells and whether each cell is split.
+    Returns split, the split point, the child code stride and for each of
+    the 8 possible children its box and whether it exists.
+    '''
+    length    = hi - lo
+    can_split = length > 1
+    mid       = lo + length // 2
+
+    sx, sy, sz = can_split.T.astype(np.int64)
+    stride     = np.stack([(1 + sy) * (1 + sz), 1 + sz, np.ones_like(sz)], axis=1) * can_split
+
+    bits   = np.array([[bx, by, bz] for bx in (0, 1) for by in (0, 1) for bz in (0, 1)])
+    exists = np.all((bits[None, :, :] == 0) | can_split[:, None, :], axis=2)
+    clo    = np.where(bits[None] == 1, mid[:, None], lo [:, None])
+    chi    = np.where((bits[None] == 0) & can_split[:, None], mid[:, None], hi[:, None])
+
+    # Moments of the children, (sensor, cell, child)
+    ncell = len(lo)
+    shape = (-1, ncell, 8)
+    cN = box_sums(p_n, clo.reshape(-1, 3), chi.reshape(-1, 3)).reshape(shape) * exists
+    cS = box_sums(p_s, clo.reshape(-1, 3), chi.reshape(-1, 3)).reshape(shape) * exists
+    cQ = box_sums(p_q, clo.reshape(-1, 3), chi.reshape(-1, 3)).reshape(shape) * exists
+
+    N, S, Q = cN.sum(2), cS.sum(2), cQ.sum(2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean    = S / N
+        cmean   = cS / cN
+        k       = (cN > 0).sum(2)
+        ss      = np.nansum(cS**2 / cN, axis=2)
+        between = ss - S**2 / N
+        within  = Q - ss
+        F       = (between / (k - 1)) / (within / (N - k))
+        rel     = np.nanmax(np.abs(cmean - mean[..., None]), axis=2) / np.abs(mean)
+
+    significant = np.any((F > fmin) & (rel > rel_min) & (k > 1), axis=0)
+
+    # Events in each child, the filled ones need min_entries
+    events = cN.max(axis=0)
+    enough = np.all((events >= min_entries) | (events == 0), axis=1)
+
+    split = np.any(can_split, axis=1) & ((depth < min_depth) | (significant & enough))
+    return split, mid, stride, exists, clo, chi
+
+
+def build_adaptive(acc, fmin=4., rel_min=0.02, min_entries=20, min_depth=2):
+    '''
+    Adaptive table from the accumulators of a fine grid (after the S2
+    collapse for the S2 tables). The cells down to min_depth are always
+    split.
+    '''
+    N    = acc.N.astype(float)
+    p_n  = prefix_sums(N)
+    p_s  = prefix_sums(N * acc.mean)
+    p_q  = prefix_sums(acc.M2 + N * acc.mean**2)
+
+    child, split_at, strides, leaf_of = [], [], [], []
+    leaves_lo, leaves_hi = [], []
+
+    lo    = np.zeros((1, 3), dtype=np.int64)
+    hi    = np.array([acc.shape[1:]], dtype=np.int64)
+    first = 1 # id of the first node of the next depth
+    depth = 0
+    nleaf = 0
+
+    while len(lo):
+        split, mid, stride, exists, clo, chi = split_cells(p_n, p_s, p_q, lo, hi, depth,
+                                                           min_depth, fmin, rel_min, min_entries)
+
+        nchildren = np.where(split, exists.sum(1), 0)
+        offsets   = first + np.cumsum(nchildren) - nchildren
+        child   .append(np.where(split, offsets, -1))
+        split_at.append(mid)
+        strides .append(np.where(split[:, None], stride, 0))
+
+        ids = np.full(len(lo), -1)
+        ids[~split] = nleaf + np.arange(np.count_nonzero(~split))
+        leaf_of  .append(ids)
+        leaves_lo.append(lo[~split])
+        leaves_hi.append(hi[~split])
+        nleaf += np.count_nonzero(~split)
+
+        # Children in the order of their code
+        keep  = exists & split[:, None]
+        lo, hi = clo[keep], chi[keep]
+        first += len(lo)
+        depth += 1
+
+    lo, hi = np.concatenate(leaves_lo), np.concatenate(leaves_hi)
+
+    n = box_sums(p_n, lo, hi).T
+    s = box_sums(p_s, lo, hi).T
+    q = box_sums(p_q, lo, hi).T
+    with np.errstate(invalid="ignore", divide="ignore"):
+        value = np.where(n > 0, s / n, np.nan)
+        std   = np.sqrt(np.maximum(q - s * value, 0) / (n - 1))
+        error = np.where(n > 1, 100 * std / value, np.nan)
+
+    b     = acc.binning
+    edges = [b.xbins, b.ybins, b.zbins]
+    lower = np.stack([edges[a][lo[:, a]] for a in range(3)], axis=1)
+    upper = np.stack([edges[a][hi[:, a]] for a in range(3)], axis=1)
+
+    return AdaptiveTable(b, acc.sensorids, np.concatenate(child), np.concatenate(split_at),
+                         np.concatenate(strides), np.concatenate(leaf_of),
+                         lower, upper, value, error, n.astype(np.int64))
+
+
+def write_adaptive(h5out, table, config, group="LT_adaptive", filters=None):
+    '''
+    Write an adaptive table to an open PyTables file. config is the
+    (parameter, value) dataframe saved in LT/Config.
+    '''
+    if filters is None:
+        filters = tb.Filters(complevel=5, complib="zlib", shuffle=True)
+
+    grp = h5out.create_group("/", group, createparents=True)
+    for name in ["value", "error", "entries", "lower", "upper", "child", "split", "stride", "leaf"]:
+        h5out.create_carray(grp, name, obj=getattr(table, name), filters=filters)
+    h5out.create_carray(grp, "total", obj=np.nansum(table.value, axis=1), filters=filters)
+
+    for name in axes:
+        h5out.create_array(grp, name, obj=getattr(table.binning, name))
+    h5out.create_array(grp, "sensor_ids", obj=table.sensorids)
+
+    for par, val in zip(config["parameter"], config["value"]):
+        grp._v_attrs[par] = val
+
+
+def read_adaptive(filename, group="LT_adaptive"):
+    with tb.open_file(filename, "r") as h5in:
+        grp     = h5in.get_node("/", group)
+        binning = Binning(*[grp._f_get_child(name).read() for name in axes])
+        arrays  = {name : grp._f_get_child(name).read() for name in
+                   ["child", "split", "stride", "leaf", "lower", "upper", "value", "error", "entries"]}
+        return AdaptiveTable(binning, grp.sensor_ids.read(), **arrays)
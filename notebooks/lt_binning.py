@@ -0,0 +1,212 @@
+'''
+Vectorised binning of the sensor response for the light tables.
+
+Does the same as the pandas chain used in the creator scripts
+(isin sensor filter -> groupby sum over time bins -> merge with MC/particles
+-> pd.cut of the initial x, y, z) with integer array operations:
+- bin indices come from the xmin/xbw, zmin/zbw arithmetic
+- the positions are looked up by event_id in an array instead of a merge
+- the time bins are summed with np.bincount over a (sensor, event) index
+
+Usage:
+cells, charge = bin_response(sns_response, parts, nphotons, acc)
+acc.add(cells, charge)
+
+bin_response is sum_response (the filter, time sum and merge) followed by
+bin_pairs, so several tables can be binned from one sum (see lt_multi.py).
+
+For the Step-1 (N, sum, sum2) partials:
+acc.add_sums(bin_partial(partial, acc), partial["N"], partial["sum"], partial["sum2"])
+'''
+
+import numpy  as np
+import pandas as pd
+
+
+def bin_index(values, edges, vmin, bw):
+    '''
+    Index of the bin containing each value, matching
+    pd.cut(values, edges, include_lowest=True): bins are closed on the
+    right and the first bin also includes its left edge.
+    Values outside the edges (or NaN) get -1.
+    '''
+    values = np.asarray(values, dtype=float)
+    nbins  = len(edges) - 1
+
+    with np.errstate(invalid="ignore"):
+        idx = np.ceil((values - vmin) / bw) - 1
+    idx = np.nan_to_num(idx, nan=0, posinf=nbins-1, neginf=0)
+    idx = np.clip(idx, 0, nbins-1).astype(np.int64)
+
+    # Fix the rounding at the bin edges so it agrees with the edge values
+    idx = np.where((values > edges[idx+1]) & (idx < nbins-1), idx+1, idx)
+    idx = np.where((values <= edges[idx])  & (idx > 0),       idx-1, idx)
+
+    inside = (values >= edges[0]) & (values <= edges[-1])
+    return np.where(inside, idx, -1)
+
+
+def bin_xyz(binning, x, y, z):
+    # x, y, z bin indices of a set of positions
+    xbw = binning.xbins[1] - binning.xbins[0]
+    ybw = binning.ybins[1] - binning.ybins[0]
+    zbw = binning.zbins[1] - binning.zbins[0]
+
+    ix = bin_index(x, binning.xbins, binning.xbins[0], xbw)
+    iy = bin_index(y, binning.ybins, binning.ybins[0], ybw)
+    iz = bin_index(z, binning.zbins, binning.zbins[0], zbw)
+    return ix, iy, iz
+
+
+def area_fraction(xbins, ybins, Active_r, nsub=8):
+    '''
+    Fraction of each (x, y) bin inside the active radius, from a grid of
+    nsub x nsub points per bin.
+    '''
+    u  = (np.arange(nsub) + 0.5) / nsub
+    xs = xbins[:-1, None] + np.diff(xbins)[:, None] * u
+    ys = ybins[:-1, None] + np.diff(ybins)[:, None] * u
+
+    r2 = xs[:, None, :, None]**2 + ys[None, :, None, :]**2
+    return (r2 <= Active_r**2).mean(axis=(2, 3))
+
+
+def active_mask(binning, Active_r, min_area=0.):
+    '''
+    (x, y) bins with more than min_area of their area inside the active
+    radius. With min_area=0 only the bins fully outside are dropped.
+    '''
+    if min_area > 0:
+        return area_fraction(binning.xbins, binning.ybins, Active_r) > min_area
+
+    # Point of each bin closest to the axis
+    xn = np.clip(0, binning.xbins[:-1], binning.xbins[1:])
+    yn = np.clip(0, binning.ybins[:-1], binning.ybins[1:])
+    return xn[:, None]**2 + yn[None, :]**2 < Active_r**2
+
+
+def event_lookup(event_ids):
+    '''
+    Array mapping event_id - min(event_id) to the row of that event.
+    Events with more than one row keep the first one.
+    '''
+    event_ids = np.asarray(event_ids, dtype=np.int64)
+    emin      = event_ids.min()
+    lut       = np.full(event_ids.max() - emin + 1, -1, dtype=np.int64)
+
+    rows = np.arange(len(event_ids))
+    lut[event_ids[::-1] - emin] = rows[::-1]
+    return emin, lut
+
+
+def lookup_rows(event_ids, emin, lut):
+    # Row of each event id in the particles table, -1 if it is not there
+    off    = np.asarray(event_ids, dtype=np.int64) - emin
+    inside = (off >= 0) & (off < len(lut))
+    return np.where(inside, lut[np.where(inside, off, 0)], -1)
+
+
+def sum_response(sns_response, parts, sensor_index, nsensors, ntime=None):
+    '''
+    Charge summed over the time bins for each (sensor, event) pair in the
+    file. sensor_index maps the sensor ids to 0..nsensors-1 (-1 for the
+    sensors left out). Returns the sensor index, the event (row of parts)
+    and the charge of each pair.
+
+    With ntime, the time_bin column is also read and a fourth item is
+    returned with the charge weighted sums of the time bin and its square
+    for each pair, and the (pair, time bin, charge) of the time profiles,
+    with the time bins from ntime-1 on summed into the last one.
+    '''
+    if isinstance(sns_response, pd.DataFrame):
+        sns_response = [sns_response]
+
+    # Row of the event in the particles table (the inner merge), the pairs
+    # are indexed by row as an event can have several particle rows
+    emin, lut = event_lookup(parts["event_id"])
+    nevt      = len(parts)
+    npairs    = nsensors * nevt
+
+    qsum   = np.zeros(npairs)
+    filled = np.zeros(npairs, dtype=bool)
+
+    if ntime is not None:
+        qt, qt2  = np.zeros(npairs), np.zeros(npairs)
+        profiles = []
+
+    for chunk in sns_response:
+        charge = np.asarray(chunk["charge"], dtype=float)
+        isns   = sensor_index(np.asarray(chunk["sensor_id"]))
+        ievt   = lookup_rows(chunk["event_id"], emin, lut)
+
+        keep = (isns >= 0) & (ievt >= 0)
+        pair = isns[keep] * nevt + ievt[keep]
+
+        qsum   += np.bincount(pair, weights=charge[keep], minlength=npairs)
+        filled |= np.bincount(pair, minlength=npairs) > 0
+
+        if ntime is not None:
+            t    = np.asarray(chunk["time_bin"], dtype=np.int64)[keep]
+            qt  += np.bincount(pair, weights=charge[keep] * t  , minlength=npairs)
+            qt2 += np.bincount(pair, weights=charge[keep] * t*t, minlength=npairs)
+            profiles.append(sum_keys(pair * ntime + np.clip(t, 0, ntime - 1), charge[keep]))
+
+    pair = np.flatnonzero(filled)
+    if ntime is None:
+        return pair // nevt, pair % nevt, qsum[pair]
+
+    keys, q = sum_keys(*map(np.concatenate, zip(*profiles))) if profiles else (np.zeros(0, np.int64), np.zeros(0))
+    times   = dict(qt=qt[pair], qt2=qt2[pair],
+                   profile=(np.searchsorted(pair, keys // ntime), keys % ntime, q))
+    return pair // nevt, pair % nevt, qsum[pair], times
+
+
+def sum_keys(keys, values):
+    # Sum of the values of each distinct key, sorted by key
+    keys, inv = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inv, weights=values, minlength=len(keys))
+
+
+def bin_pairs(acc, isns, ievt, charge, parts, sum_z=False):
+    '''
+    Flat accumulator cell of each (sensor, event) pair from the initial
+    position of the event. Returns the cells and the charge.
+    '''
+    ix, iy, iz = bin_xyz(acc.binning, parts["initial_x"], parts["initial_y"], parts["initial_z"])
+    ix, iy, iz = ix[ievt], iy[ievt], iz[ievt]
+
+    if sum_z:
+        iz = np.maximum(iz, 0)
+
+    return acc.flat_index(isns, ix, iy, iz), charge
+
+
+def bin_response(sns_response, parts, nphotons, acc, sum_z=False, time=None):
+    '''
+    Flat accumulator cell and normalised charge for each (sensor, event)
+    pair in the file. sns_response needs the event_id, sensor_id and charge
+    columns and parts the event_id, initial_x, initial_y and initial_z.
+    sns_response can also be an iterable of chunks of the table.
+
+    With sum_z the events outside the z range are kept, as the S2 tables
+    sum over z anyway. With a time accumulator (lt_time.TimeAccumulator)
+    the arrival times and time profiles of the pairs are added to it in
+    the same pass, this needs the time_bin column.
+    '''
+    if time is None:
+        isns, ievt, charge = sum_response(sns_response, parts, acc.sensor_index, len(acc.sensorids))
+        return bin_pairs(acc, isns, ievt, charge / nphotons, parts, sum_z)
+
+    isns, ievt, charge, times = sum_response(sns_response, parts, acc.sensor_index, len(acc.sensorids), time.ntime)
+    cells, _ = bin_pairs(acc, isns, ievt, charge, parts, sum_z)
+    time.add_pairs(cells, charge, times)
+    return cells, charge / nphotons
+
+
+def bin_partial(partial, acc):
+    '''
+    Flat accumulator cell of each row of a Step-1 partial table, from its
+    sensor_id and x, y, z bin centres.
+    '''
+    ix, iy, iz = bin_xyz(acc.binning, partial["x"], partial["y"], partial["z"])
+    return acc.cell_index(np.asarray(partial["sensor_id"]), ix, iy, iz)
@@ -0,0 +1,242 @@
+'''
+Persistent state for incremental light table builds.
+
+The state file holds the merged accumulators and a manifest of the input
+files already in them (path, size, mtime, checksum, event id range, number
+of events and photons). A rerun only processes the files not in the
+manifest and the state is saved every few files, so a crashed build
+resumes where it stopped.
+
+Files whose event id range overlaps one already merged (e.g. a batch of
+jobs submitted again with the same seeds) are skipped with a warning and
+recorded in the state with the reason, so reruns do not scan them again.
+Files that changed since they were merged cannot be taken out of the
+accumulators, so they trigger a rebuild from scratch.
+
+Usage:
+state = BuildState.open(state_file, sensorids, binning)
+state.update(filenames, state_file, sum_z=False, nworkers=1)
+lt, err = state.acc.aggregate(signal_type)
+'''
+
+import os
+import sys
+import zlib
+import numpy  as np
+import pandas as pd
+import tables as tb
+
+from lt_accumulator import LTAccumulator, Binning
+from lt_io          import load_config
+from lt_parallel    import build_table
+
+manifest_columns = ["path", "size", "mtime", "checksum", "emin", "emax", "nevents", "nphotons"]
+
+# Files skipped as copies of a merged file (duplicate) or for their event ids (overlap)
+skipped_columns = manifest_columns + ["reason"]
+
+axes = ["xbins", "ybins", "zbins", "xbins_centre", "ybins_centre", "zbins_centre"]
+
+
+def write_accumulator(h5out, where, name, acc, filters=None):
+    '''
+    Write the moments, sensor ids and binning of an accumulator (and its
+    mask, if any) to a new group where/name of an open PyTables file.
+    '''
+    if filters is None:
+        filters = tb.Filters(complevel=5, complib="zlib")
+
+    group = h5out.create_group(where, name, createparents=True)
+    for name in ["N", "mean", "M2", "sensorids"]:
+        h5out.create_carray(group, name, obj=np.asarray(getattr(acc, name)), filters=filters)
+    for name in axes:
+        h5out.create_array(group, name, obj=getattr(acc.binning, name))
+    if acc.mask is not None:
+        h5out.create_array(group, "mask", obj=acc.mask)
+    return group
+
+
+def read_accumulator(group):
+    # Accumulator written by write_accumulator
+    acc      = LTAccumulator(group.sensorids.read(), Binning(*[getattr(group, name).read() for name in axes]))
+    acc.N    = group.N   .read()
+    acc.mean = group.mean.read()
+    acc.M2   = group.M2  .read()
+    if "mask" in group:
+        acc.mask = group.mask.read()
+    return acc
+
+
+def checksum(filename, blocksize=2**24):
+    # Adler-32 of the file contents
+    value = 1
+    with open(filename, "rb") as f:
+        while block := f.read(blocksize):
+            value = zlib.adler32(block, value)
+    return value
+
+
+def scan_file(filename):
+    # Manifest entry of a file
+    stat     = os.stat(filename)
+    event_id = pd.read_hdf(filename, "MC/particles", columns=["event_id"])["event_id"].values
+    nevents, nphotons = load_config(filename)
+
+    return dict(path     = os.path.abspath(filename),
+                size     = stat.st_size,
+                mtime    = stat.st_mtime,
+                checksum = checksum(filename),
+                emin     = int(event_id.min()),
+                emax     = int(event_id.max()),
+                nevents  = nevents,
+                nphotons = nphotons)
+
+
+class BuildState:
+
+    def __init__(self, acc, manifest=None, skipped=None):
+        self.acc      = acc
+        self.manifest = manifest if manifest is not None else pd.DataFrame(columns=manifest_columns)
+        self.skipped  = skipped  if skipped  is not None else pd.DataFrame(columns=skipped_columns)
+
+    @classmethod
+    def open(cls, filename, sensorids, binning):
+        '''
+        Load the state from filename, or start an empty one if it does not exist.
+        A state built with other sensors or another binning is not reused,
+        with None they are taken from the state.
+        '''
+        if not os.path.exists(filename):
+            return cls(LTAccumulator(sensorids, binning))
+
+        with tb.open_file(filename, "r") as h5in:
+            acc = read_accumulator(h5in.root.state)
+
+        if sensorids is not None and not np.array_equal(acc.sensorids, np.asarray(sensorids)):
+            raise ValueError(f"{filename} was built with other sensor ids, use another state file or remove it")
+        if binning is not None:
+            for name in axes:
+                stored, given = getattr(acc.binning, name), np.asarray(getattr(binning, name))
+                if stored.shape != given.shape or not np.allclose(stored, given):
+                    raise ValueError(f"{filename} was built with other {name}, use another state file or remove it")
+
+        # States saved before the skipped files were recorded have none
+        with pd.HDFStore(filename, "r") as store:
+            manifest = store["state/manifest"]
+            skipped  = store["state/skipped"] if "/state/skipped" in store else None
+
+        return cls(acc, manifest, skipped)
+
+    def save(self, filename):
+        '''
+        Write the state to a temporary file and move it in place, so a crash
+        while saving keeps the previous state.
+        '''
+        tmpname = filename + ".tmp"
+
+        with tb.open_file(tmpname, "w") as h5out:
+            write_accumulator(h5out, "/", "state", self.acc)
+
+        self.manifest.to_hdf(tmpname, key="state/manifest", mode="a", format="fixed")
+        self.skipped .to_hdf(tmpname, key="state/skipped" , mode="a", format="fixed")
+        os.replace(tmpname, filename)
+
+    def reset(self):
+        self.acc      = LTAccumulator(self.acc.sensorids, self.acc.binning)
+        self.manifest = pd.DataFrame(columns=manifest_columns)
+        self.skipped  = pd.DataFrame(columns=skipped_columns)
+
+    def pending(self, filenames):
+        '''
+        Files not yet merged and files that changed since they were merged.
+        The checksum is only computed when the size or mtime differ. Skipped
+        files are left out unless they changed, then they are new again.
+        '''
+        merged  = self.manifest.set_index("path")
+        skipped = self.skipped .set_index("path")
+        new     = []
+        changed = []
+
+        for filename in filenames:
+            path = os.path.abspath(filename)
+            if path in skipped.index:
+                entry = skipped.loc[path]
+                stat  = os.stat(filename)
+                if stat.st_size != entry["size"] or (stat.st_mtime != entry["mtime"] and checksum(filename) != entry["checksum"]):
+                    new.append(filename)
+                continue
+
+            if path not in merged.index:
+                new.append(filename)
+                continue
+
+            entry = merged.loc[path]
+            stat  = os.stat(filename)
+            if stat.st_size == entry["size"] and stat.st_mtime == entry["mtime"]:
+                continue
+            if stat.st_size != entry["size"] or checksum(filename) != entry["checksum"]:
+                changed.append(filename)
+
+        return new, changed
+
+    def overlaps(self, emin, emax):
+        # Whether the event id range overlaps a file in the manifest
+        if self.manifest.empty:
+            return False
+        return bool(np.any((self.manifest["emin"].values <= emax) & (self.manifest["emax"].values >= emin)))
+
+    def update(self, filenames, state_file, sum_z=False, nworkers=1, save_every=64, max_memory=200, report=None,
+               prefetch=0, prefetch_memory=1000):
+        '''
+        Merge the new files into the state, saving it every save_every files.
+        Returns the list of files skipped in this run.
+        '''
+        new, changed = self.pending(filenames)
+
+        if changed:
+            print(f"{len(changed)} files changed since they were merged, rebuilding from scratch")
+            self.reset()
+            new = list(filenames)
+
+        print(f"{len(filenames) - len(new)} files already merged or skipped, {len(new)} to process")
+
+        # Skipped files that changed are scanned again
+        self.skipped = self.skipped[~self.skipped["path"].isin([os.path.abspath(f) for f in new])]
+
+        skipped = []
+        for start in range(0, len(new), save_every):
+            batch   = []
+            entries = []
+            dropped = []
+
+            for filename in new[start:start+save_every]:
+                entry = scan_file(filename)
+
+                # Reused seeds give the same events again
+                if self.overlaps(entry["emin"], entry["emax"]) or \
+                   any(e["emin"] <= entry["emax"] and e["emax"] >= entry["emin"] for e in entries):
+                    sys.stderr.write(f"Skipping {filename}: event ids {entry['emin']}-{entry['emax']} already merged\n")
+                    checksums = set(self.manifest["checksum"]) | {e["checksum"] for e in entries}
+                    dropped.append(dict(entry, reason="duplicate" if entry["checksum"] in checksums else "overlap"))
+                    skipped.append(filename)
+                    continue
+
+                batch  .append(filename)
+                entries.append(entry)
+
+            if batch:
+                acc = build_table(batch, self.acc.sensorids, self.acc.binning, sum_z=sum_z,
+                                  nworkers=nworkers, max_memory=max_memory, report=report,
+                                  prefetch=prefetch, prefetch_memory=prefetch_memory)
+                self.acc.merge(acc)
+
+                entries = pd.DataFrame(entries, columns=manifest_columns)
+                self.manifest = entries if self.manifest.empty else pd.concat([self.manifest, entries], ignore_index=True)
+
+            if dropped:
+                dropped = pd.DataFrame(dropped, columns=skipped_columns)
+                self.skipped = dropped if self.skipped.empty else pd.concat([self.skipped, dropped], ignore_index=True)
+
+            self.save(state_file)
+
+        return skipped
@@ -0,0 +1,114 @@
+import os
+import glob
+import argparse
+import numpy  as np
+import pandas as pd
+import tables as tb
+
+from lt_multi  import read_specs, build_tables
+from lt_detdb  import load_table
+from lt_dense  import write_dense
+from lt_report import Report
+
+# Builds all the light tables of a spec file from one read of the compressed nexus files
+#
+# To run:
+# python lt_creator_multi.py specs.json "../files/NEXT100_S1_LT/*.h5" --nworkers 8
+#
+# Each table is written to <outdir>/<DETECTOR>-MC_<name>_LT.h5 in the layout of lt_creator_slim.py
+# (LT/LightTable, LT/Error, LT/Config and LT_dense). See lt_multi.py for the spec file.
+
+EL_GAP = 10.0 # EL gap in mm
+SiPM_Pitch = 15
+
+# Column names of the sensor sets in the tables
+sensor_names = {"pmt" : "PmtR11410", "sipm" : "SiPM"}
+
+
+def sensor_ids(spec):
+    # Sensor ids of a spec from the detector database snapshot, or the ids given in the spec
+    if spec.sensors == "pmt":
+        return load_table(spec.detector, "DataPMT")["SensorID"].values
+    if spec.sensors == "sipm":
+        return load_table(spec.detector, "DataSiPM")["SensorID"].values
+    return np.asarray(spec.sensors)
+
+
+def make_config(spec):
+    sensor = sensor_names.get(spec.sensors, "sensor")
+    config = { "parameter" : ["detector",  "ACTIVE_rad", "EL_GAP"   , "table_type","signal_type"   ,"sensor","pitch_x"       ,"pitch_y", "nexus", "binning"],
+                    "value": [spec.detector, str(spec.Active_r), str(EL_GAP), "energy", spec.signal_type, sensor, str(SiPM_Pitch), str(SiPM_Pitch), "v7_11_00",
+                              " ".join(str(b) for b in spec.bin_params)]}
+    config = pd.DataFrame.from_dict(config)
+
+    # No active radius cut, leave it out rather than write None
+    if spec.Active_r is None:
+        config = config[config["parameter"] != "ACTIVE_rad"].reset_index(drop=True)
+    return config
+
+
+def pivot(df, signal_type, sensor):
+    # Same as lt_creator_slim.py: one column per sensor and the total
+    index = ["x", "y"] if signal_type == "S2" else ["x", "y", "z"]
+
+    df = pd.pivot_table(df, values="charge", columns="sensor_id", index=index)
+    df.columns = [f"{sensor}_{sid}" for sid in df.columns]
+    df = df.reset_index()
+    df[sensor + "_total"] = df.loc[:, df.columns.difference(index)].sum(axis=1)
+    return df
+
+
+parser = argparse.ArgumentParser(description="Build several light tables from one pass over the nexus files")
+parser.add_argument("specs", help="JSON file with the list of tables")
+parser.add_argument("files", help="glob of the compressed nexus files")
+parser.add_argument("--outdir"    , default="../LT")
+parser.add_argument("--nworkers"  , default=1  , type=int, help="number of processes used to read and bin the files")
+parser.add_argument("--max-memory", default=200, type=int, help="MB of MC/sns_response read at once by each process")
+parser.add_argument("--prefetch"  , default=0  , type=int, help="files read ahead in a thread by each process (0 to read in the loop)")
+parser.add_argument("--prefetch-memory", default=1000, type=int, help="MB of read ahead chunks held by each process")
+args = parser.parse_args()
+
+specs     = read_specs(args.specs)
+filenames = sorted(glob.glob(args.files))
+print(f"{len(filenames)} files, {len(specs)} tables: {', '.join(spec.name for spec in specs)}")
+
+sensorids = {spec.name : sensor_ids(spec) for spec in specs}
+
+report = Report("lt_creator_multi", tables=len(specs), nworkers=args.nworkers)
+
+report.begin("build")
+tables = build_tables(filenames, specs, sensorids, nworkers=args.nworkers, max_memory=args.max_memory, report=report,
+                      prefetch=args.prefetch, prefetch_memory=args.prefetch_memory)
+report.end("build", files=len(filenames))
+
+# invisible_cities is only needed to write the tables
+from invisible_cities.io.dst_io import df_writer
+
+os.makedirs(args.outdir, exist_ok=True)
+
+for spec in specs:
+    acc    = tables.accs[spec.name]
+    config = make_config(spec)
+    sensor = sensor_names.get(spec.sensors, "sensor")
+
+    with report.stage("aggregate", table=spec.name) as rec:
+        lt, err = acc.aggregate(spec.signal_type)
+        err['charge'] = 100*err['charge']/lt['charge']
+
+        LT  = pivot(lt , spec.signal_type, sensor)
+        ERR = pivot(err, spec.signal_type, sensor)
+        rec["rows"] = len(LT)
+
+    outfilename = os.path.join(args.outdir, f"{spec.detector.upper()}-MC_{spec.name}_LT.h5")
+
+    report.begin("write")
+    with tb.open_file(outfilename, 'w') as h5out:
+        df_writer(h5out, LT    , "LT", "LightTable")
+        df_writer(h5out, config, "LT", "Config")
+        df_writer(h5out, ERR   , "LT", "Error")
+        write_dense(h5out, acc, spec.signal_type, config)
+    report.end("write", table=spec.name, bytes=os.path.getsize(outfilename))
+
+    print(f"{spec.name}: {len(LT)} rows written to {outfilename}")
+
+report.close()
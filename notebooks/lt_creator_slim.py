@@ -5,11 +5,19 @@ import glob
 import numpy  as np
 import pandas as pd
 import tables as tb
-import matplotlib.pyplot as plt
 
-from invisible_cities.database  import load_db
-from invisible_cities.io.dst_io import load_dst
-from invisible_cities.io.dst_io import df_writer
+from lt_accumulator import make_binning
+from lt_io          import load_file
+from lt_binning     import active_mask
+from lt_parallel    import build_table
+from lt_build_state import BuildState
+from lt_dense       import write_dense
+from lt_sparse      import write_sparse
+from lt_pyramid     import write_pyramid
+from lt_adaptive    import build_adaptive, write_adaptive
+from lt_time        import write_time
+from lt_report      import Report
+from lt_detdb       import load_table
 
 # Takes in the compressed nexus files from simulation
 
@@ -23,6 +31,19 @@ EL_GAP = 10.0 # EL gap in mm
 SiPM_Pitch = 15
 save=True
 save_Err=True
+streaming=True # fold each file into per-voxel accumulators, False for the original concat and groupby of all the events
+save_dense=False # also save the dense (x, y, z, sensor) arrays in LT_dense
+save_sparse=False # also save the filled (sensor, voxel) cells in LT_sparse
+save_adaptive=False # also save adaptive voxels refined where the response changes, in LT_adaptive
+save_time=False # also save the arrival time moments and time profiles in LT_time (not with incremental)
+ntime=200 # time bins kept in the time profiles, the later ones are summed into the last
+save_pyramid=False # also save the accumulators and coarser copies to rebin into other grids (see lt_pyramid.py)
+mask_active=False # drop the (x, y) voxels fully outside Active_r
+nworkers=1 # number of processes used to read and bin the files
+max_memory=200 # MB of MC/sns_response read at once by each process
+prefetch=0 # files read ahead in a thread by each process while the current one is binned (0 to read in the loop)
+prefetch_memory=1000 # MB of read ahead chunks held by each process
+incremental=False # keep the accumulators and a manifest of the merged files in state_file, only process new files
 
 
 # Set the Binning
@@ -49,6 +70,10 @@ config = { "parameter" : ["detector",  "ACTIVE_rad", "EL_GAP"   , "table_type","
 
 config = pd.DataFrame.from_dict(config)
 
+# The original path has no accumulators, so it only writes the pivoted tables
+if not streaming and (incremental or mask_active or save_dense or save_sparse or save_adaptive or save_time or save_pyramid):
+    raise ValueError("streaming=False only writes LT/LightTable, LT/Error and LT/Config, turn the other outputs off")
+
 # Load in the files -- configure the path
 
 if signal_type == "S1":
@@ -61,7 +86,7 @@ lt_filenames = sorted(lt_filenames)
 print(lt_filenames)
 
 # Configure the detector database
-datapmt = load_db.DataPMT(detector_db, 0)
+datapmt = load_table(detector_db, "DataPMT")
 xpmt, ypmt = datapmt["X"].values, datapmt["Y"].values
 sensorids  = datapmt["SensorID"].values
 
@@ -75,65 +100,78 @@ ybins_centre = xbins_centre
 zbins_centre = np.arange(zmin+zbw/2, zmax+zbw/2, zbw)
 
 
-LT_list  = []
-ERR_list = []
+# JSON-lines report of the run, one line per file and per stage (see lt_report.py)
+report = Report("lt_creator", signal_type=signal_type, nworkers=nworkers)
+
+# Fold the files into the running count, mean and M2 of each sensor and voxel.
+# z is summed over for S2, so keep events outside the z range like the groupby does
+binning = make_binning(xmin, xmax, xbw, zmin, zmax, zbw)
 
+report.begin("build")
+if not streaming:
+    LT_list = []
 
-for i, filename in enumerate(lt_filenames, 0):
-    sys.stdout.write(f"Processing file {i}/{len(lt_filenames)} \r")
-    sys.stdout.flush()
+    for i, filename in enumerate(lt_filenames, 0):
+        sys.stdout.write(f"Processing file {i}/{len(lt_filenames)} \r")
+        sys.stdout.flush()
 
-    # Load the MC Particle Tree to ger the intiial x, y, z positions sampled
-    parts = pd.read_hdf(filename, 'MC/particles')
-    parts = parts[['event_id', 'initial_x', 'initial_y', 'initial_z']]
+        parts, nphotons, sns_response = load_file(filename, sensorids, max_memory)
+        pmt_response = pd.concat(list(sns_response), ignore_index=True)
 
-    # Get the metadata from the files
-    configuration = pd.read_hdf(filename, "MC/configuration").set_index("param_key")
-    num_events = int(configuration.loc["num_events"][0])
-    nphotons   = int(configuration.loc["/Generator/ScintGenerator/nphotons"][0])
+        # Sum total charge over all time bins
+        pmt_response = pmt_response.groupby(["sensor_id", "event_id"])["charge"].sum().to_frame().reset_index()
 
-    # Get the sensor response information
-    sns_response  = pd.read_hdf(filename, "MC/sns_response")
-    pmt_response  = sns_response[np.isin(sns_response["sensor_id"].values, datapmt["SensorID"].values)]
+        # Merge the MC Particle and Sensor dataframes to add the x, y, z positions
+        pmt_response = pmt_response.merge(parts, on="event_id", how = 'inner')
 
-    # Sum total charge over all time bins
-    pmt_response = pmt_response.groupby(["sensor_id", "event_id"])["charge"].sum().to_frame().reset_index()
+        # Now bin the x, y, z positions
+        pmt_response['x'] = pd.cut(x=pmt_response['initial_x'], bins=xbins,labels=xbins_centre, include_lowest=True)
+        pmt_response['y'] = pd.cut(x=pmt_response['initial_y'], bins=ybins,labels=ybins_centre, include_lowest=True)
+        pmt_response['z'] = pd.cut(x=pmt_response['initial_z'], bins=zbins,labels=zbins_centre, include_lowest=True)
+        pmt_response = pmt_response.drop(columns=['initial_x', 'initial_y', 'initial_z'])
 
-    # Merge the MC Particle and Sensor dataframes to add the x, y, z positions
-    pmt_response = pmt_response.merge(parts, on="event_id", how = 'inner')
-    
-    # Now bin the x, y, z positions
-    pmt_response['x'] = pd.cut(x=pmt_response['initial_x'], bins=xbins,labels=xbins_centre, include_lowest=True)
-    pmt_response['y'] = pd.cut(x=pmt_response['initial_y'], bins=ybins,labels=ybins_centre, include_lowest=True)
-    pmt_response['z'] = pd.cut(x=pmt_response['initial_z'], bins=zbins,labels=zbins_centre, include_lowest=True)
+        # Normalise the charge in each PMT by the total number of photons simulated
+        pmt_response['charge'] = pmt_response['charge']/nphotons
+        LT_list.append(pmt_response)
 
-    # remove the initial x,y,z since we are done with them
-    pmt_response = pmt_response.drop(columns=['initial_x', 'initial_y', 'initial_z'])
+    # Final concat — only done once
+    LT = pd.concat(LT_list, ignore_index=True)
 
-    # Normalise the charge in each PMT by the total number of photons simulated
-    pmt_response['charge'] = pmt_response['charge']/nphotons
-    
-    # Add the dataframe
-    LT_list.append(pmt_response)
-    ERR_list.append(pmt_response)
+elif incremental:
+    state_file = f"../LT/NEXT100-MC_{signal_type}_LT_state.h5"
+    state = BuildState.open(state_file, sensorids, binning)
+    state.update(lt_filenames, state_file, sum_z=(signal_type == "S2"), nworkers=nworkers, max_memory=max_memory,
+                 report=report, prefetch=prefetch, prefetch_memory=prefetch_memory)
+    acc = state.acc
+else:
+    acc = build_table(lt_filenames, sensorids, binning,
+                      sum_z=(signal_type == "S2"), nworkers=nworkers, max_memory=max_memory, report=report,
+                      ntime=(ntime if save_time else None), prefetch=prefetch, prefetch_memory=prefetch_memory)
+report.end("build", files=len(lt_filenames))
 
-# Final concat — only done once
-LT  = pd.concat(LT_list,  ignore_index=True)
-ERR = pd.concat(ERR_list, ignore_index=True)
+# Fine grid store, before the S2 collapse, so other binnings can be made without the files
+if save_pyramid:
+    write_pyramid(f"../LT/NEXT100-MC_{signal_type}_LT_pyramid.h5", acc)
+
+# Empty the voxels outside the active cylinder so they are left out of the tables
+if mask_active:
+    acc.apply_mask(active_mask(binning, Active_r))
 
 print("Finished loading light-table")
 print("Aggregating light table...")
 
 # LT: Sum the total charge collected in each sensor for a given voxel across all events and also over z in case of S2
 # ERR: std of the total charge collected in each sensor for a given voxel across all events also over z in case of S2
-if signal_type == "S2":
-    lt = LT.groupby(["sensor_id", "x", "y"])["charge"].mean().to_frame().reset_index()
-    err = LT.groupby(["sensor_id", "x", "y"])["charge"].std().to_frame().reset_index() 
-else: 
-    
-    lt = LT.groupby(["sensor_id", "x", "y", "z"])["charge"].mean().to_frame().reset_index()
-    err = LT.groupby(["sensor_id", "x", "y", "z"])["charge"].std().to_frame().reset_index() 
-    # err = LT.groupby(["sensor_id", "x", "y", "z"])["charge"].nunique().to_frame().reset_index()
+with report.stage("aggregate") as rec:
+    if streaming:
+        lt, err = acc.aggregate(signal_type)
+    else:
+        index = ["sensor_id", "x", "y"] if signal_type == "S2" else ["sensor_id", "x", "y", "z"]
+        lt  = LT.groupby(index, observed=True)["charge"].mean().to_frame().reset_index().astype({k : float for k in index[1:]})
+        err = LT.groupby(index, observed=True)["charge"].std ().to_frame().reset_index().astype({k : float for k in index[1:]})
+    rec["rows"] = len(lt)
+
+report.begin("pivot")
 
 # Calculate error values
 err['charge'] = 100*err['charge']/lt['charge']
@@ -155,9 +193,8 @@ LT  = LT.reset_index()
 ERR = ERR.reset_index()
 
 # Rename the sensor columns to PMT number
-for sid in sensorids:
-    LT = LT.rename({sid: pmt + f"_{sid}"}, axis=1)
-    ERR = ERR.rename({sid: pmt + f"_{sid}"}, axis=1)
+LT  = LT .rename(columns={sid: pmt + f"_{sid}" for sid in sensorids})
+ERR = ERR.rename(columns={sid: pmt + f"_{sid}" for sid in sensorids})
 
 # Add column for the total charge in the PMTs
 if signal_type == "S2":
@@ -167,17 +204,36 @@ else:
     LT[pmt + f"_total"] = LT.loc[:, LT.columns.difference(["x", "y", "z"])].sum(axis=1)
     ERR[pmt + f"_total"] = ERR.loc[:, ERR.columns.difference(["x", "y", "z"])].sum(axis=1)
 
+report.end("pivot", rows=len(LT))
+
 # Save the table to an output file
 outfilename = f"../LT/NEXT100-MC_{signal_type}_LT.h5"
 
 if save:
+    # invisible_cities is only needed to write the tables
+    from invisible_cities.io.dst_io import df_writer
+
+    report.begin("write")
     with tb.open_file(outfilename, 'w') as h5out:
         df_writer(h5out, LT, "LT", "LightTable")
-
-if save:
-    with tb.open_file(outfilename, 'r+') as h5out:
         df_writer(h5out, config, "LT", "Config")
 
-if save_Err:
-    with tb.open_file(outfilename, 'r+') as h5out:
-        df_writer(h5out, ERR, "LT", "Error")
+        if save_Err:
+            df_writer(h5out, ERR, "LT", "Error")
+
+        # (x, y, z, sensor) arrays built from the accumulators
+        if save_dense:
+            write_dense(h5out, acc, signal_type, config)
+
+        if save_sparse:
+            write_sparse(h5out, acc, signal_type, config)
+
+        if save_time and acc.time is not None:
+            write_time(h5out, acc, signal_type, config)
+
+        if save_adaptive:
+            write_adaptive(h5out, build_adaptive(acc.collapse_z() if signal_type == "S2" else acc), config)
+
+    report.end("write", bytes=os.path.getsize(outfilename))
+
+report.close()
@@ -0,0 +1,58 @@
+'''
+Dense layout of the light table, written from the accumulators as chunked
+arrays (one z slab per chunk) with the axes, sensor ids and config, in the
+group LT_dense (S2 has one z bin):
+value, error (100*std/mean), entries [x, y, z, sensor]
+total, total_error [x, y, z]  sums over the sensors, as the _total columns
+'''
+
+import numpy  as np
+import tables as tb
+
+axes = ["xbins", "ybins", "zbins", "xbins_centre", "ybins_centre", "zbins_centre"]
+
+
+def dense_tables(acc):
+    '''
+    Value, error and entries arrays shaped (x, y, z, sensor).
+    '''
+    with np.errstate(invalid="ignore", divide="ignore"):
+        value = np.where(acc.N > 0, acc.mean, np.nan)
+        error = 100 * acc.std() / value
+
+    order = (1, 2, 3, 0)
+    return (np.ascontiguousarray(value.transpose(order)),
+            np.ascontiguousarray(error.transpose(order)),
+            np.ascontiguousarray(acc.N    .transpose(order)))
+
+
+def write_dense(h5out, acc, signal_type, config, group="LT_dense", filters=None):
+    '''
+    Write the dense layout of the accumulators to an open PyTables file.
+    config is the (parameter, value) dataframe saved in LT/Config.
+    '''
+    if signal_type == "S2":
+        acc = acc.collapse_z()
+
+    if filters is None:
+        filters = tb.Filters(complevel=5, complib="zlib", shuffle=True)
+
+    value, error, entries = dense_tables(acc)
+    nx, ny, nz, nsensors  = value.shape
+
+    grp = h5out.create_group("/", group, createparents=True)
+
+    for name, arr in [("value", value), ("error", error), ("entries", entries.astype(np.int32))]:
+        h5out.create_carray(grp, name, obj=arr, filters=filters, chunkshape=(nx, ny, 1, nsensors))
+
+    # Sums over the sensors, empty sensors count as zero like the pandas sum
+    h5out.create_carray(grp, "total"      , obj=np.nansum(value, axis=3), filters=filters)
+    h5out.create_carray(grp, "total_error", obj=np.nansum(error, axis=3), filters=filters)
+
+    for name in axes:
+        h5out.create_array(grp, name, obj=getattr(acc.binning, name))
+    h5out.create_array(grp, "sensor_ids", obj=np.asarray(acc.sensorids))
+
+    for par, val in zip(config["parameter"], config["value"]):
+        grp._v_attrs[par] = val
+    grp._v_attrs["dims"] = "x, y, z, sensor"
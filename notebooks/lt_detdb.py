@@ -0,0 +1,122 @@
+'''
+Frozen snapshots of the detector database tables used by the light table
+scripts, so the jobs given a snapshot do not need invisible_cities and its
+sqlite database just to get the sensor ids and positions.
+
+A snapshot of a detector is a directory with the DataPMT and DataSiPM
+tables as csv files and a snapshot.json with the run number, the
+invisible_cities version it was taken with, the date and the sha256 of
+each table. load_table checks the hashes, so an edited or truncated table
+is not used by mistake, and falls back to load_db (with a warning) when
+there is no snapshot.
+
+To make (or refresh) the snapshots, where invisible_cities is installed:
+python lt_detdb.py next100 new
+
+config/detdb is not in the repository until this has been run and the
+directories committed. Until then load_table reads the database, and the
+job scripts set up invisible_cities when no snapshot is shipped with them
+(DETDB in job/condor/lt.sub and lt_merge.sub).
+
+Usage:
+datapmt = load_table("next100", "DataPMT")
+sensorids = datapmt["SensorID"].values
+
+The snapshots are looked for in $LT_DETDB, the working directory (files
+shipped with a grid job) and config/detdb of the repository, in that order.
+'''
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import datetime
+import pandas as pd
+
+tables = ["DataPMT", "DataSiPM"]
+
+repo_detdb = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config", "detdb")
+
+
+def sha256(filename):
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def snapshot_dir(detector, directory=None):
+    '''
+    Directory with the snapshot of detector, None if there is none.
+    '''
+    candidates = [directory, os.environ.get("LT_DETDB"), ".", repo_detdb]
+    for base in candidates:
+        if base is None:
+            continue
+        path = os.path.join(base, detector)
+        if os.path.exists(os.path.join(path, "snapshot.json")):
+            return path
+    return None
+
+
+def make_snapshot(detector, run_number=0, directory=repo_detdb):
+    # Only needed here, so the readers do not import invisible_cities
+    import invisible_cities
+    from invisible_cities.database import load_db
+
+    path = os.path.join(directory, detector)
+    os.makedirs(path, exist_ok=True)
+
+    meta = dict(detector=detector, run_number=run_number,
+                invisible_cities=getattr(invisible_cities, "__version__", "unknown"),
+                created=datetime.date.today().isoformat(), tables={})
+
+    for table in tables:
+        filename = os.path.join(path, f"{table}.csv")
+        getattr(load_db, table)(detector, run_number).to_csv(filename, index=False)
+        meta["tables"][table] = sha256(filename)
+
+    with open(os.path.join(path, "snapshot.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return path
+
+
+def load_table(detector, table, run_number=0, directory=None):
+    '''
+    DataPMT or DataSiPM table of detector from the snapshot, or from
+    load_db if there is no snapshot for this detector and run number.
+    '''
+    path = snapshot_dir(detector, directory)
+
+    if path is not None:
+        with open(os.path.join(path, "snapshot.json")) as f:
+            meta = json.load(f)
+
+        if meta.get("detector") != detector:
+            raise ValueError(f"{path} is a snapshot of {meta.get('detector')}, not {detector}")
+        if table not in meta.get("tables", {}):
+            raise ValueError(f"{path} has no {table} table, make the snapshot again")
+
+        filename = os.path.join(path, f"{table}.csv")
+        if meta["run_number"] == run_number:
+            if not os.path.exists(filename) or sha256(filename) != meta["tables"][table]:
+                raise ValueError(f"{filename} does not match its snapshot.json, make the snapshot again")
+            return pd.read_csv(filename)
+
+    sys.stderr.write(f"No {detector} snapshot for run {run_number}, reading the database\n")
+    try:
+        from invisible_cities.database import load_db
+    except ImportError:
+        raise ImportError(f"No {detector} snapshot for run {run_number} and no invisible_cities to read the database, "
+                          f"make one with python lt_detdb.py {detector}") from None
+    return getattr(load_db, table)(detector, run_number)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snapshot the sensor tables of the detector database")
+    parser.add_argument("detectors", nargs="+", help="e.g. next100 new")
+    parser.add_argument("--run-number", default=0, type=int)
+    parser.add_argument("--directory" , default=repo_detdb)
+    args = parser.parse_args()
+
+    for detector in args.detectors:
+        print(f"{detector}: {make_snapshot(detector, args.run_number, args.directory)}")
@@ -0,0 +1,358 @@
+'''
+Chunked comparison of two light tables, e.g. before and after a nexus or
+geometry change, to gate the production of new tables.
+
+The tables are read one piece at a time and aligned on the bin centres
+and the sensor ids:
+- LT_dense (both files have it): one z slab at a time, the errors are the
+  errors of the bin means, value*error/100/sqrt(entries)
+- LT/LightTable and LT/Error: chunks of rows, joined on (x, y, z) as they
+  stream (the pivoted tables are sorted by x, y, z). The files hold no
+  entries, so the errors are the per-event spreads, value*error/100, and
+  the pulls are smaller than with the errors of the means by sqrt(entries)
+  unless the typical entries per bin are given (--entries)
+
+For each sensor and z slab (one slab for S2) the pulls
+(a - b)/sqrt(sigma_a^2 + sigma_b^2) of the bins filled in both tables give
+chi2/ndf, the largest |pull| and where it is, and the mean relative
+difference. A (sensor, slab) is flagged when its chi2 is more than
+threshold sigmas above ndf (Wilson-Hilferty approximation of the chi2
+distribution). Bins of one table only are counted as missing.
+
+Tables on different grids only share some bin centres; bring them to a
+common grid first (lt_pyramid.py table).
+
+To run:
+python lt_diff.py NEXT100-MC_S1_LT_v7_08_00.h5 NEXT100-MC_S1_LT_v7_11_00.h5 --threshold 5 --output diff_S1.h5
+
+The exit status is 1 if a (sensor, slab) is flagged, so it can gate a job.
+'''
+
+import sys
+import argparse
+import itertools
+import numpy  as np
+import pandas as pd
+import tables as tb
+
+# Rows of LT/LightTable read at once
+chunk_rows = 2**16
+
+# Bin centres are matched to this many decimals (mm)
+decimals = 3
+
+keys = ["x", "y", "z"]
+
+
+class DiffMaps:
+    '''
+    Sums of the pulls of each (slab, sensor), filled a piece at a time.
+    '''
+    def __init__(self, sensor_ids):
+        self.sensor_ids = np.asarray(sensor_ids)
+        self.slabs      = {} # z -> dict of (sensor,) arrays
+
+    def _slab(self, z):
+        if z not in self.slabs:
+            n = len(self.sensor_ids)
+            self.slabs[z] = dict(chi2=np.zeros(n), ndf=np.zeros(n, dtype=np.int64), rel=np.zeros(n),
+                                 missing=np.zeros(n, dtype=np.int64), pull_max=np.zeros(n),
+                                 x_max=np.full(n, np.nan), y_max=np.full(n, np.nan))
+        return self.slabs[z]
+
+    def add(self, x, y, z, va, sa, vb, sb):
+        '''
+        Add the bins at (x, y, z) with values and errors (bin, sensor) of
+        the two tables.
+        '''
+        both    = np.isfinite(va) & np.isfinite(vb)
+        missing = np.isfinite(va) ^ np.isfinite(vb)
+        sigma   = np.sqrt(sa**2 + sb**2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pull = np.where(both & (sigma > 0), (va - vb) / sigma, np.nan)
+            rel  = np.where(both & (vb != 0)  , (va - vb) / vb   , np.nan)
+
+        for zval in np.unique(z):
+            sel  = np.flatnonzero(z == zval)
+            slab = self._slab(zval)
+            p    = pull[sel]
+            used = np.isfinite(p)
+
+            slab["chi2"]    += np.nansum(p**2, axis=0)
+            slab["ndf"]     += used.sum(axis=0)
+            slab["rel"]     += np.nansum(rel[sel], axis=0)
+            slab["missing"] += missing[sel].sum(axis=0)
+
+            a    = np.where(used, np.abs(p), -1)
+            imax = a.argmax(axis=0)
+            amax = a[imax, np.arange(a.shape[1])]
+            new  = amax > slab["pull_max"]
+            slab["pull_max"][new] = amax[new]
+            slab["x_max"]   [new] = x[sel][imax[new]]
+            slab["y_max"]   [new] = y[sel][imax[new]]
+
+    def frame(self):
+        '''
+        One row per (z, sensor) with chi2/ndf, the significance of the
+        chi2, the mean relative difference and the largest |pull|.
+        '''
+        rows = []
+        for z, slab in sorted(self.slabs.items()):
+            df = pd.DataFrame(slab)
+            df.insert(0, "sensor_id", self.sensor_ids)
+            df.insert(0, "z", z)
+            rows.append(df)
+
+        df = pd.concat(rows, ignore_index=True)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            df["rel"]      = df["rel"] / df["ndf"]
+            df["chi2_ndf"] = df["chi2"] / df["ndf"]
+            df["sigma"]    = chi2_sigma(df["chi2"].values, df["ndf"].values)
+        return df
+
+
+def chi2_sigma(chi2, ndf):
+    # Gaussian significance of chi2 above ndf (Wilson-Hilferty)
+    k = np.maximum(ndf, 1)
+    return np.where(ndf > 0, ((chi2 / k)**(1/3) - (1 - 2/(9*k))) / np.sqrt(2/(9*k)), np.nan)
+
+
+def common_index(a, b):
+    # Positions in a and b of the values present in both
+    a = np.round(np.asarray(a, dtype=float), decimals)
+    b = np.round(np.asarray(b, dtype=float), decimals)
+    _, ia, ib = np.intersect1d(a, b, return_indices=True)
+    return ia, ib
+
+
+def dense_pairs(h5a, h5b):
+    '''
+    Sensor ids and, for each z slab, the (x, y, z) of the bins with the
+    values and errors of the means of both tables. The bins of one table
+    only (other x, y or z centres) come with NaN for the other table, so
+    they are counted as missing.
+    '''
+    ga, gb = h5a.root.LT_dense, h5b.root.LT_dense
+    sa, sb = common_index(ga.sensor_ids.read(), gb.sensor_ids.read())
+    xa, xb = common_index(ga.xbins_centre.read(), gb.xbins_centre.read())
+    ya, yb = common_index(ga.ybins_centre.read(), gb.ybins_centre.read())
+    za, zb = common_index(ga.zbins_centre.read(), gb.zbins_centre.read())
+
+    def slab(grp, iz, isns):
+        # (x, y, sensor) values and errors of the means of a z slab
+        value = grp.value  [:, :, iz, :][:, :, isns]
+        error = grp.error  [:, :, iz, :][:, :, isns]
+        N     = grp.entries[:, :, iz, :][:, :, isns]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sigma = np.abs(value * error / 100) / np.sqrt(N)
+        return value, sigma
+
+    def one_sided(grp, iz, isns, sel, first):
+        # Bins of sel in one table only, with NaN for the other
+        x, y  = np.meshgrid(grp.xbins_centre.read(), grp.ybins_centre.read(), indexing="ij")
+        value, sigma = [v[sel] for v in slab(grp, iz, isns)]
+        nan   = np.full_like(value, np.nan)
+        pairs = (value, sigma, nan, nan) if first else (nan, nan, value, sigma)
+        return (x[sel], y[sel], np.full(sel.sum(), grp.zbins_centre.read()[iz])) + pairs
+
+    def outside(grp, ix, iy):
+        # (x, y) bins of grp not in the common grid
+        sel = np.ones((len(grp.xbins_centre), len(grp.ybins_centre)), dtype=bool)
+        sel[np.ix_(ix, iy)] = False
+        return sel
+
+    xc = ga.xbins_centre.read()[xa]
+    yc = ga.ybins_centre.read()[ya]
+    zc = ga.zbins_centre.read()[za]
+    x, y = [v.reshape(-1) for v in np.meshgrid(xc, yc, indexing="ij")]
+    out_a, out_b = outside(ga, xa, ya), outside(gb, xb, yb)
+
+    yield ga.sensor_ids.read()[sa]
+    for k in range(len(za)):
+        va, ea = [v[np.ix_(xa, ya)].reshape(-1, len(sa)) for v in slab(ga, za[k], sa)]
+        vb, eb = [v[np.ix_(xb, yb)].reshape(-1, len(sb)) for v in slab(gb, zb[k], sb)]
+        yield x, y, np.full(len(x), zc[k]), va, ea, vb, eb
+
+        if out_a.any():
+            yield one_sided(ga, za[k], sa, out_a, True)
+        if out_b.any():
+            yield one_sided(gb, zb[k], sb, out_b, False)
+
+    # z slabs of one table only
+    for grp, zs, isns, first in [(ga, za, sa, True), (gb, zb, sb, False)]:
+        all_bins = np.ones((len(grp.xbins_centre), len(grp.ybins_centre)), dtype=bool)
+        for iz in np.setdiff1d(np.arange(len(grp.zbins_centre)), zs):
+            yield one_sided(grp, iz, isns, all_bins, first)
+
+
+def table_reader(h5, where):
+    '''
+    Number of rows and a reader of row ranges of a table written by
+    df_writer (PyTables) or by pandas.
+    '''
+    node = h5.get_node(where)
+    if isinstance(node, tb.Table):
+        return node.nrows, lambda start, stop: pd.DataFrame(node.read(start, stop))
+
+    with pd.HDFStore(h5.filename, "r") as store:
+        storer = store.get_storer(where)
+        if storer.is_table:
+            return storer.nrows, lambda start, stop: pd.read_hdf(h5.filename, where, start=start, stop=stop)
+
+        # Fixed format tables can only be read in one go
+        df = store.select(where)
+        return len(df), lambda start, stop: df.iloc[start:stop]
+
+
+def row_chunks(h5, where, chunksize):
+    n, read = table_reader(h5, where)
+    for start in range(0, n, chunksize):
+        df = read(start, min(start + chunksize, n))
+        if "z" not in df:
+            df["z"] = 0.
+        df[keys] = df[keys].astype(float).round(decimals)
+        yield df
+
+
+def up_to(df, last):
+    # Rows of a frame sorted by x, y, z with key <= last
+    x, y, z = (df[k].values for k in keys)
+    lx, ly, lz = last
+    return (x < lx) | ((x == lx) & ((y < ly) | ((y == ly) & (z <= lz))))
+
+
+def sorted_join(left, right, suffixes, how="inner"):
+    '''
+    Join (inner or outer) of two streams of frames sorted by x, y, z, chunk
+    by chunk. Only the rows of right up to the last key of the current left
+    chunk are kept in memory.
+    '''
+    right   = iter(right)
+    buffer  = None
+    done    = False
+    columns = None
+
+    for chunk in left:
+        last    = tuple(chunk[keys].iloc[-1])
+        columns = chunk.columns
+
+        # Read right until it goes past the last key of the chunk
+        while not done and (buffer is None or buffer.empty or up_to(buffer.iloc[-1:], last)[0]):
+            nxt = next(right, None)
+            if nxt is None:
+                done = True
+            else:
+                buffer = nxt if buffer is None else pd.concat([buffer, nxt], ignore_index=True)
+
+        if buffer is None:
+            return
+
+        take   = up_to(buffer, last)
+        yield chunk.merge(buffer[take], on=keys, how=how, suffixes=suffixes)
+        buffer = buffer[~take]
+
+    if how != "outer" or buffer is None or columns is None:
+        return
+
+    # Rows of right past the end of left
+    empty = pd.DataFrame({c : pd.Series(dtype=float) for c in columns})
+    for rest in itertools.chain([buffer], right):
+        if len(rest):
+            yield empty.merge(rest, on=keys, how="outer", suffixes=suffixes)
+
+
+def sensor_columns(df):
+    # Sensor id of each column of a pivoted table, the _total column is left out
+    columns = [c for c in df.columns if c not in keys and not c.endswith("_total") and c[-1].isdigit()]
+    return {int(c.split("_")[-1]) : c for c in columns}
+
+
+def frame_pairs(h5a, h5b, chunksize=chunk_rows, entries=None):
+    '''
+    As dense_pairs from LT/LightTable and LT/Error, one chunk of rows at a
+    time. The errors are the per-event spreads, over sqrt(entries) if given.
+    '''
+    def table(h5):
+        return sorted_join(row_chunks(h5, "/LT/LightTable", chunksize),
+                           row_chunks(h5, "/LT/Error"     , chunksize), ("", "_err"))
+
+    cols_a = sensor_columns(table_reader(h5a, "/LT/LightTable")[1](0, 1))
+    cols_b = sensor_columns(table_reader(h5b, "/LT/LightTable")[1](0, 1))
+    sensors = np.array(sorted(set(cols_a) & set(cols_b)))
+    yield sensors
+
+    # Outer join, so the bins of one table only are counted as missing
+    for df in sorted_join(table(h5a), table(h5b), ("_a", "_b"), how="outer"):
+        if df.empty:
+            continue
+
+        def arrays(cols, suffix):
+            value = df[[cols[s] + suffix for s in sensors]].values.astype(float)
+            error = df[[cols[s] + "_err" + suffix for s in sensors]].values.astype(float)
+            return value, np.abs(value * error / 100) / np.sqrt(entries or 1)
+
+        va, ea = arrays(cols_a, "_a")
+        vb, eb = arrays(cols_b, "_b")
+        yield df["x"].values, df["y"].values, df["z"].values, va, ea, vb, eb
+
+
+def compare(file_a, file_b, frames=False, chunksize=chunk_rows, entries=None):
+    '''
+    DiffMaps of two table files, from LT_dense if both have it (unless
+    frames) or from LT/LightTable and LT/Error (see frame_pairs).
+    '''
+    with tb.open_file(file_a, "r") as h5a, tb.open_file(file_b, "r") as h5b:
+        dense  = not frames and "/LT_dense" in h5a and "/LT_dense" in h5b
+        pieces = dense_pairs(h5a, h5b) if dense else frame_pairs(h5a, h5b, chunksize, entries)
+
+        maps = DiffMaps(next(pieces))
+        for piece in pieces:
+            maps.add(*piece)
+
+    return maps, ("dense" if dense else "frames")
+
+
+def write_diff(filename, df, flagged):
+    with pd.HDFStore(filename, "w") as store:
+        store.put("diff/slabs"  , df)
+        store.put("diff/flagged", flagged)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two light tables slab by slab")
+    parser.add_argument("table_a")
+    parser.add_argument("table_b")
+    parser.add_argument("--threshold", default=5., type=float, help="chi2 significance (sigmas) flagging a (sensor, slab)")
+    parser.add_argument("--frames"   , action="store_true", help="compare LT/LightTable and LT/Error even with LT_dense")
+    parser.add_argument("--chunk"    , default=chunk_rows, type=int, help="rows read at once from LT/LightTable")
+    parser.add_argument("--entries"  , default=None, type=float, help="events per bin, for the errors of tables without LT_dense")
+    parser.add_argument("--output"   , help="write the per (sensor, slab) results and the flagged ones here")
+    args = parser.parse_args()
+
+    maps, source = compare(args.table_a, args.table_b, args.frames, args.chunk, args.entries)
+    df = maps.frame()
+
+    ndf = df["ndf"].sum()
+    print(f"Compared {ndf} (bin, sensor) pairs of {len(maps.sensor_ids)} sensors in {len(maps.slabs)} slabs from {source}, "
+          f"{df['missing'].sum()} in one table only")
+    if source == "frames" and not args.entries:
+        print("No entries in the files: the errors are the per-event spreads, the pulls are smaller by sqrt(entries)")
+    print(f"chi2/ndf {df['chi2'].sum()/max(ndf, 1):.3g}, mean relative difference {np.nansum(df['rel']*df['ndf'])/max(ndf, 1):+.3g}")
+
+    per_sensor = df.groupby("sensor_id")[["chi2", "ndf"]].sum()
+    per_sensor["chi2_ndf"] = per_sensor["chi2"] / per_sensor["ndf"]
+    worst = per_sensor["chi2_ndf"].sort_values(ascending=False).head(5)
+    print("Largest chi2/ndf: " + ", ".join(f"sensor {s} {v:.3g}" for s, v in worst.items()))
+
+    flagged = df[df["sigma"] > args.threshold].sort_values("sigma", ascending=False)
+    columns = ["z", "sensor_id", "ndf", "chi2_ndf", "sigma", "rel", "pull_max", "x_max", "y_max"]
+    if len(flagged):
+        print(f"{len(flagged)} (sensor, slab) above {args.threshold} sigma:")
+        print(flagged[columns].head(50).to_string(index=False, float_format=lambda v: f"{v:.4g}"))
+    else:
+        print(f"No (sensor, slab) above {args.threshold} sigma")
+
+    if args.output:
+        write_diff(args.output, df, flagged)
+
+    sys.exit(1 if len(flagged) else 0)
@@ -0,0 +1,93 @@
+'''
+Readers for the nexus files used to build the light tables.
+
+MC/sns_response is streamed in bounded size chunks with only the
+event_id, sensor_id and charge columns, and the other sensors are dropped
+from each chunk after reading. Selecting the sensors on disk with a
+PyTables where condition is slower: the condition is evaluated row by row
+over the whole table, about 3 times slower for the PMTs and no faster for
+a single SiPM board on the lt_synthetic.py files.
+'''
+
+import numpy  as np
+import pandas as pd
+
+sns_columns = ["event_id", "sensor_id", "charge"]
+
+# Memory used by a chunk in pandas relative to its size on disk
+chunk_overhead = 3
+
+
+def load_config(filename):
+    # Number of events and photons simulated per event in the file
+    configuration = pd.read_hdf(filename, "MC/configuration").set_index("param_key")
+    num_events = int(configuration.loc["num_events"].iloc[0])
+    nphotons   = int(configuration.loc["/Generator/ScintGenerator/nphotons"].iloc[0])
+    return num_events, nphotons
+
+
+def partial_binning(filename):
+    '''
+    Binning (xmin, xmax, xbw, zmin, zmax, zbw) stored in the LT/Config of
+    a Step-1 partial, None for partials written without it.
+    '''
+    config = pd.read_hdf(filename, "LT/Config").set_index("parameter")["value"]
+    if "binning" not in config.index:
+        return None
+    return [float(v) for v in config["binning"].split()]
+
+
+def chunk_size(storer, max_memory):
+    '''
+    Number of rows of a table (or fixed format frame) that fit in
+    max_memory (in MB).
+    '''
+    if storer.is_table:
+        rowsize = storer.table.rowsize
+    else:
+        blocks  = [getattr(storer.group, f"block{i}_values") for i in range(storer.nblocks)]
+        rowsize = sum(block.shape[1] * block.dtype.itemsize for block in blocks)
+    return max(1, int(max_memory * 1024**2 / (rowsize * chunk_overhead)))
+
+
+def read_sns_response(filename, sensorids=None, max_memory=200, columns=sns_columns):
+    '''
+    Generator over chunks of MC/sns_response restricted to sensorids.
+    max_memory (in MB) sets the chunk size.
+    '''
+    with pd.HDFStore(filename, "r") as store:
+        storer    = store.get_storer("MC/sns_response")
+        chunksize = chunk_size(storer, max_memory)
+
+        # Fixed format frames have no column selection or iterator, but can be read by row ranges
+        if not storer.is_table:
+            chunks = (store.select("MC/sns_response", start=start, stop=start + chunksize)[list(columns)]
+                      for start in range(0, int(storer.shape[0]), chunksize))
+
+        # The iterator has a fixed cost, only use it for tables larger than a chunk
+        elif storer.nrows <= chunksize:
+            chunks = [store.select("MC/sns_response", columns=list(columns))]
+        else:
+            chunks = store.select("MC/sns_response", columns=list(columns),
+                                  chunksize=chunksize, iterator=True)
+
+        for chunk in chunks:
+            if sensorids is not None:
+                chunk = chunk[np.isin(chunk["sensor_id"].values, sensorids)]
+            yield chunk
+
+
+def load_file(filename, sensorids=None, max_memory=200, columns=sns_columns):
+    '''
+    The MC particles (event_id and initial x, y, z), the number of photons
+    simulated per event and the chunks of the sensor response of a nexus
+    file. The response is read lazily, restricted to sensorids.
+    '''
+    parts = pd.read_hdf(filename, 'MC/particles')
+    parts = parts[['event_id', 'initial_x', 'initial_y', 'initial_z']]
+
+    _, nphotons = load_config(filename)
+
+    sns_response = read_sns_response(filename, sensorids, max_memory, columns)
+
+    return parts, nphotons, sns_response
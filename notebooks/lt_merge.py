@@ -0,0 +1,155 @@
+'''
+One node of the reduction tree of the light table partials
+(lt_reduce_tree.py): merges its inputs into one accumulator and writes it
+for the next level, or, at the root, writes the final table.
+
+The inputs can be Step-1 partials ((sensor_id, x, y, z, N, sum, sum2) in
+LT/LightTable, from lt_creator_S1S2_1.py or lt_partial.py) or the merged
+accumulators written by other nodes (group /merge). The sensors come from
+the detector database (lt_detdb.py) and the binning from the inputs (the
+LT/Config of the partials), --binning is checked against it.
+
+To run:
+python lt_merge.py merged_0.h5 partial_0.h5 partial_1.h5 ...
+python lt_merge.py NEXT100-MC_S2_LT.h5 merged_*.h5 --final --signal-type S2
+
+The root writes the LT/LightTable, LT/Error and LT/Config of
+lt_creator_S1S2_2.py (std with ddof=0) and the LT_dense arrays.
+'''
+
+import sys
+import argparse
+import pandas as pd
+import tables as tb
+
+from lt_accumulator import LTAccumulator, make_binning
+from lt_binning     import bin_partial
+from lt_build_state import write_accumulator, read_accumulator
+from lt_dense       import write_dense
+from lt_detdb       import load_table
+from lt_io          import partial_binning
+
+pmt = "PmtR11410"
+
+
+def merge_inputs(filenames, sensorids, binning):
+    '''
+    Accumulator of a set of partial and merged files.
+    '''
+    acc = LTAccumulator(sensorids, binning)
+
+    for filename in filenames:
+        with tb.open_file(filename, "r") as h5in:
+            merged = "/merge" in h5in
+
+            if merged:
+                acc.merge(read_accumulator(h5in.root.merge))
+
+        if not merged:
+            lt = pd.read_hdf(filename, "LT/LightTable", columns=['sensor_id', 'x', 'y', 'z', 'N', 'sum', 'sum2'])
+            acc.add_sums(bin_partial(lt, acc), lt["N"].values, lt["sum"].values, lt["sum2"].values)
+
+    return acc
+
+
+def input_binning(filename):
+    # Binning parameters of a partial or merged file, None if not stored
+    with tb.open_file(filename, "r") as h5in:
+        if "/merge" in h5in:
+            attrs = h5in.root.merge._v_attrs
+            return [float(b) for b in attrs.binning] if "binning" in attrs else None
+    return partial_binning(filename)
+
+
+def resolve_binning(filenames, binning=None):
+    '''
+    Binning parameters of the inputs, which must agree with each other and
+    with binning if given. Inputs without it are taken to have it.
+    '''
+    for filename in filenames:
+        stored = input_binning(filename)
+        if stored is None:
+            continue
+        if binning is None:
+            binning = stored
+        elif list(map(float, binning)) != stored:
+            raise ValueError(f"{filename} was binned with {stored}, not {list(binning)}")
+
+    if binning is None:
+        raise ValueError("The inputs do not store their binning, give --binning")
+    return [float(b) for b in binning]
+
+
+def write_merged(filename, acc, binning):
+    with tb.open_file(filename, "w") as h5out:
+        group = write_accumulator(h5out, "/", "merge", acc)
+        group._v_attrs.binning = list(binning)
+
+
+def write_final(filename, acc, signal_type, config):
+    '''
+    Final table in the layout of lt_creator_S1S2_2.py.
+    '''
+    # invisible_cities is only needed to write the tables
+    from invisible_cities.io.dst_io import df_writer
+
+    index = ["x", "y"] if signal_type == "S2" else ["x", "y", "z"]
+
+    lt, err = acc.aggregate(signal_type, ddof=0)
+    err["charge"] = (100*err["charge"]/lt["charge"]).fillna(0)
+    lt ["charge"] = lt["charge"].fillna(0)
+
+    tables = []
+    for df in [lt, err]:
+        df = pd.pivot_table(df, values="charge", columns="sensor_id", index=index)
+        df.columns = [f"{pmt}_{sid}" for sid in df.columns]
+        df = df.reset_index()
+        df[pmt + "_total"] = df.loc[:, df.columns.difference(index)].sum(axis=1)
+        tables.append(df)
+
+    with tb.open_file(filename, "w") as h5out:
+        df_writer(h5out, tables[0], "LT", "LightTable")
+        df_writer(h5out, config   , "LT", "Config")
+        df_writer(h5out, tables[1], "LT", "Error")
+        write_dense(h5out, acc, signal_type, config)
+
+
+def merge_node(output, inputs, binning=None, detector="next100", final=False, signal_type="S1"):
+    '''
+    Run one node of the tree: merge inputs into output. The binning is
+    taken from the inputs if None.
+    '''
+    binning   = resolve_binning(inputs, binning)
+    sensorids = load_table(detector, "DataPMT")["SensorID"].values
+    acc       = merge_inputs(inputs, sensorids, make_binning(*binning))
+
+    if final:
+        config = pd.DataFrame({"parameter" : ["detector", "signal_type", "sensor", "binning"],
+                               "value"     : [detector, signal_type, pmt, " ".join(map(str, binning))]})
+        write_final(output, acc, signal_type, config)
+    else:
+        write_merged(output, acc, binning)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge light table partials into one accumulator or the final table")
+    parser.add_argument("output")
+    parser.add_argument("inputs", nargs="*")
+    parser.add_argument("--inputs-from", help="file with one input per line")
+    parser.add_argument("--binning"    , type=float, nargs=6, metavar=("XMIN", "XMAX", "XBW", "ZMIN", "ZMAX", "ZBW"),
+                        help="Step-1 binning, by default the one stored in the inputs")
+    parser.add_argument("--detector"   , default="next100")
+    parser.add_argument("--final"      , action="store_true", help="write the final table instead of the accumulator")
+    parser.add_argument("--signal-type", default="S1", choices=["S1", "S2"])
+    args = parser.parse_args()
+
+    inputs = list(args.inputs)
+    if args.inputs_from:
+        with open(args.inputs_from) as f:
+            inputs += [line.strip() for line in f if line.strip()]
+
+    if not inputs:
+        sys.exit("No inputs to merge")
+
+    merge_node(args.output, inputs, args.binning, args.detector, args.final, args.signal_type)
+    print(f"Merged {len(inputs)} files into {args.output}")
@@ -0,0 +1,118 @@
+'''
+Several light tables (signal types, binnings, sensor sets) built from one
+read of the input files, each the same as built on its own with
+lt_parallel.build_table. The tables are given as a JSON list of specs,
+binning is (xmin, xmax, xbw, zmin, zmax, zbw) and sensors "pmt", "sipm" or
+a list of ids:
+[{"name" : "S1_20mm", "signal_type" : "S1", "binning" : [-500, 500, 20, 0, 1200, 20]},
+ {"name" : "S2_SiPM", "signal_type" : "S2", "binning" : [-500, 500, 20, -12, 2, 1], "sensors" : "sipm"}]
+
+Usage:
+tables  = build_tables(filenames, read_specs("specs.json"), sensorids, nworkers=8)
+lt, err = tables.accs["S1_20mm"].aggregate("S1")
+'''
+
+import json
+import numpy  as np
+
+from lt_accumulator import LTAccumulator, make_binning
+from lt_binning     import active_mask, sum_response, bin_pairs
+from lt_parallel    import ShardCollector, read_files, run_shards, shard
+
+
+class TableSpec:
+    '''
+    One table to build: signal type, binning, sensors and detector.
+    '''
+    def __init__(self, name, signal_type, binning, sensors="pmt", detector="next100", Active_r=None):
+        self.name        = name
+        self.signal_type = signal_type
+        self.bin_params  = list(binning)
+        self.binning     = make_binning(*binning)
+        self.sensors     = sensors
+        self.detector    = detector
+        self.Active_r    = Active_r
+
+    @property
+    def sum_z(self):
+        # z is summed over for S2, so the events outside the z range are kept
+        return self.signal_type == "S2"
+
+
+def read_specs(filename):
+    with open(filename) as f:
+        specs = [TableSpec(**spec) for spec in json.load(f)]
+
+    names = [spec.name for spec in specs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicated table names in {filename}: {names}")
+    return specs
+
+
+class MultiAccumulator:
+    '''
+    The accumulators of a set of specs, filled from the same reads.
+    sensorids maps the name of each spec to its sensor ids.
+    '''
+    def __init__(self, specs, sensorids):
+        self.specs = {spec.name : spec for spec in specs}
+        self.accs  = {}
+        for spec in specs:
+            mask = active_mask(spec.binning, spec.Active_r) if spec.Active_r is not None else None
+            self.accs[spec.name] = LTAccumulator(sensorids[spec.name], spec.binning, mask)
+
+        # Union of the sensors of all the tables, read once
+        self.sensorids = np.unique(np.concatenate([acc.sensorids for acc in self.accs.values()]))
+
+    def sensor_index(self, sensor_id):
+        # Position in the union of the sensors, -1 for the others
+        sensor_id = np.asarray(sensor_id)
+        pos   = np.clip(np.searchsorted(self.sensorids, sensor_id), 0, len(self.sensorids) - 1)
+        return np.where(self.sensorids[pos] == sensor_id, pos, -1)
+
+    def add_file(self, sns_response, parts, nphotons):
+        isns, ievt, charge = sum_response(sns_response, parts, self.sensor_index, len(self.sensorids))
+        charge    = charge / nphotons
+        sensor_id = self.sensorids[isns]
+
+        for name, acc in self.accs.items():
+            cells, q = bin_pairs(acc, acc.sensor_index(sensor_id), ievt, charge, parts, self.specs[name].sum_z)
+            acc.add(cells, q)
+
+    def merge(self, other):
+        for name, acc in self.accs.items():
+            acc.merge(other.accs[name])
+        return self
+
+
+def fold_tables(filenames, specs, sensorids, max_memory=200, prefetch=0, prefetch_memory=1000, stats=None):
+    '''
+    Fold a list of files into the accumulators of all the specs. Returns
+    the accumulators and the number of events read, the other arguments
+    are those of lt_parallel.read_files.
+    '''
+    tables  = MultiAccumulator(specs, sensorids)
+    nevents = 0
+
+    for parts, nphotons, sns_response in read_files(filenames, tables.sensorids, max_memory, prefetch=prefetch,
+                                                    prefetch_memory=prefetch_memory, stats=stats):
+        tables.add_file(sns_response, parts, nphotons)
+        nevents += parts.event_id.nunique()
+
+    return tables, nevents
+
+
+def build_tables(filenames, specs, sensorids, nworkers=1, files_per_shard=16, max_memory=200, report=None,
+                 prefetch=0, prefetch_memory=1000):
+    '''
+    Accumulators of all the specs from one pass over the files, built with
+    nworkers processes. The shards and the reduction are the same as
+    lt_parallel.build_table.
+    '''
+    tasks     = [(files, specs, sensorids, max_memory, prefetch, prefetch_memory)
+                 for files in shard(filenames, files_per_shard)]
+    collector = ShardCollector(len(filenames), report)
+    run_shards(fold_tables, tasks, nworkers, collector)
+
+    tables = collector.result()
+    return tables if tables is not None else MultiAccumulator(specs, sensorids)
@@ -0,0 +1,228 @@
+'''
+Map-reduce build of the light table accumulators: the files are split in
+fixed size shards folded on a pool of workers and merged with a binary
+tree in shard order, so any nworkers gives the same table bit for bit.
+
+Usage:
+acc = build_table(filenames, sensorids, binning, sum_z=False, nworkers=64)
+'''
+
+import os
+import sys
+import time
+import functools
+import contextlib
+import multiprocessing as mp
+
+from lt_accumulator import LTAccumulator
+from lt_binning     import bin_response
+from lt_io          import load_file, sns_columns
+from lt_time        import TimeAccumulator
+from lt_prefetch    import Prefetcher
+from lt_report      import peak_rss
+
+
+def count_rows(chunks, stat):
+    # Pass the chunks through, adding up their rows in stat
+    for chunk in chunks:
+        stat["rows"] += len(chunk)
+        yield chunk
+
+
+def read_files(filenames, sensorids=None, max_memory=200, columns=sns_columns, prefetch=0, prefetch_memory=1000,
+               stats=None):
+    '''
+    Generator over the files as (parts, nphotons, sns_response). max_memory
+    (in MB) caps the chunks of MC/sns_response read at once. With prefetch,
+    up to that many files (and about prefetch_memory MB) are read ahead in
+    a thread (lt_prefetch.py). If stats is a list, a dict with the file,
+    bytes, events, rows (of sns_response), wall and cpu time and peak RSS
+    of the process is appended for each file once it has been processed.
+    With prefetch it also has the io_wait and read times of
+    Prefetcher.get and the CPU time of the binning (busy).
+    '''
+    with (Prefetcher(filenames, sensorids, max_memory, columns, prefetch, prefetch_memory)
+          if prefetch else contextlib.nullcontext()) as prefetcher:
+
+        for filename in filenames:
+            stat = dict(file=filename, bytes=os.path.getsize(filename), rows=0)
+            wall = time.perf_counter()
+            cpu  = time.process_time()
+            busy = time.thread_time()
+
+            if prefetcher is not None:
+                (parts, nphotons, sns_response), times = prefetcher.get()
+            else:
+                parts, nphotons, sns_response = load_file(filename, sensorids, max_memory, columns)
+
+            yield parts, nphotons, count_rows(sns_response, stat)
+
+            if stats is not None:
+                stat.update(events=parts.event_id.nunique(), wall=time.perf_counter() - wall, cpu=time.process_time() - cpu,
+                            peak_rss=peak_rss())
+                if prefetcher is not None:
+                    # The binning runs in this thread, the reading in the prefetch thread
+                    stat.update(times, busy=time.thread_time() - busy)
+                stats.append(stat)
+
+
+def fold_shard(filenames, sensorids, binning, sum_z, max_memory=200, ntime=None, prefetch=0, prefetch_memory=1000,
+               stats=None):
+    '''
+    Fold a list of files into one accumulator. Returns the accumulator
+    and the number of events read. With ntime the time tables (lt_time.py)
+    are accumulated in acc.time. The other arguments are those of
+    read_files.
+    '''
+    acc     = LTAccumulator(sensorids, binning)
+    nevents = 0
+    columns = sns_columns
+
+    if ntime is not None:
+        acc.time = TimeAccumulator(sensorids, binning, ntime)
+        columns  = sns_columns + ["time_bin"]
+
+    for parts, nphotons, sns_response in read_files(filenames, sensorids, max_memory, columns, prefetch,
+                                                    prefetch_memory, stats):
+        cells, charge = bin_response(sns_response, parts, nphotons, acc, sum_z=sum_z, time=acc.time)
+        acc.add(cells, charge)
+        nevents += parts.event_id.nunique()
+
+    return acc, nevents
+
+
+def run_fold(fold, args):
+    # Pool entry point: fold a shard of files (args[0]) keeping the stats of its files
+    stats = []
+    acc, nevents = fold(*args, stats=stats)
+    return acc, len(args[0]), nevents, stats
+
+
+def run_shards(fold, tasks, nworkers, on_done):
+    '''
+    Call fold(*task, stats=[]) for each task, on a pool of nworkers
+    processes if nworkers > 1, and pass (acc, nfiles, nevents, stats) to
+    on_done in task order.
+    '''
+    entry = functools.partial(run_fold, fold)
+
+    if nworkers > 1:
+        # fork so the workers do not re-run the creator script on startup
+        with mp.get_context("fork").Pool(nworkers) as pool:
+            for result in pool.imap(entry, tasks):
+                on_done(*result)
+    else:
+        for task in tasks:
+            on_done(*entry(task))
+
+
+class TreeReducer:
+    '''
+    Pairwise (binary tree) reduction of accumulators pushed in order.
+    Only one accumulator per tree level is kept in memory.
+    '''
+    def __init__(self):
+        self.stack = [] # (level, accumulator)
+
+    def push(self, acc):
+        level = 0
+        while self.stack and self.stack[-1][0] == level:
+            _, left = self.stack.pop()
+            acc    = left.merge(acc)
+            level += 1
+        self.stack.append((level, acc))
+
+    def result(self):
+        acc = None
+        while self.stack:
+            _, left = self.stack.pop()
+            acc = left if acc is None else left.merge(acc)
+        return acc
+
+
+class Progress:
+    '''
+    Single line progress report with the file and event rates.
+    '''
+    def __init__(self, nfiles, stream=sys.stdout):
+        self.nfiles  = nfiles
+        self.stream  = stream
+        self.files   = 0
+        self.events  = 0
+        self.start   = time.perf_counter()
+
+    def update(self, nfiles, nevents):
+        self.files  += nfiles
+        self.events += nevents
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+
+        self.stream.write(f"Processed {self.files}/{self.nfiles} files, "
+                          f"{self.files/elapsed:.2f} files/s, {self.events/elapsed:.1f} events/s \r")
+        self.stream.flush()
+
+    def close(self):
+        self.stream.write("\n")
+        self.stream.flush()
+
+
+class ShardCollector:
+    '''
+    on_done of run_shards: merges the shard accumulators with a
+    TreeReducer, shows the progress and emits a "file" line per file to
+    the report (lt_report.Report), if any.
+    '''
+    def __init__(self, nfiles, report=None):
+        self.reducer  = TreeReducer()
+        self.progress = Progress(nfiles)
+        self.report   = report
+        self.totals   = dict(wall=0., busy=0., read=0., io_wait=0.) # of the prefetched files
+
+    def __call__(self, acc, nfiles, nevents, stats):
+        self.reducer.push(acc)
+        self.progress.update(nfiles, nevents)
+
+        for stat in stats:
+            prefetched = {key : stat[key] for key in self.totals if "read" in stat}
+            for key, value in prefetched.items():
+                self.totals[key] += value
+            if self.report is not None:
+                self.report.add(bytes=stat["bytes"], events=stat["events"], rows=stat["rows"],
+                                **{key : value for key, value in prefetched.items() if key != "wall"})
+                self.report.emit("file", **stat)
+
+    def result(self, stream=sys.stdout):
+        # The merged accumulator, None if there were no files
+        self.progress.close()
+        if self.totals["wall"] > 0:
+            # Reading then binning each file would take busy + read
+            serial = self.totals["busy"] + self.totals["read"]
+            saved  = serial - self.totals["wall"]
+            stream.write(f"Prefetch: {self.totals['wall']:.1f} s, {serial:.1f} s estimated without "
+                         f"(binning {self.totals['busy']:.1f} s, reading {self.totals['read']:.1f} s), "
+                         f"{saved:.1f} s ({100*saved/serial:.0f}%) saved, waited {self.totals['io_wait']:.1f} s\n")
+        return self.reducer.result()
+
+
+def shard(filenames, files_per_shard):
+    return [filenames[i:i+files_per_shard] for i in range(0, len(filenames), files_per_shard)]
+
+
+def build_table(filenames, sensorids, binning, sum_z=False, nworkers=1, files_per_shard=16, max_memory=200, report=None,
+                ntime=None, prefetch=0, prefetch_memory=1000):
+    '''
+    Accumulator of all the files, built with nworkers processes. With a
+    report (lt_report.Report) a "file" line is emitted for each file. With
+    ntime the time tables are built too (acc.time). prefetch and
+    prefetch_memory are per process, see fold_shard.
+    '''
+    tasks     = [(files, sensorids, binning, sum_z, max_memory, ntime, prefetch, prefetch_memory)
+                 for files in shard(filenames, files_per_shard)]
+    collector = ShardCollector(len(filenames), report)
+    run_shards(fold_shard, tasks, nworkers, collector)
+
+    acc = collector.result()
+    if acc is None:
+        acc = LTAccumulator(sensorids, binning)
+        if ntime is not None:
+            acc.time = TimeAccumulator(sensorids, binning, ntime)
+    return acc
@@ -0,0 +1,89 @@
+'''
+Reduces a nexus output file on the grid worker to the binned light table
+partial sums, the same (sensor_id, x, y, z, N, sum, sum2) table that
+lt_creator_S1S2_1.py makes from the slimmed file. Only the partial needs to
+be transferred back, and the Step-1 pass is not needed.
+
+Both scripts bin the file with the same functions (lt_parallel.fold_shard),
+so the partials are identical and merge to the same table in
+lt_creator_S1S2_2.py.
+
+To run:
+python3 lt_partial.py <basename> <S1/S2> [jobid]
+
+The file and write stages are reported as JSON lines (see lt_report.py).
+
+The PMT sensor ids are those of the DataPMT table (lt_detdb.py) used to
+merge the partials, and must be the PMTs of MC/sns_positions.
+'''
+
+import os
+import sys
+import numpy  as np
+import pandas as pd
+
+from lt_accumulator import make_binning
+from lt_detdb       import load_table
+from lt_parallel    import fold_shard
+from lt_report      import Report
+
+# Configure the script here
+basename    = sys.argv[1]
+signal_type = sys.argv[2] # S1/S2
+jobid       = int(sys.argv[3]) if len(sys.argv) > 3 else None
+detector_db = "next100"
+pmt = "PmtR11410"
+Active_r = 1000 # active radius in mm
+EL_GAP = 10.0 # EL gap in mm
+SiPM_Pitch = 15
+
+# Set the Binning, the same as lt_creator_S1S2_1.py
+if signal_type == "S1":
+    # Min x val, max x val, x bin w (y are set equal to this)
+    xmin=-500; xmax=500; xbw=20
+
+    # Min z val, max z val, z bin w
+    zmin=0; zmax=510; zbw=20
+else:
+    # Min x val, max x val, x bin w (y are set equal to this)
+    xmin=-500; xmax=500; xbw=20
+
+    # Min z val, max z val, z bin w (in case of S2, we just want one bin in EL)
+    zmin=-12; zmax=2; zbw=1
+
+# create config which will be saved to the file
+config = { "parameter" : ["detector",  "ACTIVE_rad", "EL_GAP"   , "table_type","signal_type","sensor","pitch_x"       ,"pitch_y", "nexus", "binning"],
+                "value": [detector_db, str(Active_r),str(EL_GAP), "energy"     ,signal_type , pmt     ,str(SiPM_Pitch), str(SiPM_Pitch), "v7_11_00",
+                          " ".join(str(b) for b in [xmin, xmax, xbw, zmin, zmax, zbw])]}
+
+config = pd.DataFrame.from_dict(config)
+
+filename = basename + ".h5"
+
+# PMT ids of the detector database, checked against the sensors simulated by nexus
+sensorids     = load_table(detector_db, "DataPMT")["SensorID"].values
+sns_positions = pd.read_hdf(filename, "MC/sns_positions")
+simulated     = sns_positions[sns_positions["sensor_name"] == pmt]["sensor_id"].values
+if not np.array_equal(np.sort(sensorids), np.sort(simulated)):
+    raise ValueError(f"The {pmt} ids in {filename} are not those of the {detector_db} DataPMT table")
+
+report = Report("lt_partial", signal_type=signal_type, jobid=jobid)
+
+stats = []
+acc, nevents = fold_shard([filename], sensorids, make_binning(xmin, xmax, xbw, zmin, zmax, zbw), sum_z=False, stats=stats)
+for stat in stats:
+    report.add(bytes=stat["bytes"], events=stat["events"], rows=stat["rows"])
+    report.emit("file", **stat)
+
+LT = acc.to_partial()
+
+print(f"Reduced {nevents} events to {len(LT)} partial rows")
+
+report.begin("write")
+with pd.HDFStore(f"{basename}_partial.h5", mode='w', complevel=5, complib='zlib') as store:
+    # Write each DataFrame to the file with a unique key
+    store.put('LT/LightTable', LT, format='table')
+    store.put('LT/Config',config, format='table')
+report.end("write", rows=len(LT), bytes=os.path.getsize(f"{basename}_partial.h5"))
+
+report.close()
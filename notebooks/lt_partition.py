@@ -0,0 +1,397 @@
+'''
+Merge of the light table partials with bounded memory, partitioned by
+sensor (and z slab).
+
+A SiPM or finely binned table (sensors x nx x ny x nz moments) may not fit
+in the memory of one node. The sensors are split into contiguous ranges
+(and, if a single sensor does not fit, the z bins into slabs) so that the
+accumulator of one partition fits in --max-memory. Each partition is a
+separate process or array task: it streams all the partials in chunks
+and keeps only the rows of its sensors and z slab. The partitions are
+then stitched into the final table a block of x bins at a time, reading
+the block of every partition and appending the rows of the pivoted
+LT/LightTable and LT/Error (in x, y, z order, with the columns of
+lt_merge.write_final) and the LT_dense arrays, so the table is never
+pivoted or held whole.
+
+The inputs are the Step-1 partials (LT/LightTable with sensor_id, x, y,
+z, N, sum, sum2) or the accumulators of lt_merge.py (group /merge), and
+the binning they store must be --binning.
+max_memory covers the arrays of a process; the interpreter and the
+libraries take about job_overhead MB more.
+
+To run:
+python lt_partition.py plan --binning -500 500 20 -12 2 1 --sensors sipm --max-memory 3000
+python lt_partition.py merge partials.txt parts --partition 0 --binning -500 500 20 -12 2 1 --sensors sipm --max-memory 3000
+python lt_partition.py stitch parts NEXT100-MC_S2_LT.h5 --binning -500 500 20 -12 2 1 --sensors sipm --signal-type S2 --max-memory 3000
+
+or all of it, here with nworkers processes or as slurm array jobs:
+python lt_partition.py run partials.txt parts NEXT100-MC_S2_LT.h5 --backend slurm --binning -500 500 20 -12 2 1 --signal-type S2
+'''
+
+import os
+import argparse
+import multiprocessing as mp
+import numpy  as np
+import pandas as pd
+import tables as tb
+
+from lt_accumulator import LTAccumulator, make_binning, merge_moments
+from lt_binning     import bin_partial
+from lt_build_state import write_accumulator
+from lt_dense       import axes
+from lt_detdb       import load_table
+from lt_io          import chunk_size
+from lt_merge       import resolve_binning
+from lt_report      import peak_rss
+
+MB = 1024**2
+
+# Bytes per cell of the moments (N, mean, M2) and the factor for the temporaries of the merges
+cell_bytes = 24
+overhead   = 2
+
+# Fraction of max_memory used for the chunks of the partials
+read_fraction = 0.25
+
+# Bytes per cell and sensor of a block of the stitch: about 24 arrays for the moments, their merges,
+# the values and errors and their copies written to LT_dense
+stitch_bytes = 24 * 8
+
+# The partition files are read once by the stitch, light compression is enough
+partition_filters = tb.Filters(complevel=1, complib="zlib", shuffle=True)
+
+# MB of the interpreter and the libraries, added to max_memory for the job request
+job_overhead = 500
+
+# Sensor tables and column names of the sensor sets
+sensor_tables = {"pmt" : "DataPMT"  , "sipm" : "DataSiPM"}
+sensor_names  = {"pmt" : "PmtR11410", "sipm" : "SiPM"}
+
+job_script = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "job", "slurm",
+                                          "LT_partition_job.sh"))
+
+
+def plan_partitions(sensorids, binning, max_memory):
+    '''
+    Partitions (sensor ids, z0, z1) whose accumulators fit in max_memory
+    MB: ranges of sensors with all the z bins, or single sensors and z
+    slabs if one sensor does not fit.
+    '''
+    nx, ny, nz = binning.shape
+    budget     = max_memory * MB * (1 - read_fraction)
+    per_sensor = nx * ny * nz * cell_bytes * overhead
+
+    if per_sensor <= budget:
+        nsensors = int(budget // per_sensor)
+        return [(sensorids[i:i+nsensors], 0, nz) for i in range(0, len(sensorids), nsensors)]
+
+    nslab = int(budget // (nx * ny * cell_bytes * overhead))
+    if nslab < 1:
+        raise ValueError(f"{max_memory} MB cannot hold one z bin of one sensor "
+                         f"({nx * ny * cell_bytes * overhead / MB:.1f} MB)")
+    return [(sensorids[i:i+1], z0, min(z0 + nslab, nz)) for i in range(len(sensorids)) for z0 in range(0, nz, nslab)]
+
+
+def merge_group(acc, group, z0):
+    # Fold the sensors of acc from an accumulator written by lt_merge.py, one sensor at a time
+    ids = group.sensorids.read()
+    nz  = acc.shape[3]
+    for i, sid in enumerate(acc.sensorids):
+        j = np.flatnonzero(ids == sid)
+        if len(j) == 0:
+            continue
+        n, mean, m2 = (getattr(group, name)[j[0], :, :, z0:z0+nz] for name in ["N", "mean", "M2"])
+        acc.N[i], acc.mean[i], acc.M2[i] = merge_moments(acc.N[i], acc.mean[i], acc.M2[i], n, mean, m2)
+
+
+def merge_partition(filenames, sensorids, binning, z0, z1, max_memory=2000):
+    '''
+    Accumulator of the sensors and z bins z0 to z1 of a partition, from all
+    the partial and merged files. The partials are read in chunks of
+    read_fraction of max_memory.
+    '''
+    acc = LTAccumulator(sensorids, binning.z_slice(z0, z1))
+    columns = ['sensor_id', 'x', 'y', 'z', 'N', 'sum', 'sum2']
+
+    for filename in filenames:
+        with tb.open_file(filename, "r") as h5in:
+            merged = "/merge" in h5in
+            if merged:
+                merge_group(acc, h5in.root.merge, z0)
+
+        if merged:
+            continue
+
+        with pd.HDFStore(filename, "r") as store:
+            storer = store.get_storer("LT/LightTable")
+            if storer.is_table:
+                chunks = store.select("LT/LightTable", columns=columns, iterator=True,
+                                      chunksize=chunk_size(storer, max_memory * read_fraction))
+            else:
+                chunks = [store.select("LT/LightTable")[columns]]
+
+            for lt in chunks:
+                lt = lt[np.isin(lt["sensor_id"].values, acc.sensorids)]
+                acc.add_sums(bin_partial(lt, acc), lt["N"].values, lt["sum"].values, lt["sum2"].values)
+
+    return acc
+
+
+def partition_file(directory, index):
+    return os.path.join(directory, f"part_{index}.h5")
+
+
+def write_partition(filename, acc, signal_type, z0, z1):
+    # The S2 partitions are collapsed in z here, the stitch merges their z slabs
+    acc = acc.collapse_z() if signal_type == "S2" else acc
+    with tb.open_file(filename, "w") as h5out:
+        group = write_accumulator(h5out, "/", "partition", acc, partition_filters)
+        h5out.create_array(group, "filled", obj=(acc.N > 0).any(axis=(1, 2, 3)))
+        group._v_attrs["z0"] = z0
+        group._v_attrs["z1"] = z1
+
+
+def read_parts(filenames):
+    # Sensor ids, z range and filled sensors of each partition, without the moments
+    parts = []
+    for filename in filenames:
+        with tb.open_file(filename, "r") as h5in:
+            grp = h5in.root.partition
+            parts.append(dict(file=filename, sensorids=grp.sensorids.read(), filled=grp.filled.read(),
+                              z0=grp._v_attrs["z0"], z1=grp._v_attrs["z1"]))
+    return parts
+
+
+def stitch_block(parts, sensorids, x0, x1, shape, signal_type):
+    '''
+    Moments (sensor, x, y, z) of the x bins x0 to x1 of all the partitions.
+    '''
+    ny, nz = shape
+    index  = {sid : i for i, sid in enumerate(sensorids)}
+    N      = np.zeros((len(sensorids), x1 - x0, ny, nz), dtype=np.int64)
+    mean   = np.zeros(N.shape)
+    M2     = np.zeros(N.shape)
+
+    for part in parts:
+        isns = np.array([index[sid] for sid in part["sensorids"]])
+        with tb.open_file(part["file"], "r") as h5in:
+            grp = h5in.root.partition
+            n, m, m2 = (getattr(grp, name)[:, x0:x1] for name in ["N", "mean", "M2"])
+
+        # S2 partitions hold one z bin, the sum over their z slab
+        zs = slice(0, 1) if signal_type == "S2" else slice(part["z0"], part["z1"])
+        N[isns, :, :, zs], mean[isns, :, :, zs], M2[isns, :, :, zs] = \
+            merge_moments(N[isns, :, :, zs], mean[isns, :, :, zs], M2[isns, :, :, zs], n, m, m2)
+
+    return N, mean, M2
+
+
+def block_frames(N, mean, M2, binning, x0, columns, prefix, signal_type):
+    '''
+    Rows of the pivoted LT/LightTable and LT/Error of a block: the voxels
+    with any sensor filled, as lt_merge.write_final writes them.
+    '''
+    filled = N > 0
+    ix, iy, iz = np.nonzero(filled.any(axis=0))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        std   = np.sqrt(np.divide(M2, N, out=np.full(N.shape, np.nan), where=filled))
+        error = 100 * std / mean
+    error = np.where(np.isnan(error), 0., error)
+
+    isns, ids = columns
+    keep = filled[isns][:, ix, iy, iz]
+
+    frames = []
+    for values in [mean, error]:
+        values = np.where(keep, values[isns][:, ix, iy, iz], np.nan).T
+
+        df = pd.DataFrame({"x" : binning.xbins_centre[x0 + ix], "y" : binning.ybins_centre[iy]})
+        if signal_type != "S2":
+            df["z"] = binning.zbins_centre[iz]
+
+        df = pd.concat([df, pd.DataFrame(values, columns=[f"{prefix}_{sid}" for sid in ids])], axis=1)
+        df[prefix + "_total"] = df.iloc[:, 2 if signal_type == "S2" else 3:].sum(axis=1)
+        frames.append(df)
+    return frames
+
+
+def stitch(output, filenames, binning, signal_type, config, sensors="pmt", max_memory=2000):
+    '''
+    Write the final table from the partition files, a block of x bins at
+    a time.
+    '''
+    # invisible_cities is only needed to write the tables
+    from invisible_cities.io.dst_io import df_writer
+
+    parts     = read_parts(filenames)
+    sensorids = np.array(list(dict.fromkeys(sid for part in parts for sid in part["sensorids"])))
+    filled    = {sid for part in parts for sid, f in zip(part["sensorids"], part["filled"]) if f}
+
+    # The frame columns are the filled sensors in id order, as the pivot gives them
+    order   = np.array([i for i in np.argsort(sensorids) if sensorids[i] in filled], dtype=np.int64)
+    columns = (order, sensorids[order])
+
+    if signal_type == "S2":
+        binning = binning.collapse_z()
+    nx, ny, nz = binning.shape
+    nsensors   = len(sensorids)
+    block      = max(1, int(max_memory * MB // (ny * nz * nsensors * stitch_bytes)))
+    prefix     = sensor_names.get(sensors, sensors)
+
+    filters = tb.Filters(complevel=5, complib="zlib", shuffle=True)
+    with tb.open_file(output, "w") as h5out:
+        grp   = h5out.create_group("/", "LT_dense")
+        dense = {name : h5out.create_carray(grp, name, atom=atom, shape=(nx, ny, nz, nsensors), filters=filters,
+                                            chunkshape=(1, ny, 1, nsensors))
+                 for name, atom in [("value", tb.Float64Atom()), ("error", tb.Float64Atom()), ("entries", tb.Int32Atom())]}
+        total = {name : h5out.create_carray(grp, name, atom=tb.Float64Atom(), shape=(nx, ny, nz), filters=filters)
+                 for name in ["total", "total_error"]}
+
+        for x0 in range(0, nx, block):
+            x1 = min(x0 + block, nx)
+            N, mean, M2 = stitch_block(parts, sensorids, x0, x1, (ny, nz), signal_type)
+
+            lt, err = block_frames(N, mean, M2, binning, x0, columns, prefix, signal_type)
+            if len(lt):
+                df_writer(h5out, lt , "LT", "LightTable")
+                df_writer(h5out, err, "LT", "Error")
+
+            # LT_dense as lt_dense.dense_tables, with the std of the N - 1 estimate
+            with np.errstate(invalid="ignore", divide="ignore"):
+                value = np.where(N > 0, mean, np.nan)
+                std   = np.sqrt(np.divide(M2, N - 1, out=np.full(N.shape, np.nan), where=N > 1))
+                error = 100 * std / value
+
+            dense["value"]  [x0:x1] = value.transpose(1, 2, 3, 0)
+            dense["error"]  [x0:x1] = error.transpose(1, 2, 3, 0)
+            dense["entries"][x0:x1] = N    .transpose(1, 2, 3, 0)
+            total["total"]      [x0:x1] = np.nansum(value, axis=0)
+            total["total_error"][x0:x1] = np.nansum(error, axis=0)
+
+        for name in axes:
+            h5out.create_array(grp, name, obj=getattr(binning, name))
+        h5out.create_array(grp, "sensor_ids", obj=sensorids)
+        for par, val in zip(config["parameter"], config["value"]):
+            grp._v_attrs[par] = val
+        grp._v_attrs["dims"] = "x, y, z, sensor"
+
+        df_writer(h5out, config, "LT", "Config")
+
+
+def make_config(detector, signal_type, sensors, binning):
+    return pd.DataFrame({"parameter" : ["detector", "signal_type", "sensor", "binning"],
+                         "value"     : [detector, signal_type, sensor_names.get(sensors, sensors), " ".join(map(str, binning))]})
+
+
+def load_sensors(detector, sensors):
+    return load_table(detector, sensor_tables[sensors])["SensorID"].values
+
+
+def run_partition(args):
+    # Pool entry point, one process per partition so its memory is returned
+    filenames, directory, index, sensorids, binning, z0, z1, signal_type, max_memory = args
+    acc = merge_partition(filenames, sensorids, binning, z0, z1, max_memory)
+    write_partition(partition_file(directory, index), acc, signal_type, z0, z1)
+    return index, peak_rss()
+
+
+def write_slurm(directory, partials, output, npartitions, options, max_memory):
+    '''
+    Script submitting the partitions as an array job and the stitch after
+    them, each asking for max_memory plus job_overhead MB.
+    '''
+    mem   = int(max_memory + job_overhead)
+    lines = ["#!/bin/bash", "", "# Submits the partitioned merge (see lt_partition.py)", "",
+             f'JID=$(sbatch --parsable --array=0-{npartitions-1} --mem {mem} {job_script} merge '
+             f'"{partials} {directory} {options}")',
+             f'sbatch --dependency=afterok:${{JID}} --mem {mem} {job_script} stitch "{directory} {output} {options}"',
+             f'echo "{npartitions} partitions, job ${{JID}}"']
+
+    filename = os.path.join(directory, "submit_partition.sh")
+    with open(filename, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.chmod(filename, 0o755)
+    return filename
+
+
+def read_list(filename):
+    with open(filename) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the light table partials partitioned by sensor with bounded memory")
+    sub    = parser.add_subparsers(dest="command", required=True)
+
+    commands = {"plan"   : [],
+                "merge"  : ["partials", "directory"],
+                "stitch" : ["directory", "output"],
+                "run"    : ["partials", "directory", "output"]}
+
+    for command, positional in commands.items():
+        p = sub.add_parser(command)
+        for name in positional:
+            p.add_argument(name)
+        p.add_argument("--binning"    , required=True, type=float, nargs=6, metavar=("XMIN", "XMAX", "XBW", "ZMIN", "ZMAX", "ZBW"))
+        p.add_argument("--detector"   , default="next100")
+        p.add_argument("--sensors"    , default="pmt", choices=list(sensor_tables))
+        p.add_argument("--signal-type", default="S1", choices=["S1", "S2"])
+        p.add_argument("--max-memory" , default=2000, type=float, help="MB of arrays per process")
+        if command == "merge":
+            p.add_argument("--partition", required=True, type=int)
+        if command == "run":
+            p.add_argument("--backend" , default="local", choices=["local", "slurm"])
+            p.add_argument("--nworkers", default=1, type=int, help="partitions merged at once for the local backend")
+
+    args       = parser.parse_args()
+    binning    = make_binning(*args.binning)
+    sensorids  = load_sensors(args.detector, args.sensors)
+    partitions = plan_partitions(sensorids, binning, args.max_memory)
+
+    # Partials binned otherwise would be folded into the wrong bins
+    if args.command in ["merge", "run"]:
+        resolve_binning(read_list(args.partials), args.binning)
+
+    if args.command == "plan":
+        nx, ny, nz = binning.shape
+        print(f"{len(sensorids)} sensors, {nx}x{ny}x{nz} bins, "
+              f"{len(sensorids) * nx * ny * nz * cell_bytes / MB:.0f} MB of moments")
+        print(f"{len(partitions)} partitions of up to {max(len(s) for s, _, _ in partitions)} sensors "
+              f"and {max(z1 - z0 for _, z0, z1 in partitions)} z bins for {args.max_memory:.0f} MB")
+
+    elif args.command == "merge":
+        sensors, z0, z1 = partitions[args.partition]
+        os.makedirs(args.directory, exist_ok=True)
+        index, rss = run_partition((read_list(args.partials), args.directory, args.partition,
+                                    sensors, binning, z0, z1, args.signal_type, args.max_memory))
+        print(f"Partition {index}: sensors {sensors[0]}-{sensors[-1]}, z bins {z0}-{z1}, peak RSS {rss:.0f} MB")
+
+    elif args.command == "stitch":
+        files = [partition_file(args.directory, i) for i in range(len(partitions))]
+        stitch(args.output, files, binning, args.signal_type,
+               make_config(args.detector, args.signal_type, args.sensors, args.binning), args.sensors, args.max_memory)
+        print(f"Stitched {len(files)} partitions into {args.output}, peak RSS {peak_rss():.0f} MB")
+
+    elif args.backend == "slurm":
+        options = (f"--binning {' '.join(map(str, args.binning))} --detector {args.detector} --sensors {args.sensors} "
+                   f"--signal-type {args.signal_type} --max-memory {args.max_memory:g}")
+        os.makedirs(args.directory, exist_ok=True)
+        script = write_slurm(os.path.abspath(args.directory), os.path.abspath(args.partials), os.path.abspath(args.output),
+                             len(partitions), options, args.max_memory)
+        print(f"Wrote {script}")
+
+    else:
+        os.makedirs(args.directory, exist_ok=True)
+        filenames = read_list(args.partials)
+        tasks = [(filenames, args.directory, i, sensors, binning, z0, z1, args.signal_type, args.max_memory)
+                 for i, (sensors, z0, z1) in enumerate(partitions)]
+
+        with mp.get_context("fork").Pool(args.nworkers, maxtasksperchild=1) as pool:
+            for index, rss in pool.imap_unordered(run_partition, tasks):
+                print(f"Partition {index} of {len(tasks)} done, peak RSS {rss:.0f} MB")
+
+        stitch(args.output, [partition_file(args.directory, i) for i in range(len(tasks))], binning, args.signal_type,
+               make_config(args.detector, args.signal_type, args.sensors, args.binning), args.sensors, args.max_memory)
+        print(f"Wrote {args.output}")
@@ -0,0 +1,150 @@
+'''
+Plans the next batch of light table jobs from the current statistics.
+
+For each voxel the relative error on the mean charge of a sensor is
+std/(mean*sqrt(N)), so reaching a target relative error needs
+N = (std/mean / target)^2 events. The sensors of a voxel are combined with
+a quantile (the median by default, 1 for the worst sensor). The missing
+events are turned into a number of jobs from the fraction of the events
+generated in the active cylinder (radius Active_r) that land in the voxel.
+For S2 the counts are summed over z first, as in the tables.
+
+By default the jobs generate uniformly over the whole table (what the
+S1/S2 ScintGenerator jobs do with region ACTIVE). With slab_width the
+table is split in z-slabs of slab_width bins and each slab gets the jobs
+it still needs with the generation restricted to it, so the events go
+where the statistics are missing. The job scripts set the z range with
+the /Generator/ScintGenerator/zmin and zmax lines of the config macro, and
+stop if it has none.
+
+To run:
+python lt_planner.py <state_file> --target 0.01 --events-per-job 100 --first-jobid 10000 --slab-width 10
+
+Each slab gets its own block of job ids from first-jobid on, which set the
+seeds and event ids, so they do not repeat those of the jobs already
+merged or of the other slabs. Writes jobs.txt with one job per line, the
+job id (and the z range of its slab with slab_width), for
+queue NewProcess from jobs.txt            (whole table)
+queue NewProcess,ZMIN,ZMAX from jobs.txt  (slabs)
+in the condor submit file, and prints a slurm array (from 0) per slab with
+the first job id of the slab passed to the job script.
+'''
+
+import os
+import argparse
+import numpy  as np
+import pandas as pd
+
+from lt_binning     import area_fraction
+from lt_build_state import BuildState
+
+
+def events_needed(acc, target, quantile=0.5, min_events=10):
+    '''
+    Additional events needed in each (x, y, z) voxel to reach the target
+    relative error on the mean. Voxels with less than two events get
+    min_events.
+    '''
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rel = acc.std() / acc.mean
+
+    rel  = np.where(np.isfinite(rel), rel, np.nan)
+    need = (rel / target)**2
+
+    # Voxels where no sensor has an error estimate yet
+    empty = np.all(np.isnan(need), axis=0)
+    need  = np.nanquantile(np.where(empty[None], 0, need), quantile, axis=0)
+    need  = np.where(empty, min_events, need)
+
+    nevents = acc.N.max(axis=0)
+    return np.clip(np.ceil(need - nevents), 0, None), nevents
+
+
+def plan_jobs(acc, target, events_per_job, Active_r, slab_width=0, quantile=0.5, min_events=10, min_area=0.1,
+              signal_type="S1"):
+    '''
+    Jobs needed for each z-slab of slab_width bins with the generation
+    restricted to the slab, or for the whole table if slab_width is 0.
+    Voxels with less than min_area of their (x, y) bin inside Active_r are
+    left out. Returns a dataframe with one row per slab.
+    '''
+    if signal_type == "S2":
+        acc = acc.collapse_z()
+
+    binning = acc.binning
+    extra, nevents = events_needed(acc, target, quantile, min_events)
+
+    # Fraction of the events generated in the cylinder landing in each (x, y) bin
+    area   = area_fraction(binning.xbins, binning.ybins, Active_r)
+    inside = area >= min_area
+    extra  = np.where(inside[:, :, None], extra, 0)
+
+    bin_area = (binning.xbins[1] - binning.xbins[0]) * (binning.ybins[1] - binning.ybins[0])
+    prob     = area * bin_area / (np.pi * Active_r**2)
+
+    nz    = len(binning.zbins_centre)
+    width = slab_width if slab_width > 0 else nz
+    slabs = []
+
+    for iz in range(0, nz, width):
+        sl    = slice(iz, min(iz + width, nz))
+        nbins = sl.stop - sl.start
+
+        # Generated uniformly in the slab
+        with np.errstate(invalid="ignore", divide="ignore"):
+            jobs = np.where(inside[:, :, None], extra[:, :, sl] / (events_per_job * prob[:, :, None] / nbins), 0)
+
+        slabs.append(dict(zmin          = binning.zbins[sl.start],
+                          zmax          = binning.zbins[sl.stop],
+                          voxels        = int(inside.sum() * nbins),
+                          converged     = int((inside[:, :, None] & (extra[:, :, sl] == 0)).sum()),
+                          min_events    = int(nevents[:, :, sl][inside].min()) if inside.any() else 0,
+                          events_needed = int(extra[:, :, sl].max()),
+                          jobs          = int(np.ceil(jobs.max()))))
+
+    return pd.DataFrame(slabs)
+
+
+def write_jobs(plan, first_jobid, filename, zrange=True):
+    '''
+    One line per job, the job id and, with zrange, the z range of its
+    slab. The slabs get consecutive blocks of job ids from first_jobid,
+    their first job id is added to the plan as first_jobid.
+    '''
+    plan = plan.assign(first_jobid=first_jobid + np.cumsum(plan["jobs"].values) - plan["jobs"].values)
+
+    with open(filename, "w") as f:
+        for slab in plan.itertuples():
+            for jobid in range(slab.first_jobid, slab.first_jobid + slab.jobs):
+                f.write(f"{jobid} {slab.zmin:g} {slab.zmax:g}\n" if zrange else f"{jobid}\n")
+    return plan
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plan the light table jobs from the current accumulators")
+    parser.add_argument("state_file", help="state file written by the incremental build")
+    parser.add_argument("--target"        , default=0.01, type=float, help="target relative error on the mean")
+    parser.add_argument("--events-per-job", default=100 , type=int  , help="N_EVENTS of the job scripts")
+    parser.add_argument("--first-jobid"   , default=10000, type=int , help="first job id, after the ones already used")
+    parser.add_argument("--active-r"      , default=1000, type=float, help="radius of the generation region in mm")
+    parser.add_argument("--slab-width"    , default=0   , type=int  , help="z bins per slab of the jobs, 0 for the whole table")
+    parser.add_argument("--signal-type"   , default="S1", choices=["S1", "S2"])
+    parser.add_argument("--quantile"      , default=0.5 , type=float, help="quantile over the sensors of a voxel")
+    parser.add_argument("--out"           , default="jobs.txt")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.state_file):
+        parser.error(f"{args.state_file} does not exist")
+
+    state  = BuildState.open(args.state_file, None, None)
+    plan   = plan_jobs(state.acc, args.target, args.events_per_job, args.active_r,
+                       args.slab_width, args.quantile, signal_type=args.signal_type)
+    zrange = len(plan) > 1
+    plan   = write_jobs(plan, args.first_jobid, args.out, zrange)
+    print(plan.to_string(index=False))
+
+    print(f"{plan['jobs'].sum()} jobs written to {args.out}")
+    print(f"condor: queue NewProcess{',ZMIN,ZMAX' if zrange else ''} from {args.out}")
+    for slab in plan[plan["jobs"] > 0].itertuples():
+        print(f"slurm:  sbatch --array=0-{slab.jobs - 1} <job script> {slab.first_jobid}" +
+              (f" {slab.zmin:g} {slab.zmax:g}" if zrange else ""))
@@ -0,0 +1,180 @@
+'''
+Background reading of the nexus files of a build: a thread reads the
+particles and the MC/sns_response chunks of the next files (at most depth
+files, and about budget MB of chunks, ahead) while the current one is
+binned.
+
+Usage:
+with Prefetcher(filenames, sensorids, depth=2, budget=1000) as files:
+    for filename in filenames:
+        (parts, nphotons, sns_response), times = files.get()
+'''
+
+import time
+import threading
+import collections
+
+from lt_io import load_file, sns_columns
+
+MB = 1024**2
+
+
+def frame_bytes(df):
+    return int(df.memory_usage(index=True).sum())
+
+
+class Prefetcher:
+    '''
+    Reads the files in order in a background thread, one chunk of
+    MC/sns_response (of up to max_memory MB) at a time, so at most about
+    budget MB plus one chunk are held. get returns the files in the same
+    order.
+
+    The reads done while get is waiting run alone, the others share the
+    CPU with the binning and take longer. The time to read a file serially
+    is estimated from the bytes per second of the lone reads.
+    '''
+    def __init__(self, filenames, sensorids=None, max_memory=200, columns=sns_columns, depth=2, budget=1000):
+        if depth < 1:
+            raise ValueError("depth must be at least 1")
+
+        self.filenames = list(filenames)
+        self.args      = (sensorids, max_memory, columns)
+        self.depth     = depth
+        self.budget    = budget * MB
+        self.queue     = collections.deque() # (kind, data, nbytes, wall, cpu, alone)
+        self.queued    = 0                   # bytes in the queue
+        self.ahead     = 0                   # files in the queue
+        self.estimate  = 0                   # bytes of the last chunk read
+        self.waiting   = False               # get is waiting for the thread
+        self.alone     = [0., 0]             # seconds and bytes of the reads done while get waited
+        self.cond      = threading.Condition()
+        self.closed    = False
+        self.current   = None                # chunks of the file being used
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _room(self, new_file):
+        # A read is started if the queue is empty or the last chunk would still fit
+        if new_file and self.ahead >= self.depth:
+            return False
+        return not self.queue or self.queued + self.estimate <= self.budget
+
+    def _read(self, read, new_file=False):
+        # Wait for room and time read(), None if the prefetcher was closed
+        with self.cond:
+            self.cond.wait_for(lambda: self.closed or self._room(new_file))
+            if self.closed:
+                return None
+            # get only returns once this read is queued, so it runs alone
+            alone = self.waiting
+
+        wall = time.perf_counter()
+        cpu  = time.thread_time()
+        data = read()
+        return data, time.perf_counter() - wall, time.thread_time() - cpu, alone
+
+    def _append(self, kind, data, nbytes=0, wall=0., cpu=0., alone=False):
+        with self.cond:
+            if self.closed:
+                return
+            self.queue.append((kind, data, nbytes, wall, cpu, alone))
+            self.queued += nbytes
+            self.ahead  += kind == "file"
+            if alone:
+                self.alone[0] += wall
+                self.alone[1] += nbytes
+            self.cond.notify_all()
+
+    def _run(self):
+        for filename in self.filenames:
+            try:
+                read = self._read(lambda: load_file(filename, *self.args), new_file=True)
+                if read is None:
+                    return
+                (parts, nphotons, chunks), *times = read
+                self._append("file", (parts, nphotons), frame_bytes(parts), *times)
+
+                try:
+                    while True:
+                        read = self._read(lambda: next(chunks, None))
+                        if read is None:
+                            return
+                        chunk, *times = read
+                        if chunk is None:
+                            self._append("end", None, 0, *times)
+                            break
+                        self.estimate = frame_bytes(chunk)
+                        self._append("chunk", chunk, self.estimate, *times)
+                finally:
+                    chunks.close()
+
+            except Exception as e:
+                self._append("error", (filename, e))
+                return
+
+    def _serial(self, nbytes, wall, cpu, alone):
+        # Estimated time of a read done on its own, from the bytes per second of the lone reads
+        if alone:
+            return wall
+        if self.alone[1] > 0:
+            return min(wall, nbytes * self.alone[0] / self.alone[1])
+        return cpu
+
+    def _pop(self, times):
+        start = time.perf_counter()
+        with self.cond:
+            self.waiting = True
+            self.cond.wait_for(lambda: self.queue)
+            self.waiting = False
+            kind, data, nbytes, wall, cpu, alone = self.queue.popleft()
+            self.queued -= nbytes
+            self.ahead  -= kind == "file"
+            self.cond.notify_all()
+        times["io_wait"] += time.perf_counter() - start
+
+        if kind == "error":
+            filename, e = data
+            raise OSError(f"Prefetching {filename} failed") from e
+
+        times["read"] += self._serial(nbytes, wall, cpu, alone)
+        return kind, data
+
+    def _chunks(self, times):
+        while True:
+            kind, chunk = self._pop(times)
+            if kind == "end":
+                return
+            yield chunk
+
+    def get(self):
+        '''
+        The next file as (parts, nphotons, chunks of MC/sns_response) and a
+        dict of its io_wait (time waiting for the thread) and read (time it
+        would take to read serially), filled in as the chunks are used.
+        Errors of the thread are raised here.
+        '''
+        # Skip what is left of the previous file
+        if self.current is not None:
+            for _ in self.current:
+                pass
+
+        times = dict(io_wait=0., read=0.)
+        kind, (parts, nphotons) = self._pop(times)
+        self.current = self._chunks(times)
+        return (parts, nphotons, self.current), times
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.queue.clear()
+            self.queued = 0
+            self.cond.notify_all()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,179 @@
+'''
+Radial PSF table of the SiPM plane, as psf_constructor.ipynb without the
+per-event loop: the charge is binned by the distance of each SiPM to the
+emission point and the EL-gap slice (zbins, in -z), and the SiPMs per
+distance bin are counted from the emission points.
+
+Usage:
+acc = build_psf(filenames, sensorids, xsipm, ysipm, dbins, zbins, nworkers=8)
+psf = acc.table()
+'''
+
+import numpy  as np
+import pandas as pd
+
+from lt_binning  import bin_index, event_lookup, lookup_rows
+from lt_parallel import ShardCollector, read_files, run_shards, shard
+
+
+class PSFAccumulator:
+
+    def __init__(self, sensorids, xsipm, ysipm, dbins, zbins):
+        self.sensorids = np.asarray(sensorids)
+        self.xsipm     = np.asarray(xsipm, dtype=float)
+        self.ysipm     = np.asarray(ysipm, dtype=float)
+        self.dbins     = np.asarray(dbins, dtype=float)
+        self.zbins     = np.asarray(zbins, dtype=float)
+        self.shape     = (len(self.zbins) - 1, len(self.dbins) - 1)
+
+        self.charge  = np.zeros(self.shape) # sum of charge/nphotons
+        self.entries = np.zeros(self.shape) # number of SiPM distances summed
+        self.nevents = np.zeros(self.shape[0], dtype=np.int64)
+
+        # Lookup from sensor id to the SiPM position
+        self._order  = np.argsort(self.sensorids)
+        self._sorted = self.sensorids[self._order]
+
+    def sensor_index(self, sensor_id):
+        # Returns -1 for sensors that are not SiPMs
+        sensor_id = np.asarray(sensor_id)
+        pos   = np.searchsorted(self._sorted, sensor_id)
+        pos   = np.clip(pos, 0, len(self._sorted) - 1)
+        found = self._sorted[pos] == sensor_id
+        return np.where(found, self._order[pos], -1)
+
+    def slice_index(self, z):
+        # EL-gap slice of each emission point, as pd.cut(-z, zbins), -1 outside
+        z   = -np.asarray(z, dtype=float)
+        idx = bin_index(z, self.zbins, self.zbins[0], self.zbins[1] - self.zbins[0])
+        return np.where(z > self.zbins[0], idx, -1)
+
+    def distance(self, isns, x, y):
+        # As the notebook, so that equal distances compare equal
+        return ((self.xsipm[isns] - x)**2 + (self.ysipm[isns] - y)**2)**0.5
+
+    def distance_index(self, d):
+        return bin_index(d, self.dbins, self.dbins[0], self.dbins[1] - self.dbins[0])
+
+    def cell_index(self, iz, d):
+        # Flat (slice, distance) index, -1 outside the table
+        idist = self.distance_index(d)
+        valid = (iz >= 0) & (idist >= 0)
+        return np.where(valid, iz * self.shape[1] + idist, -1)
+
+    def add_events(self, x, y, z, max_memory=200):
+        '''
+        Count the SiPMs in each distance bin for a set of emission points,
+        in blocks of events using up to max_memory MB. SiPMs at the same
+        distance of an event are counted once (nunique in the notebook).
+        '''
+        iz    = self.slice_index(z)
+        keep  = iz >= 0
+        x, y, iz = np.asarray(x, dtype=float)[keep], np.asarray(y, dtype=float)[keep], iz[keep]
+
+        self.nevents += np.bincount(iz, minlength=self.shape[0])
+
+        # A few temporaries of (block, nsipm) doubles and indices
+        block = max(1, int(max_memory * 1024**2 / (8 * 8 * len(self.sensorids))))
+        size  = self.charge.size
+        isns  = np.arange(len(self.sensorids))
+
+        for start in range(0, len(x), block):
+            sl = slice(start, start + block)
+            d  = self.distance(isns[None, :], x[sl, None], y[sl, None])
+
+            cells = self.cell_index(iz[sl, None], d).ravel()
+            event = np.repeat(np.arange(len(d)), d.shape[1])
+            ok    = cells >= 0
+            cells, event, d = cells[ok], event[ok], d.ravel()[ok]
+
+            # First of each (event, distance), the cell follows from both
+            order = np.lexsort((d, event))
+            cells, event, d = cells[order], event[order], d[order]
+            first = np.ones(len(d), dtype=bool)
+            first[1:] = (event[1:] != event[:-1]) | (d[1:] != d[:-1])
+
+            self.entries += np.bincount(cells[first], minlength=size).reshape(self.shape)
+
+    def add_response(self, sns_response, parts, nphotons):
+        '''
+        Bin the charge of the SiPM rows of sns_response (a dataframe or an
+        iterable of chunks) by distance and slice of their event.
+        '''
+        if isinstance(sns_response, pd.DataFrame):
+            sns_response = [sns_response]
+
+        emin, lut = event_lookup(parts["event_id"])
+        x  = np.asarray(parts["initial_x"], dtype=float)
+        y  = np.asarray(parts["initial_y"], dtype=float)
+        iz = self.slice_index(parts["initial_z"])
+
+        for chunk in sns_response:
+            isns = self.sensor_index(np.asarray(chunk["sensor_id"]))
+            ievt = lookup_rows(chunk["event_id"], emin, lut)
+            keep = (isns >= 0) & (ievt >= 0)
+            isns, ievt = isns[keep], ievt[keep]
+
+            d     = self.distance(isns, x[ievt], y[ievt])
+            cells = self.cell_index(iz[ievt], d)
+            q     = np.asarray(chunk["charge"], dtype=float)[keep]
+
+            ok = cells >= 0
+            self.charge += np.bincount(cells[ok], weights=q[ok] / nphotons,
+                                       minlength=self.charge.size).reshape(self.shape)
+
+    def add_file(self, parts, nphotons, sns_response, max_memory=200):
+        '''
+        Add the events of a nexus file read with lt_io.load_file (the PMTs
+        are dropped in add_response). Returns the number of events.
+        '''
+        # One emission point per event
+        emin, lut = event_lookup(parts["event_id"])
+        parts = parts.iloc[lut[lut >= 0]]
+
+        self.add_response(sns_response, parts, nphotons)
+        self.add_events(parts["initial_x"].values, parts["initial_y"].values, parts["initial_z"].values, max_memory)
+        return len(parts)
+
+    def merge(self, other):
+        self.charge  += other.charge
+        self.entries += other.entries
+        self.nevents += other.nevents
+        return self
+
+    def table(self):
+        '''
+        PSF table as written by psf_constructor.ipynb: dist_xy and one
+        z_m<slice> column per EL-gap slice with the mean charge per SiPM
+        and photon.
+        '''
+        with np.errstate(invalid="ignore", divide="ignore"):
+            psf = self.charge / self.entries
+
+        table = pd.DataFrame({"dist_xy" : self.dbins[:-1]})
+        for iz in range(self.shape[0]):
+            table["z_m" + str(int(self.zbins[iz+1]))] = psf[iz]
+        return table
+
+
+def fold_psf(filenames, sensorids, xsipm, ysipm, dbins, zbins, max_memory=200, stats=None):
+    # Accumulator of a shard of files and its number of events, stats as in lt_parallel.read_files
+    acc     = PSFAccumulator(sensorids, xsipm, ysipm, dbins, zbins)
+    nevents = 0
+    for parts, nphotons, sns_response in read_files(filenames, None, max_memory, stats=stats):
+        nevents += acc.add_file(parts, nphotons, sns_response, max_memory)
+    return acc, nevents
+
+
+def build_psf(filenames, sensorids, xsipm, ysipm, dbins, zbins, nworkers=1, files_per_shard=16, max_memory=200):
+    '''
+    PSF accumulator of all the files, built with nworkers processes. The
+    shards are merged as in lt_parallel.build_table, so the result does
+    not depend on nworkers.
+    '''
+    tasks     = [(files, sensorids, xsipm, ysipm, dbins, zbins, max_memory) for files in shard(filenames, files_per_shard)]
+    collector = ShardCollector(len(filenames))
+    run_shards(fold_psf, tasks, nworkers, collector)
+
+    acc = collector.result()
+    return acc if acc is not None else PSFAccumulator(sensorids, xsipm, ysipm, dbins, zbins)
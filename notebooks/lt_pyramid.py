@@ -0,0 +1,134 @@
+'''
+Multi-resolution store of the light table accumulators.
+
+The (count, mean, M2) moments of a fine grid can be combined into any
+coarser grid whose bin edges are edges of the fine one
+(LTAccumulator.rebin), so tables with other bin widths or ranges, and the
+S2 sum over z, can be made without reading the nexus files again.
+
+The pyramid file holds the base accumulators (level_1x1x1) and copies
+rebinned by integer factors in x, y and z (e.g. level_4x4x2), so the
+coarse tables are read from a small level instead of the full base:
+/pyramid/level_<fx>x<fy>x<fz>/{N, mean, M2, sensorids, xbins, ..., mask}
+
+Usage:
+write_pyramid("pyramid.h5", acc, levels=[(2, 2, 2), (4, 4, 4)])
+acc     = read_rebinned("pyramid.h5", make_binning(-500, 500, 40, 0, 1200, 40))
+lt, err = acc.aggregate("S1")
+
+or from the state file of an incremental build (lt_build_state.py):
+python lt_pyramid.py build ../LT/NEXT100-MC_S1_LT_state.h5 pyramid.h5 --levels 2,2,2 4,4,4
+python lt_pyramid.py info pyramid.h5
+python lt_pyramid.py table pyramid.h5 out.h5 --binning -500 500 40 0 1200 40 --signal-type S1
+'''
+
+import os
+import argparse
+import numpy  as np
+import tables as tb
+
+from lt_accumulator import Binning, make_binning, edge_index
+from lt_build_state import write_accumulator, read_accumulator
+from lt_dense       import write_dense
+
+
+def coarsen(binning, fx, fy, fz):
+    '''
+    Binning with fx, fy, fz fine bins merged into each bin. If the number
+    of bins is not a multiple of the factor, the last bin takes the fine
+    bins left over, so the level keeps the full range.
+    '''
+    edges = []
+    for bins, f in [(binning.xbins, fx), (binning.ybins, fy), (binning.zbins, fz)]:
+        edges.append(bins[np.unique(np.append(np.arange(0, len(bins), f), len(bins) - 1))])
+
+    return Binning(*edges, *[0.5*(e[1:] + e[:-1]) for e in edges])
+
+
+def level_name(fx, fy, fz):
+    return f"level_{fx}x{fy}x{fz}"
+
+
+def write_pyramid(filename, acc, levels=[(2, 2, 2), (4, 4, 4), (8, 8, 8)], filters=None):
+    '''
+    Write the accumulators and their rebinned copies by the (fx, fy, fz)
+    factors of levels.
+    '''
+    with tb.open_file(filename, "w") as h5out:
+        for factors in [(1, 1, 1)] + [tuple(f) for f in levels]:
+            level = acc if factors == (1, 1, 1) else acc.rebin(coarsen(acc.binning, *factors))
+            group = write_accumulator(h5out, "/pyramid", level_name(*factors), level, filters)
+            group._v_attrs["factors"] = factors
+
+
+def list_levels(filename):
+    # (name, factors, shape) of each level, finest first
+    with tb.open_file(filename, "r") as h5in:
+        levels = [(group._v_name, tuple(group._v_attrs["factors"]), tuple(map(int, group.N.shape)))
+                  for group in h5in.root.pyramid._f_iter_nodes("Group")]
+    return sorted(levels, key=lambda level: np.prod(level[2]))[::-1]
+
+
+def can_rebin(group, binning):
+    # Whether the bin edges of a level include those of binning
+    try:
+        for name in ["xbins", "ybins", "zbins"]:
+            edge_index(getattr(group, name).read(), getattr(binning, name))
+    except ValueError:
+        return False
+    return True
+
+
+def read_rebinned(filename, binning):
+    '''
+    Accumulators on binning, rebinned from the coarsest level of the
+    pyramid that has all its bin edges. Raises a ValueError if no level
+    does.
+    '''
+    levels = list_levels(filename)
+
+    with tb.open_file(filename, "r") as h5in:
+        for name, _, _ in levels[::-1]:
+            group = getattr(h5in.root.pyramid, name)
+            if can_rebin(group, binning):
+                return read_accumulator(group).rebin(binning)
+
+    raise ValueError(f"No level of {filename} can be rebinned to the bins asked for")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multi-resolution store of the light table accumulators")
+    sub    = parser.add_subparsers(dest="command", required=True)
+
+    build = sub.add_parser("build", help="write a pyramid from the state file of an incremental build")
+    build.add_argument("state")
+    build.add_argument("pyramid")
+    build.add_argument("--levels", default=["2,2,2", "4,4,4", "8,8,8"], nargs="+", help="fx,fy,fz factors of each level")
+
+    info = sub.add_parser("info", help="list the levels of a pyramid")
+    info.add_argument("pyramid")
+
+    table = sub.add_parser("table", help="write the dense table (LT_dense) of a binning")
+    table.add_argument("pyramid")
+    table.add_argument("output")
+    table.add_argument("--binning"    , required=True, type=float, nargs=6, metavar=("XMIN", "XMAX", "XBW", "ZMIN", "ZMAX", "ZBW"))
+    table.add_argument("--signal-type", default="S1", choices=["S1", "S2"])
+    args = parser.parse_args()
+
+    if args.command == "build":
+        with tb.open_file(args.state, "r") as h5in:
+            acc = read_accumulator(h5in.root.state)
+        write_pyramid(args.pyramid, acc, [tuple(int(f) for f in level.split(",")) for level in args.levels])
+        args.command = "info"
+
+    if args.command == "info":
+        print(f"{args.pyramid} ({os.path.getsize(args.pyramid)/1024**2:.1f} MB)")
+        for name, factors, shape in list_levels(args.pyramid):
+            print(f"{name:>16} sensors, x, y, z = {shape}")
+
+    if args.command == "table":
+        acc = read_rebinned(args.pyramid, make_binning(*args.binning))
+        with tb.open_file(args.output, "w") as h5out:
+            write_dense(h5out, acc, args.signal_type, {"parameter" : ["signal_type", "binning"],
+                                                       "value"     : [args.signal_type, " ".join(map(str, args.binning))]})
+        print(f"Table of shape {acc.shape} written to {args.output}")
@@ -0,0 +1,192 @@
+'''
+Fan-in reduction tree for merging the light table partials on a cluster.
+
+The partials are merged in groups of fanin by the nodes of the first
+level, their outputs in groups of fanin by the next level, and so on up
+to a single root node that writes the final table (lt_merge.py). With
+10000 partials and fanin 32 this is 313 + 10 + 1 nodes, each reading at
+most 32 files, instead of one process reading all of them.
+
+The tree can be written as:
+- condor: a DAGMan file (reduce.dag) with one node per merge, run with
+  job/condor/lt_merge.sub and LT_merge_job.sh
+- slurm: one array job per level, each depending on the previous one
+  (afterok), run with job/slurm/LT_merge_job.sh
+- local: run here, level by level, with a pool of nworkers processes,
+  to test a tree on one machine
+
+To run:
+python lt_reduce_tree.py partials.txt reduce --fanin 32 --backend condor --signal-type S2
+cd reduce && condor_submit_dag reduce.dag
+'''
+
+import os
+import argparse
+import multiprocessing as mp
+
+from lt_merge import merge_node
+
+# Job files of the nodes
+job_dir   = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "job"))
+merge_sub = os.path.join(job_dir, "condor", "lt_merge.sub")
+merge_job = os.path.join(job_dir, "slurm" , "LT_merge_job.sh")
+
+
+def plan_tree(filenames, fanin):
+    '''
+    Levels of the tree, each a list of nodes (name, inputs, output).
+    The last level has the root node, with output None.
+    '''
+    if fanin < 2:
+        raise ValueError("fanin must be at least 2")
+
+    levels = []
+    inputs = list(filenames)
+    if not inputs:
+        raise ValueError("No partials to merge")
+
+    while True:
+        groups = [inputs[i:i+fanin] for i in range(0, len(inputs), fanin)]
+        level  = len(levels) + 1
+        nodes  = [(f"merge_{level}_{i}", group, f"merged_{level}_{i}.h5") for i, group in enumerate(groups)]
+        levels.append(nodes)
+
+        if len(nodes) == 1:
+            name, group, _ = nodes[0]
+            levels[-1] = [(name, group, None)]
+            return levels
+        inputs = [output for _, _, output in nodes]
+
+
+def write_inputs(levels, directory):
+    # One file per node with its inputs, one per line
+    os.makedirs(os.path.join(directory, "inputs"), exist_ok=True)
+    for nodes in levels:
+        for name, inputs, _ in nodes:
+            with open(os.path.join(directory, "inputs", f"{name}.txt"), "w") as f:
+                f.write("\n".join(inputs) + "\n")
+
+
+def merge_args(binning, detector):
+    # Without a binning the nodes take it from their inputs
+    if binning is None:
+        return f"--detector {detector}"
+    return f"--binning {' '.join(map(str, binning))} --detector {detector}"
+
+
+def write_dag(levels, directory, final, binning, detector, signal_type):
+    '''
+    DAGMan file with a node per merge and the edges between the levels.
+    The inputs are given to condor to transfer (partials on OSDF or
+    outputs of the previous level in the DAG directory).
+    '''
+    write_inputs(levels, directory)
+    os.makedirs(os.path.join(directory, "logs"), exist_ok=True)
+    args  = merge_args(binning, detector)
+    lines = []
+
+    for nodes in levels:
+        for name, inputs, output in nodes:
+            mode = f"--final --signal-type {signal_type}" if output is None else ""
+            lines.append(f"JOB {name} {merge_sub}")
+            lines.append(f'VARS {name} node="{name}" merge_output="{output or final}" inputs="{",".join(inputs)}" '
+                         f'merge_args="{(args + " " + mode).strip()}"')
+
+    for parents, children in zip(levels[:-1], levels[1:]):
+        for name, inputs, _ in children:
+            outputs = set(inputs)
+            lines.append(f"PARENT {' '.join(p for p, _, out in parents if out in outputs)} CHILD {name}")
+
+    filename = os.path.join(directory, "reduce.dag")
+    with open(filename, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return filename
+
+
+def write_slurm(levels, directory, final, binning, detector, signal_type):
+    '''
+    One line per node (output, then inputs) for each level and a script
+    submitting one array job per level after the previous one.
+    '''
+    write_inputs(levels, directory)
+    args  = merge_args(binning, detector)
+    lines = ["#!/bin/bash", "", "# Submits the reduction tree, one array job per level (see lt_reduce_tree.py)", ""]
+
+    for level, nodes in enumerate(levels, 1):
+        with open(os.path.join(directory, f"level_{level}.txt"), "w") as f:
+            for name, inputs, output in nodes:
+                f.write(f"{output or final} inputs/{name}.txt\n")
+
+        mode       = f"--final --signal-type {signal_type}" if level == len(levels) else ""
+        dependency = f" --dependency=afterok:${{JID{level-1}}}" if level > 1 else ""
+        lines.append(f'JID{level}=$(sbatch --parsable --array=1-{len(nodes)}{dependency} '
+                     f'{merge_job} level_{level}.txt "{(args + " " + mode).strip()}")')
+        lines.append(f'echo "Level {level}: {len(nodes)} nodes, job ${{JID{level}}}"')
+
+    filename = os.path.join(directory, "submit_reduce.sh")
+    with open(filename, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.chmod(filename, 0o755)
+    return filename
+
+
+def _run_node(args):
+    # Pool entry point
+    merge_node(*args)
+    return args[0]
+
+
+def run_local(levels, directory, final, binning, detector, signal_type, nworkers=1):
+    '''
+    Run the tree here, the nodes of a level in parallel. The intermediate
+    outputs are written to directory. Returns the final table.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    path = lambda f: f if os.path.isabs(f) else os.path.join(directory, f)
+    top  = len(levels)
+
+    for level, nodes in enumerate(levels, 1):
+        tasks = [(path(output or final), [inp if level == 1 else path(inp) for inp in inputs],
+                  binning, detector, level == top, signal_type) for _, inputs, output in nodes]
+
+        if nworkers > 1:
+            with mp.get_context("fork").Pool(nworkers) as pool:
+                list(pool.imap(_run_node, tasks))
+        else:
+            for task in tasks:
+                _run_node(task)
+
+        print(f"Level {level}: merged {sum(len(inputs) for _, inputs, _ in nodes)} files in {len(nodes)} nodes")
+
+    return path(final)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reduction tree for merging the light table partials")
+    parser.add_argument("partials" , help="file with one partial per line (paths or osdf:// URLs)")
+    parser.add_argument("directory", help="where the tree is written (and run, for local)")
+    parser.add_argument("--fanin"      , default=32, type=int)
+    parser.add_argument("--backend"    , default="local", choices=["condor", "slurm", "local"])
+    parser.add_argument("--binning"    , type=float, nargs=6, metavar=("XMIN", "XMAX", "XBW", "ZMIN", "ZMAX", "ZBW"),
+                        help="Step-1 binning, by default the one stored in the partials")
+    parser.add_argument("--signal-type", default="S1", choices=["S1", "S2"])
+    parser.add_argument("--detector"   , default="next100")
+    parser.add_argument("--final"      , default=None, help="name of the final table")
+    parser.add_argument("--nworkers"   , default=1, type=int, help="processes for the local backend")
+    args = parser.parse_args()
+
+    with open(args.partials) as f:
+        partials = [line.strip() for line in f if line.strip()]
+
+    levels = plan_tree(partials, args.fanin)
+    final  = args.final or f"NEXT100-MC_{args.signal_type}_LT.h5"
+    print(f"{len(partials)} partials, fanin {args.fanin}: " +
+          ", ".join(f"{len(nodes)}" for nodes in levels) + " nodes per level")
+
+    os.makedirs(args.directory, exist_ok=True)
+    if args.backend == "condor":
+        print(f"Wrote {write_dag(levels, args.directory, final, args.binning, args.detector, args.signal_type)}")
+    elif args.backend == "slurm":
+        print(f"Wrote {write_slurm(levels, args.directory, final, args.binning, args.detector, args.signal_type)}")
+    else:
+        print(f"Wrote {run_local(levels, args.directory, final, args.binning, args.detector, args.signal_type, args.nworkers)}")
@@ -0,0 +1,163 @@
+'''
+Run reports of the table builds and grid jobs as JSON lines.
+
+Each stage of a run (reading a file, binning, writing, ...) gives one line
+with the wall clock and CPU time, the peak RSS of the process so far, the
+bytes, events and rows processed and their rates, plus the host, site and
+job id. The lines start with {"report": so they can be picked out of the
+condor .out files among the other output (also after a progress line
+ending in a carriage return).
+
+Usage:
+report = Report("lt_creator", jobid=1)
+with report.stage("aggregate") as rec:
+    ...
+    rec["rows"] = len(lt)
+
+report.begin("pivot")
+...
+report.end("pivot", rows=len(LT))
+report.close()
+
+To summarise the reports of a set of jobs per site and stage, with the
+request_memory needed to cover them:
+python lt_report.py jobs/NEXT100_S2_LT/*/*.out
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import resource
+import contextlib
+import numpy  as np
+import pandas as pd
+
+# Environment variables holding the site name on the OSPool and slurm
+site_variables = ["GLIDEIN_Site", "OSG_SITE_NAME", "SLURM_CLUSTER_NAME"]
+
+
+def peak_rss():
+    # Peak resident memory of the process in MB (ru_maxrss is in kB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def site():
+    return next((os.environ[v] for v in site_variables if v in os.environ), None)
+
+
+class Report:
+
+    def __init__(self, name, stream=sys.stdout, **fields):
+        self.name   = name
+        self.stream = stream
+        self.fields = dict(host=socket.gethostname(), site=site(), pid=os.getpid(), **fields)
+        self.totals = dict(bytes=0, events=0, rows=0)
+
+        self.wall0  = time.perf_counter()
+        self.cpu0   = time.process_time()
+        self.starts = {}
+
+    def emit(self, stage, **values):
+        # One JSON line, the rates are added from the counts and the wall time
+        wall = values.get("wall")
+        for count in ["bytes", "events", "rows"]:
+            if count in values and wall:
+                values[f"{count}_per_s"] = values[count] / wall
+
+        record = dict(report=self.name, stage=stage, time=time.time(), **self.fields, **values)
+        self.stream.write(json.dumps(record, default=float) + "\n")
+        self.stream.flush()
+
+    def add(self, **counts):
+        # Counts of the whole run, reported by close
+        for count, value in counts.items():
+            self.totals[count] = self.totals.get(count, 0) + value
+
+    def begin(self, stage):
+        self.starts[stage] = (time.perf_counter(), time.process_time())
+
+    def end(self, stage, **values):
+        # Emit the line of a stage started with begin
+        wall, cpu = self.starts.pop(stage)
+        self.emit(stage, **values, wall=time.perf_counter() - wall, cpu=time.process_time() - cpu,
+                  peak_rss=peak_rss())
+
+    @contextlib.contextmanager
+    def stage(self, stage, **values):
+        '''
+        Time the block and emit its line. The counts (bytes, events, rows)
+        can be given here or set in the yielded dict.
+        '''
+        record = dict(values)
+        self.begin(stage)
+        yield record
+        self.end(stage, **record)
+
+    def close(self, **values):
+        values = {**self.totals, **values}
+        self.emit("total", wall=time.perf_counter() - self.wall0, cpu=time.process_time() - self.cpu0,
+                  peak_rss=peak_rss(), **values)
+
+
+def read_reports(filenames):
+    '''
+    Dataframe of the report lines found in a set of files.
+    '''
+    records = []
+    for filename in filenames:
+        with open(filename, errors="replace") as f:
+            for line in f:
+                start = line.find('{"report":')
+                if start < 0:
+                    continue
+                try:
+                    records.append(dict(json.loads(line[start:]), source=filename))
+                except json.JSONDecodeError:
+                    continue # truncated by a killed job
+    return pd.DataFrame(records)
+
+
+def summary(reports, quantile=0.99, margin=1.2):
+    '''
+    Per report, site and stage: number of runs, median and maximum wall
+    time, median rates and the peak RSS quantile. request_memory is the
+    quantile of the peak RSS of the whole runs times margin.
+    '''
+    if "site" in reports:
+        reports = reports.assign(site=reports["site"].fillna(reports["host"]))
+    else:
+        reports = reports.assign(site=reports["host"])
+
+    columns = {"runs" : ("wall", "size"), "wall_median" : ("wall", "median"), "wall_max" : ("wall", "max"),
+               "rss_quantile" : ("peak_rss", lambda x: np.quantile(x, quantile)), "rss_max" : ("peak_rss", "max")}
+    for rate in ["events_per_s", "rows_per_s", "bytes_per_s"]:
+        if rate in reports:
+            columns[rate] = (rate, "median")
+
+    table  = reports.groupby(["report", "site", "stage"]).agg(**columns).reset_index()
+    totals = reports[reports["stage"] == "total"]
+    memory = (totals.groupby("report")["peak_rss"].quantile(quantile) * margin).apply(np.ceil)
+    return table, memory
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarise the JSON-lines run reports of a set of jobs")
+    parser.add_argument("files", nargs="+", help="condor .out files or report files")
+    parser.add_argument("--quantile", default=0.99, type=float, help="quantile of the peak RSS to cover")
+    parser.add_argument("--margin"  , default=1.2 , type=float, help="factor on the peak RSS for request_memory")
+    args = parser.parse_args()
+
+    reports = read_reports(args.files)
+    if reports.empty:
+        sys.exit("No reports found")
+
+    table, memory = summary(reports, args.quantile, args.margin)
+    print(table.to_string(index=False, float_format=lambda x: f"{x:.3g}"))
+
+    print()
+    for name, mb in memory.items():
+        print(f"{name}: request_memory = {mb:.0f}MB covers {100*args.quantile:.0f}% of the runs "
+              f"(max {reports[(reports['report'] == name) & (reports['stage'] == 'total')]['peak_rss'].max():.0f}MB)")
@@ -0,0 +1,86 @@
+'''
+Sparse layout of the light table.
+
+Only the (sensor, voxel) cells with entries are written, sorted by sensor
+as in a CSR matrix with one row per sensor and one column per (x, y, z)
+voxel. Voxels outside the active region (see lt_binning.active_mask and
+LTAccumulator.apply_mask) or never reached by an event take no space, which
+matters for the SiPM tables where most cells are empty.
+
+Layout of the group (LT_sparse by default):
+indptr [sensor + 1]   the cells of sensor i are indptr[i]:indptr[i+1]
+voxel [cell]          flat voxel index (ix*ny + iy)*nz + iz
+value, error, entries [cell]  as in LT_dense
+mask [x, y]           voxels kept by the geometry mask
+xbins, ybins, zbins, xbins_centre, ybins_centre, zbins_centre, sensor_ids
+
+For S2 the z axis has a single bin, as in LT_dense.
+'''
+
+import numpy  as np
+import tables as tb
+
+from lt_dense import axes
+
+
+def sparse_tables(acc):
+    '''
+    indptr, voxel, value, error and entries of the filled cells.
+    '''
+    nsensors = len(acc.sensorids)
+    N        = acc.N.reshape(nsensors, -1)
+    isns, voxel = np.nonzero(N)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        value = acc.mean.reshape(nsensors, -1)[isns, voxel]
+        error = 100 * acc.std().reshape(nsensors, -1)[isns, voxel] / value
+
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(isns, minlength=nsensors))])
+    return indptr, voxel, value, error, N[isns, voxel]
+
+
+def write_sparse(h5out, acc, signal_type, config, group="LT_sparse", filters=None):
+    '''
+    Write the sparse layout of the accumulators to an open PyTables file.
+    config is the (parameter, value) dataframe saved in LT/Config.
+    '''
+    if signal_type == "S2":
+        acc = acc.collapse_z()
+
+    if filters is None:
+        filters = tb.Filters(complevel=5, complib="zlib", shuffle=True)
+
+    indptr, voxel, value, error, entries = sparse_tables(acc)
+    mask = acc.mask if acc.mask is not None else np.ones(acc.shape[1:3], dtype=bool)
+
+    grp = h5out.create_group("/", group, createparents=True)
+
+    h5out.create_array(grp, "indptr", obj=indptr.astype(np.int64))
+    for name, arr in [("voxel"  , voxel.astype(np.int32)),
+                      ("value"  , value),
+                      ("error"  , error),
+                      ("entries", entries.astype(np.int32))]:
+        # Empty tables cannot be chunked
+        if len(arr):
+            h5out.create_carray(grp, name, obj=arr, filters=filters)
+        else:
+            h5out.create_array(grp, name, obj=arr)
+
+    h5out.create_array(grp, "mask", obj=mask)
+    for name in axes:
+        h5out.create_array(grp, name, obj=getattr(acc.binning, name))
+    h5out.create_array(grp, "sensor_ids", obj=np.asarray(acc.sensorids))
+
+    for par, val in zip(config["parameter"], config["value"]):
+        grp._v_attrs[par] = val
+    grp._v_attrs["dims"] = "sensor, voxel"
+
+
+def read_sparse(grp, name="value"):
+    '''
+    Sensor position, voxel index and the name array (value, error or
+    entries) of the filled cells of an LT_sparse group.
+    '''
+    indptr = grp.indptr.read()
+    isns   = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    return isns, grp.voxel.read().astype(np.int64), getattr(grp, name).read()
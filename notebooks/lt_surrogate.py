@@ -0,0 +1,311 @@
+'''
+Smooth analytic surrogate of a light table for fast evaluation.
+
+The response of each sensor is fitted with a tensor product of Chebyshev
+polynomials in x, y and z (degree 0 in z for S2) over the table volume,
+by least squares on the log of the bin means (so the surrogate stays
+positive and the relative deviations are fitted, as the response falls by
+orders of magnitude away from the sensor) weighted with sqrt(entries). The bins
+filled for every sensor share the weights, so all the sensors are fitted
+with one solve (a sensor with other bins filled is fitted on its own).
+The coefficients of all the sensors (a few hundred per sensor) are
+written to a small file and evaluated for batches of points with matrix
+products, without a table in memory.
+
+The fit is checked against the table, per sensor:
+chi2_ndf      chi2 of the fit with the error of the bin means over the degrees of freedom
+within_error  fraction of the bins where the fit is within the per-event spread (LT/Error)
+rms_rel       rms of (fit - table)/table
+max_rel       largest |fit - table|/table
+The empty corners of the grid (outside Active_r) have no bins, so the fit
+there is an extrapolation and should not be used.
+
+To run:
+python lt_surrogate.py fit NEXT100-MC_S1_LT.h5 NEXT100-MC_S1_surrogate.h5 --degree 6 6 6
+python lt_surrogate.py bench NEXT100-MC_S1_surrogate.h5 NEXT100-MC_S1_LT.h5 --npoints 1000 100000
+
+Usage:
+sur = read_surrogate("NEXT100-MC_S1_surrogate.h5")
+values, total = sur.query(x, y, z)
+
+as LightTable.query: one column per sensor (sur.sensor_ids) and NaN
+outside the table volume.
+'''
+
+import sys
+import time
+import argparse
+import numpy  as np
+import tables as tb
+
+from numpy.polynomial import chebyshev
+
+from lt_dense import dense_tables
+from lt_table import LightTable
+
+# Points evaluated at once, bounds the (points, z degree, sensors) products
+batch_size = 2**13
+
+check_columns = ["chi2_ndf", "within_error", "rms_rel", "max_rel"]
+
+
+def scale(values, domain):
+    # Map [a, b] onto the Chebyshev interval [-1, 1]
+    a, b = domain
+    return (2*values - (a + b)) / (b - a)
+
+
+class Surrogate:
+    '''
+    Chebyshev coefficients (sensor, x degree, y degree, z degree) of each
+    sensor over domain ((xmin, xmax), (ymin, ymax), (zmin, zmax)).
+    '''
+    def __init__(self, coef, domain, sensor_ids, log=True):
+        self.coef       = np.asarray(coef)
+        self.domain     = np.asarray(domain, dtype=float)
+        self.sensor_ids = np.asarray(sensor_ids)
+        self.log        = log
+
+        # (x, y) coefficients by (z, sensor), for one matrix product per batch
+        nsensors, nx, ny, nz = self.coef.shape
+        self._xy = np.ascontiguousarray(self.coef.transpose(1, 2, 3, 0).reshape(nx*ny, nz*nsensors))
+
+    @property
+    def degree(self):
+        return tuple(n - 1 for n in self.coef.shape[1:])
+
+    def query(self, x, y, z=None):
+        '''
+        Response of each sensor (npoints, nsensors) and the total
+        (npoints,) at the given points.
+        '''
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        z = np.full_like(x, self.domain[2].mean()) if z is None else np.asarray(z, dtype=float)
+
+        dx, dy, dz = self.degree
+        nsensors   = len(self.sensor_ids)
+        out        = np.empty((len(x), nsensors))
+
+        for start in range(0, len(x), batch_size):
+            sl = slice(start, start + batch_size)
+            tx = chebyshev.chebvander(scale(x[sl], self.domain[0]), dx)
+            ty = chebyshev.chebvander(scale(y[sl], self.domain[1]), dy)
+            tz = chebyshev.chebvander(scale(z[sl], self.domain[2]), dz)
+
+            txy = (tx[:, :, None] * ty[:, None, :]).reshape(len(tx), -1)
+            hz  = (txy @ self._xy).reshape(len(tx), dz + 1, nsensors)
+            out[sl] = np.einsum("pk,pks->ps", tz, hz)
+
+        if self.log:
+            np.exp(out, out=out)
+
+        outside = np.zeros(len(x), dtype=bool)
+        for values, (a, b) in zip([x, y, z], self.domain):
+            outside |= (values < a) | (values > b)
+        out[outside] = np.nan
+
+        return out, out.sum(axis=1)
+
+
+def solve(v, values, w, ridge):
+    '''
+    Weighted least squares coefficients (coefficient, sensor) of the
+    values (bin, sensor) in the basis v (bin, coefficient).
+    '''
+    a = v * w[:, None]
+    b = values * w[:, None]
+
+    # A small ridge keeps the coefficients bounded where the bins are few
+    lam = ridge * np.linalg.norm(a, ord=2)
+    a   = np.vstack([a, lam * np.eye(v.shape[1])])
+    b   = np.vstack([b, np.zeros((v.shape[1], b.shape[1]))])
+    return np.linalg.lstsq(a, b, rcond=None)[0]
+
+
+def fit_surrogate(value, error, entries, bins, sensor_ids, degree=(6, 6, 6), ridge=1e-6, log=True):
+    '''
+    Surrogate of the dense (x, y, z, sensor) value, error (100*std/mean)
+    and entries arrays, with bins the (xbins, ybins, zbins) edges. The
+    degrees are capped to the number of bins minus one. With log the log
+    of the response is fitted (the empty bins of a sensor are left out).
+    Returns the surrogate and the checks of each sensor (dict of arrays).
+    '''
+    nx, ny, nz, nsensors = value.shape
+    degree = tuple(min(d, n - 1) for d, n in zip(degree, (nx, ny, nz)))
+    domain = np.array([[b[0], b[-1]] for b in bins])
+
+    # Basis of the bin centres, (x, y, z) flattened as the arrays
+    centres = [0.5*(b[1:] + b[:-1]) for b in bins]
+    v = chebyshev.chebvander3d(*np.meshgrid(*[scale(c, d) for c, d in zip(centres, domain)], indexing="ij"), degree)
+    v = v.reshape(nx*ny*nz, -1)
+
+    value   = value  .reshape(-1, nsensors)
+    entries = entries.reshape(-1, nsensors)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        spread = np.abs(value * error.reshape(-1, nsensors) / 100)
+        sigma  = spread / np.sqrt(entries)
+
+    coef   = np.zeros((nsensors,) + tuple(d + 1 for d in degree))
+    checks = {c : np.full(nsensors, np.nan) for c in check_columns}
+
+    filled = np.isfinite(value) & (entries > 0)
+    if log:
+        filled &= value > 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        target = np.log(value) if log else value
+
+    common = filled.all(axis=1)
+    w      = np.sqrt(entries.max(axis=1))
+
+    shared = np.flatnonzero((filled == common[:, None]).all(axis=0))
+    if common.sum() > v.shape[1] and len(shared):
+        coef[shared] = solve(v[common], target[common][:, shared], w[common], ridge).T.reshape((len(shared),) + coef.shape[1:])
+
+    for s in range(nsensors):
+        fill = filled[:, s]
+        if fill.sum() <= v.shape[1]:
+            continue
+
+        if s not in shared:
+            coef[s] = solve(v[fill], target[fill, s, None], w[fill], ridge)[:, 0].reshape(coef.shape[1:])
+
+        fit = v[fill] @ coef[s].reshape(-1)
+        fit = np.exp(fit) if log else fit
+        res = fit - value[fill, s]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rel = res / value[fill, s]
+            checks["chi2_ndf"]    [s] = np.nansum((res / sigma[fill, s])[sigma[fill, s] > 0]**2) / (fill.sum() - v.shape[1])
+            checks["within_error"][s] = np.mean(np.abs(res) <= spread[fill, s])
+            checks["rms_rel"]     [s] = np.sqrt(np.nanmean(rel[np.isfinite(rel)]**2))
+            checks["max_rel"]     [s] = np.nanmax(np.abs(rel[np.isfinite(rel)]))
+
+    return Surrogate(coef, domain, sensor_ids, log), checks
+
+
+def fit_accumulator(acc, degree=(6, 6, 6), ridge=1e-6, log=True):
+    '''
+    Surrogate of the mean charge of an LTAccumulator (collapse it first for S2).
+    '''
+    value, error, entries = dense_tables(acc)
+    bins = (acc.binning.xbins, acc.binning.ybins, acc.binning.zbins)
+    return fit_surrogate(value, error, entries, bins, acc.sensorids, degree, ridge, log)
+
+
+def fit_table(filename, degree=(6, 6, 6), ridge=1e-6, log=True, group="LT_dense"):
+    '''
+    Surrogate of the LT_dense arrays of a light table file.
+    '''
+    with tb.open_file(filename, "r") as h5in:
+        grp   = h5in.get_node(f"/{group}")
+        value = grp.value.read()
+        error = grp.error.read()
+        N     = grp.entries.read()
+        bins  = (grp.xbins.read(), grp.ybins.read(), grp.zbins.read())
+        ids   = grp.sensor_ids.read()
+        attrs = {name : grp._v_attrs[name] for name in grp._v_attrs._f_list("user")}
+
+    return (*fit_surrogate(value, error, N, bins, ids, degree, ridge, log), attrs)
+
+
+def write_surrogate(filename, sur, checks, attrs=None, group="surrogate"):
+    with tb.open_file(filename, "w") as h5out:
+        grp = h5out.create_group("/", group)
+        h5out.create_array(grp, "coef"      , obj=sur.coef)
+        h5out.create_array(grp, "domain"    , obj=sur.domain)
+        h5out.create_array(grp, "sensor_ids", obj=sur.sensor_ids)
+        for name in check_columns:
+            h5out.create_array(grp, name, obj=checks[name])
+
+        for par, val in (attrs or {}).items():
+            grp._v_attrs[par] = val
+        grp._v_attrs["degree"] = " ".join(map(str, sur.degree))
+        grp._v_attrs["log"]    = int(sur.log)
+        grp._v_attrs["dims"]   = "sensor, x degree, y degree, z degree"
+
+
+def read_surrogate(filename, group="surrogate"):
+    with tb.open_file(filename, "r") as h5in:
+        grp = h5in.get_node(f"/{group}")
+        return Surrogate(grp.coef.read(), grp.domain.read(), grp.sensor_ids.read(), bool(grp._v_attrs["log"]))
+
+
+def read_checks(filename, group="surrogate"):
+    with tb.open_file(filename, "r") as h5in:
+        grp = h5in.get_node(f"/{group}")
+        return {name : getattr(grp, name).read() for name in check_columns}
+
+
+def print_checks(sensor_ids, checks, stream=sys.stdout):
+    stream.write(f"{'sensor':>8} " + " ".join(f"{c:>12}" for c in check_columns) + "\n")
+    for i, sid in enumerate(sensor_ids):
+        stream.write(f"{sid:>8} " + " ".join(f"{checks[c][i]:12.4g}" for c in check_columns) + "\n")
+    stream.write(f"{'median':>8} " + " ".join(f"{np.nanmedian(checks[c]):12.4g}" for c in check_columns) + "\n")
+
+
+def bench(sur, table, sizes, repeat=5, rng=None):
+    '''
+    Throughput of the surrogate and of LightTable.query (nearest and
+    linear) for batches of random points in the table volume.
+    '''
+    rng = rng or np.random.default_rng(0)
+    with LightTable(table) as lt:
+        lt.shape # opens the table
+        lo = [lt.xbins_centre[0], lt.ybins_centre[0], lt.zbins_centre[0]]
+        hi = [lt.xbins_centre[-1], lt.ybins_centre[-1], lt.zbins_centre[-1]]
+
+        for npoints in sizes:
+            # Points in the filled part of the table
+            x, y, z = [rng.uniform(a, b, 4*npoints) for a, b in zip(lo, hi)]
+            inside  = np.flatnonzero(lt.query(x, y, z)[1] > 0)[:npoints]
+            x, y, z = x[inside], y[inside], z[inside]
+            calls   = {"surrogate" : lambda: sur.query(x, y, z),
+                       "nearest"   : lambda: lt.query(x, y, z, method="nearest"),
+                       "linear"    : lambda: lt.query(x, y, z, method="linear")}
+
+            for name, call in calls.items():
+                call() # warm up the slab cache
+                times = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    call()
+                    times.append(time.perf_counter() - start)
+                print(f"{npoints:8d} points {name:9s}: {1e3*np.median(times):9.3f} ms, "
+                      f"{npoints/np.median(times):.3g} points/s")
+
+            linear, _ = lt.query(x, y, z, method="linear")
+            values, _ = sur.query(x, y, z)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                rel = np.abs(values - linear) / linear
+            print(f"{npoints:8d} points surrogate vs linear: median |rel| {np.nanmedian(rel[np.isfinite(rel)]):.3g}, "
+                  f"90% {np.nanpercentile(rel[np.isfinite(rel)], 90):.3g}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit and evaluate smooth surrogates of the light tables")
+    sub    = parser.add_subparsers(dest="command", required=True)
+
+    fit = sub.add_parser("fit", help="fit the LT_dense arrays of a table")
+    fit.add_argument("table")
+    fit.add_argument("output")
+    fit.add_argument("--degree", default=[6, 6, 6], type=int, nargs=3, metavar=("DX", "DY", "DZ"))
+    fit.add_argument("--ridge" , default=1e-6, type=float)
+    fit.add_argument("--linear", action="store_true", help="fit the response instead of its log")
+
+    ben = sub.add_parser("bench", help="time the surrogate against the table queries")
+    ben.add_argument("surrogate")
+    ben.add_argument("table")
+    ben.add_argument("--npoints", default=[1000, 100000], type=int, nargs="+")
+
+    args = parser.parse_args()
+
+    if args.command == "fit":
+        start = time.perf_counter()
+        sur, checks, attrs = fit_table(args.table, tuple(args.degree), args.ridge, not args.linear)
+        write_surrogate(args.output, sur, checks, attrs)
+        print_checks(sur.sensor_ids, checks)
+        print(f"Fitted degree {sur.degree} for {len(sur.sensor_ids)} sensors in {time.perf_counter() - start:.1f} s, "
+              f"{sur.coef.nbytes/1024:.0f} kB of coefficients written to {args.output}")
+
+    elif args.command == "bench":
+        bench(read_surrogate(args.surrogate), args.table, args.npoints)
@@ -0,0 +1,180 @@
+'''
+Synthetic nexus files for testing and benchmarking the light table
+scripts without the cluster.
+
+The files have the layout written by compress_files.py: MC/configuration
+(with num_events and /Generator/ScintGenerator/nphotons), MC/particles,
+MC/sns_response (table format) and MC/sns_positions. The sensors follow the NEXT100 numbering,
+60 PMTs with ids 0-59 and 56 boards of 64 SiPMs with ids
+board*1000 + channel.
+
+The charges are Poisson numbers of photoelectrons, with a mean that falls
+with the distance from the emission point, spread over a few time bins:
+- S1: emission points uniform in the active cylinder, every PMT sees
+  light and only the SiPMs close to the point see a few photoelectrons
+- S2: emission points in the EL gap, the SiPMs under the point see most
+  of the light
+so the number of rows per event is close to the real files.
+
+To run:
+python lt_synthetic.py <directory> --nfiles 10 --nevents 100 --signal-type S1
+'''
+
+import os
+import argparse
+import numpy  as np
+import pandas as pd
+
+pmt_name  = "PmtR11410"
+sipm_name = "SiPM"
+
+Active_r   = 492 # mm
+Active_z   = 1190 # mm
+EL_GAP     = 10.0 # mm
+SiPM_Pitch = 15.55 # mm
+
+# Photoelectrons seen by a sensor close to the emission point per photon
+# emitted, and the distance (mm) over which it falls for the SiPMs
+pmt_yield  = {"S1" : 1e-4, "S2" : 1e-4}
+sipm_yield = {"S1" : 1e-7, "S2" : 2e-4}
+sipm_scale = {"S1" : 100 , "S2" : 10}
+
+# Time bins the charge of a sensor is spread over
+pmt_time_bins  = {"S1" : 5, "S2" : 40}
+sipm_time_bins = {"S1" : 1, "S2" : 2}
+
+
+def make_sensors():
+    '''
+    sns_positions table of the PMTs (on rings in the energy plane) and
+    the SiPMs (square grid in the tracking plane).
+    '''
+    rings  = [(1, 0), (6, 120), (12, 240), (18, 360), (23, 460)]
+    angles = np.concatenate([np.arange(n) * 2*np.pi/n for n, _ in rings])
+    radii  = np.concatenate([np.full(n, r) for n, r in rings])
+
+    pmts = pd.DataFrame({"sensor_id"   : np.arange(len(radii)),
+                         "sensor_name" : pmt_name,
+                         "x"           : radii * np.cos(angles),
+                         "y"           : radii * np.sin(angles),
+                         "z"           : -Active_z - 100.})
+
+    # The SiPMs closest to the axis, board by board
+    grid = np.arange(-32, 32) * SiPM_Pitch + SiPM_Pitch/2
+    x, y = [a.ravel() for a in np.meshgrid(grid, grid, indexing="ij")]
+    keep = np.argsort(x**2 + y**2, kind="stable")[:56*64]
+    x, y = x[keep], y[keep]
+
+    order = np.lexsort((y, x))
+    ids   = (1 + np.arange(len(keep)) // 64) * 1000 + np.arange(len(keep)) % 64
+
+    sipms = pd.DataFrame({"sensor_id"   : ids,
+                          "sensor_name" : sipm_name,
+                          "x"           : x[order],
+                          "y"           : y[order],
+                          "z"           : EL_GAP})
+
+    return pd.concat([pmts, sipms], ignore_index=True)
+
+
+def make_particles(rng, nevents, first_event, signal_type):
+    # One emission point per event, uniform in the active cylinder or the EL gap
+    r   = Active_r * np.sqrt(rng.uniform(0, 1, nevents))
+    phi = rng.uniform(0, 2*np.pi, nevents)
+    z   = rng.uniform(0, Active_z, nevents) if signal_type == "S1" else rng.uniform(-EL_GAP, 0, nevents)
+
+    return pd.DataFrame({"event_id"    : np.arange(first_event, first_event + nevents),
+                         "particle_id" : 1,
+                         "initial_x"   : r * np.cos(phi),
+                         "initial_y"   : r * np.sin(phi),
+                         "initial_z"   : z})
+
+
+def make_response(rng, particles, sensors, nphotons, signal_type):
+    '''
+    sns_response rows (event_id, sensor_id, time_bin, charge) for the
+    events of particles.
+    '''
+    x = particles["initial_x"].values[:, None]
+    y = particles["initial_y"].values[:, None]
+    z = particles["initial_z"].values[:, None]
+
+    sx, sy, sz = [sensors[c].values[None, :] for c in ["x", "y", "z"]]
+    is_pmt     = (sensors["sensor_name"] == pmt_name).values[None, :]
+
+    # Mean number of photoelectrons of each (event, sensor)
+    d2_pmt  = (sx - x)**2 + (sy - y)**2 + (sz - z)**2
+    d2_sipm = (sx - x)**2 + (sy - y)**2
+    mu = np.where(is_pmt,
+                  nphotons * pmt_yield [signal_type] * 1e6 / (1e6 + d2_pmt),
+                  nphotons * sipm_yield[signal_type] * np.exp(-np.sqrt(d2_sipm) / sipm_scale[signal_type]))
+
+    npes        = rng.poisson(mu)
+    ievt, isens = np.nonzero(npes)
+    npes        = npes[ievt, isens]
+
+    # Spread the photoelectrons of each sensor over consecutive time bins
+    nbins = np.where(is_pmt[0, isens], pmt_time_bins[signal_type], sipm_time_bins[signal_type])
+    pe    = np.repeat(np.arange(len(npes)), npes)
+    tbin  = (rng.uniform(0, 1, len(pe)) * nbins[pe]).astype(np.int64)
+
+    key, charge = np.unique(pe * nbins.max() + tbin, return_counts=True)
+    row, tbin   = key // nbins.max(), key % nbins.max()
+    t0          = rng.integers(0, 50, len(npes))
+
+    return pd.DataFrame({"event_id"  : particles["event_id"].values[ievt[row]],
+                         "sensor_id" : sensors["sensor_id"].values[isens[row]],
+                         "time_bin"  : t0[row] + tbin,
+                         "charge"    : charge})
+
+
+def write_file(filename, nevents, signal_type, seed, nphotons=1000000, first_event=0):
+    '''
+    Write one synthetic file. Returns the number of sns_response rows.
+    '''
+    rng       = np.random.default_rng(seed)
+    sensors   = make_sensors()
+    particles = make_particles(rng, nevents, first_event, signal_type)
+    response  = make_response(rng, particles, sensors, nphotons, signal_type)
+
+    configuration = pd.DataFrame({"param_key"   : ["num_events", "/Generator/ScintGenerator/nphotons", "/nexus/random_seed"],
+                                  "param_value" : [str(nevents), str(nphotons), str(seed)]})
+
+    # Same settings as compress_files.py
+    with pd.HDFStore(filename, mode='w', complevel=5, complib='zlib') as store:
+        store.append('MC/configuration', configuration, format='table', expectedrows=len(configuration))
+        store.append('MC/particles'    , particles    , format='table', expectedrows=len(particles))
+        store.append('MC/sns_response' , response     , format='table', expectedrows=len(response))
+        store.append('MC/sns_positions', sensors      , format='table', expectedrows=len(sensors))
+
+    return len(response)
+
+
+def make_files(directory, nfiles, nevents, signal_type, seed=0, nphotons=1000000):
+    '''
+    nfiles files of nevents events in directory, numbered like the job
+    outputs (different seeds and event ids per file). Files already there
+    are kept.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    filenames = []
+    for jobid in range(nfiles):
+        filename = os.path.join(directory, f"NEXUS_OUTPUT_{jobid}.h5")
+        if not os.path.exists(filename):
+            write_file(filename, nevents, signal_type, seed + jobid, nphotons, first_event=nevents*jobid)
+        filenames.append(filename)
+    return filenames
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic nexus files for the light tables")
+    parser.add_argument("directory")
+    parser.add_argument("--nfiles"     , default=10    , type=int)
+    parser.add_argument("--nevents"    , default=100   , type=int)
+    parser.add_argument("--nphotons"   , default=1000000, type=int)
+    parser.add_argument("--signal-type", default="S1"  , choices=["S1", "S2"])
+    parser.add_argument("--seed"       , default=0     , type=int)
+    args = parser.parse_args()
+
+    filenames = make_files(args.directory, args.nfiles, args.nevents, args.signal_type, args.seed, args.nphotons)
+    print(f"{len(filenames)} files in {args.directory}")
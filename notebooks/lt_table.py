@@ -0,0 +1,209 @@
+'''
+Reader for the light table files with batched nearest or trilinear
+queries, from LT_dense (slab by slab through an LRU cache of max_memory
+MB), LT_sparse or LT/LightTable. Points outside the table get NaN.
+
+Usage:
+with LightTable("NEXT100-MC_S1_LT.h5") as lt:
+    values, total = lt.query(x, y, z, method="linear")
+'''
+
+from collections import OrderedDict
+
+import numpy  as np
+import pandas as pd
+import tables as tb
+
+from lt_binning import bin_index
+from lt_sparse  import read_sparse
+
+
+class LightTable:
+
+    def __init__(self, filename, group="LT_dense", max_memory=200, fill_value=0.):
+        self.filename    = filename
+        self.group       = group
+        self.max_memory  = max_memory # MB of z slabs kept in the cache
+        self.fill_value  = fill_value
+
+        self._h5     = None
+        self._array  = None # whole table when read from LT/LightTable
+        self._sparse = None # cells sorted by z bin when read from LT_sparse
+        self._cache  = OrderedDict()
+        self.hits    = 0
+        self.misses  = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
+        self._cache.clear()
+
+    def _open(self):
+        if self._h5 is not None or self._array is not None or self._sparse is not None:
+            return
+
+        h5 = tb.open_file(self.filename, "r")
+        for group in [self.group, "LT_sparse"]:
+            if f"/{group}" in h5:
+                break
+        else:
+            h5.close()
+            self._from_frame(pd.read_hdf(self.filename, "LT/LightTable"))
+            return
+
+        grp = h5.get_node(f"/{group}")
+        self.sensor_ids   = grp.sensor_ids.read()
+        self.xbins        = grp.xbins.read()
+        self.ybins        = grp.ybins.read()
+        self.zbins        = grp.zbins.read()
+        self.xbins_centre = grp.xbins_centre.read()
+        self.ybins_centre = grp.ybins_centre.read()
+        self.zbins_centre = grp.zbins_centre.read()
+
+        if "indptr" in grp:
+            self._from_sparse(grp)
+            h5.close()
+        else:
+            self._h5    = h5
+            self._value = grp.value
+
+    def _from_sparse(self, grp):
+        # Keep the cells in memory, grouped by z bin so each slab is one scatter
+        isns, voxel, value = read_sparse(grp)
+        nz    = len(self.zbins_centre)
+        iz    = voxel % nz
+        order = np.argsort(iz, kind="stable")
+
+        bounds = np.searchsorted(iz[order], np.arange(nz + 1))
+        self._sparse = (bounds, isns[order], voxel[order] // nz, value[order])
+
+    def _from_frame(self, df):
+        # Dense array from the pivoted table, the bins are rebuilt from the
+        # centres present (empty bins of the grid may be missing)
+        def centres(values):
+            values = np.unique(values.astype(float))
+            if len(values) == 1:
+                return values
+            width = np.diff(values).min()
+            return values[0] + width * np.arange(np.rint((values[-1] - values[0]) / width) + 1)
+
+        def edges(centres):
+            width = centres[1] - centres[0] if len(centres) > 1 else 1.
+            return np.append(centres - width/2, centres[-1] + width/2)
+
+        sensors = [c for c in df.columns if c not in ("x", "y", "z") and not c.endswith("_total")]
+        self.sensor_ids   = np.array([int(c.split("_")[-1]) for c in sensors])
+        self.xbins_centre = centres(df["x"].values)
+        self.ybins_centre = centres(df["y"].values)
+        self.zbins_centre = centres(df["z"].values) if "z" in df else np.array([0.])
+
+        self.xbins = edges(self.xbins_centre)
+        self.ybins = edges(self.ybins_centre)
+        self.zbins = edges(self.zbins_centre) if "z" in df else np.array([-np.inf, np.inf])
+
+        def nearest(values, centres):
+            return np.rint((values.astype(float) - centres[0]) / (centres[1] - centres[0])).astype(np.int64) \
+                   if len(centres) > 1 else np.zeros(len(values), dtype=np.int64)
+
+        ix = nearest(df["x"].values, self.xbins_centre)
+        iy = nearest(df["y"].values, self.ybins_centre)
+        iz = nearest(df["z"].values, self.zbins_centre) if "z" in df else 0
+
+        self._array = np.full((len(self.xbins_centre), len(self.ybins_centre),
+                               len(self.zbins_centre), len(sensors)), np.nan)
+        self._array[ix, iy, iz] = df[sensors].values
+
+    @property
+    def shape(self):
+        self._open()
+        return (len(self.xbins_centre), len(self.ybins_centre), len(self.zbins_centre), len(self.sensor_ids))
+
+    def slab(self, iz):
+        '''
+        (x*y, sensor) values of z bin iz, through the LRU cache.
+        '''
+        self._open()
+        if iz in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(iz)
+            return self._cache[iz]
+
+        self.misses += 1
+        if self._sparse is not None:
+            bounds, isns, ixy, value = self._sparse
+            sl   = slice(bounds[iz], bounds[iz+1])
+            slab = np.full((len(self.xbins_centre) * len(self.ybins_centre), len(self.sensor_ids)), self.fill_value)
+            slab[ixy[sl], isns[sl]] = value[sl]
+        else:
+            slab = self._array[:, :, iz] if self._array is not None else self._value[:, :, iz, :]
+            slab = np.where(np.isnan(slab), self.fill_value, slab).reshape(-1, slab.shape[-1])
+
+        self._cache[iz] = slab
+        if len(self._cache) > max(1, int(self.max_memory * 2**20 / slab.nbytes)):
+            self._cache.popitem(last=False)
+        return slab
+
+    def _axis(self, values, centres):
+        # Lower neighbour and weight of the upper one for the interpolation
+        if len(centres) == 1:
+            return np.zeros(len(values), dtype=np.int64), np.zeros(len(values))
+
+        f  = (values - centres[0]) / (centres[1] - centres[0])
+        i0 = np.clip(np.floor(f), 0, len(centres) - 2).astype(np.int64)
+        return i0, np.clip(f - i0, 0, 1)
+
+    def query(self, x, y, z=None, method="nearest"):
+        '''
+        Response of each sensor (npoints, nsensors) and the total
+        (npoints,) at the given points.
+        '''
+        self._open()
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        z = np.zeros_like(x) if z is None or len(self.zbins_centre) == 1 else np.asarray(z, dtype=float)
+
+        ix = bin_index(x, self.xbins, self.xbins[0], self.xbins[1] - self.xbins[0])
+        iy = bin_index(y, self.ybins, self.ybins[0], self.ybins[1] - self.ybins[0])
+        iz = np.zeros(len(x), dtype=np.int64) if len(self.zbins_centre) == 1 else \
+             bin_index(z, self.zbins, self.zbins[0], self.zbins[1] - self.zbins[0])
+
+        inside = (ix >= 0) & (iy >= 0) & (iz >= 0)
+        out    = np.full((len(x), len(self.sensor_ids)), np.nan)
+
+        ny = len(self.ybins_centre)
+
+        if method == "nearest":
+            for k in np.unique(iz[inside]):
+                sel = np.flatnonzero(inside & (iz == k))
+                out[sel] = self.slab(k)[ix[sel] * ny + iy[sel]]
+
+        elif method == "linear":
+            ix0, tx = self._axis(x, self.xbins_centre)
+            iy0, ty = self._axis(y, self.ybins_centre)
+            iz0, tz = self._axis(z, self.zbins_centre)
+            ix1 = np.minimum(ix0 + 1, len(self.xbins_centre) - 1)
+            iy1 = np.minimum(iy0 + 1, ny - 1)
+
+            # The four (x, y) corners of each point and their weights
+            corners = np.stack([ix0*ny + iy0, ix1*ny + iy0, ix0*ny + iy1, ix1*ny + iy1], axis=1)
+            weights = np.stack([(1-tx)*(1-ty), tx*(1-ty), (1-tx)*ty, tx*ty], axis=1)
+
+            out[inside] = 0
+            for k in np.unique(iz0[inside]):
+                sel = np.flatnonzero(inside & (iz0 == k))
+                for dz, wz in [(0, 1 - tz[sel]), (1, tz[sel])]:
+                    if k + dz >= len(self.zbins_centre):
+                        continue
+                    s = self.slab(k + dz)
+                    out[sel] += np.einsum("pc,pcs->ps", wz[:, None] * weights[sel], s[corners[sel]])
+        else:
+            raise ValueError(f"Unknown method {method}, use nearest or linear")
+
+        return out, out.sum(axis=1)
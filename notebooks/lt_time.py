@@ -0,0 +1,160 @@
+'''
+Time-resolved light tables, accumulated in the same pass as the energy
+tables from the time_bin column of MC/sns_response.
+
+For each (sensor, event) pair the charge weighted mean and rms of the time
+bins are taken, and their mean and spread over the events of each sensor
+and voxel are kept in two dense accumulators (as the charge is). The time
+profile (mean fraction of the charge of a pair in each time bin, for the
+events where the sensor saw light) is kept sparse, as sums over the
+(cell, time bin) keys seen, so the memory follows the number of filled
+time bins and not ntime times the table size.
+
+The times are in time bins of the sensor, the width of a bin is set in
+the nexus config (/Geometry/PmtR11410/time_binning, 25 ns for the PMTs).
+
+Usage:
+acc = build_table(filenames, sensorids, binning, ntime=200)
+write_time(h5out, acc, signal_type, config)
+
+Layout of the group (LT_time by default):
+t_mean, t_mean_spread, t_width [x, y, z, sensor]   in time bins, NaN where empty
+entries [x, y, z, sensor]                          events with light in the sensor
+profile_sensor, profile_voxel, profile_time, profile_fraction
+                                                   sparse profile, voxel = (ix*ny + iy)*nz + iz
+xbins, ..., zbins_centre, sensor_ids
+'''
+
+import numpy  as np
+import tables as tb
+
+from lt_accumulator import LTAccumulator
+from lt_binning     import sum_keys
+from lt_dense       import axes
+
+# Number of pending profile entries before they are summed
+compact_size = 2**22
+
+
+class TimeAccumulator:
+    '''
+    Arrival time moments and sparse time profiles of each sensor and
+    voxel of an LTAccumulator.
+    '''
+    def __init__(self, sensorids, binning, ntime):
+        self.ntime   = ntime
+        self.tmean   = LTAccumulator(sensorids, binning)
+        self.twidth  = LTAccumulator(sensorids, binning)
+        self.keys    = np.zeros(0, dtype=np.int64) # cell * ntime + time bin
+        self.frac    = np.zeros(0)                 # summed charge fractions
+        self.pending = []
+
+    def add_pairs(self, cells, charge, times):
+        '''
+        Add the (sensor, event) pairs binned into cells, with the time sums
+        from lt_binning.sum_response.
+        '''
+        tmean = times["qt"] / charge
+        width = np.sqrt(np.maximum(times["qt2"] / charge - tmean**2, 0))
+        self.tmean .add(cells, tmean)
+        self.twidth.add(cells, width)
+
+        ipair, tbin, q = times["profile"]
+        c    = cells[ipair]
+        keep = c >= 0
+        self.pending.append((c[keep] * self.ntime + tbin[keep], q[keep] / charge[ipair[keep]]))
+
+        if sum(len(k) for k, _ in self.pending) > compact_size:
+            self.compact()
+
+    def compact(self):
+        if self.pending:
+            keys, frac = zip(*self.pending)
+            self.keys, self.frac = sum_keys(np.concatenate((self.keys,) + keys), np.concatenate((self.frac,) + frac))
+            self.pending = []
+
+    def merge(self, other):
+        self.tmean .merge(other.tmean)
+        self.twidth.merge(other.twidth)
+        other.compact()
+        self.pending.append((other.keys, other.frac))
+        self.compact()
+        return self
+
+    def apply_mask(self, mask):
+        self.tmean .apply_mask(mask)
+        self.twidth.apply_mask(mask)
+
+        self.compact()
+        _, nx, ny, nz = self.tmean.shape
+        ix   = self.keys // self.ntime // nz // ny % nx
+        iy   = self.keys // self.ntime // nz % ny
+        keep = self.tmean.mask[ix, iy]
+        self.keys, self.frac = self.keys[keep], self.frac[keep]
+        return self
+
+    def collapse_z(self):
+        '''
+        Combine all the z bins into one, as done for the S2 tables.
+        '''
+        self.compact()
+        out = TimeAccumulator(self.tmean.sensorids, self.tmean.binning, self.ntime)
+        out.tmean  = self.tmean .collapse_z()
+        out.twidth = self.twidth.collapse_z()
+
+        # The flat cell with one z bin is the cell divided by nz
+        nz   = self.tmean.shape[3]
+        cell = self.keys // self.ntime // nz
+        out.keys, out.frac = sum_keys(cell * self.ntime + self.keys % self.ntime, self.frac)
+        return out
+
+    def profile(self):
+        '''
+        Flat cell, time bin and mean charge fraction of the filled profile
+        bins.
+        '''
+        self.compact()
+        cell = self.keys // self.ntime
+        return cell, self.keys % self.ntime, self.frac / self.tmean.N.reshape(-1)[cell]
+
+
+def write_time(h5out, acc, signal_type, config, group="LT_time", filters=None):
+    '''
+    Write the time tables of an accumulator built with ntime to an open
+    PyTables file. config is the (parameter, value) dataframe saved in
+    LT/Config.
+    '''
+    time = acc.time.collapse_z() if signal_type == "S2" else acc.time
+
+    if filters is None:
+        filters = tb.Filters(complevel=5, complib="zlib", shuffle=True)
+
+    grp   = h5out.create_group("/", group, createparents=True)
+    order = (1, 2, 3, 0)
+
+    with np.errstate(invalid="ignore"):
+        arrays = {"t_mean"        : np.where(time.tmean .N > 0, time.tmean .mean, np.nan),
+                  "t_mean_spread" : time.tmean.std(),
+                  "t_width"       : np.where(time.twidth.N > 0, time.twidth.mean, np.nan),
+                  "entries"       : time.tmean.N.astype(np.int32)}
+
+    nx, ny, nz = time.tmean.shape[1:]
+    for name, arr in arrays.items():
+        h5out.create_carray(grp, name, obj=np.ascontiguousarray(arr.transpose(order)), filters=filters,
+                            chunkshape=(nx, ny, 1, len(time.tmean.sensorids)))
+
+    cell, tbin, fraction = time.profile()
+    h5out.create_carray(grp, "profile_sensor"  , obj=(cell // (nx*ny*nz)).astype(np.int32), filters=filters)
+    h5out.create_carray(grp, "profile_voxel"   , obj=cell % (nx*ny*nz), filters=filters)
+    h5out.create_carray(grp, "profile_time"    , obj=tbin.astype(np.int32), filters=filters)
+    h5out.create_carray(grp, "profile_fraction", obj=fraction, filters=filters)
+
+    for name in axes:
+        h5out.create_array(grp, name, obj=getattr(time.tmean.binning, name))
+    h5out.create_array(grp, "sensor_ids", obj=np.asarray(time.tmean.sensorids))
+
+    for par, val in zip(config["parameter"], config["value"]):
+        grp._v_attrs[par] = val
+    grp._v_attrs["table_type"] = "time"
+    grp._v_attrs["ntime"]      = time.ntime
+    grp._v_attrs["dims"]       = "x, y, z, sensor"
@@ -11,6 +11,11 @@ from invisible_cities.database  import load_db
 from invisible_cities.io.dst_io import load_dst
 from invisible_cities.io.dst_io import df_writer
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from lt_accumulator import LTAccumulator, make_binning
+from lt_binning     import bin_response
+from lt_io          import read_sns_response
+
 
 # Configure the script here
 signal_type = "S2"
@@ -69,8 +74,8 @@ xbins_centre = np.arange(xmin+xbw/2, xmax+xbw/2, xbw)
 ybins_centre = xbins_centre
 zbins_centre = np.arange(zmin+zbw/2, zmax+zbw/2, zbw)
 
-LT  = pd.DataFrame()
-ERR = pd.DataFrame()
+# Running count, mean and M2 for each sensor and voxel
+acc = LTAccumulator(sensorids, make_binning(xmin, xmax, xbw, zmin, zmax, zbw))
 
 # Loop over the input files
 for i, filename in enumerate(lt_filenames, 0):
@@ -83,39 +88,19 @@ for i, filename in enumerate(lt_filenames, 0):
     nphotons   = int(configuration.loc["/Generator/ScintGenerator/nphotons"][0])
 
     # Load in the sensor data
-    sns_response  = pd.read_hdf(filename, "MC/sns_response")
-    pmt_response  = sns_response[np.isin(sns_response["sensor_id"].values, datapmt["SensorID"].values)]
-    
-    # Get the total charge over all time bins by summing
-    pmt_response = pmt_response.groupby(["sensor_id", "event_id"])["charge"].sum().to_frame().reset_index()
+    sns_response  = read_sns_response(filename, sensorids)
 
     # Load in the MC Particles
     parts = pd.read_hdf(filename, 'MC/particles')
     parts = parts[['event_id', 'initial_x', 'initial_y', 'initial_z']]
 
-    # Merge the dataframes
-    pmt_response = pmt_response.merge(parts, on="event_id", how = 'inner')
-
-    # Now bin the x, y, z positions
-    pmt_response['x'] = pd.cut(x=pmt_response['initial_x'], bins=xbins,labels=xbins_centre, include_lowest=True)
-    pmt_response['y'] = pd.cut(x=pmt_response['initial_y'], bins=ybins,labels=ybins_centre, include_lowest=True)
-    pmt_response['z'] = pd.cut(x=pmt_response['initial_z'], bins=zbins,labels=zbins_centre, include_lowest=True)
-
-    # remove the initial x,y,z since we are done with them
-    pmt_response = pmt_response.drop(columns=['initial_x', 'initial_y', 'initial_z'])
-
-    # Normalise the charge in each PMT by the total number of photons simulated
-    pmt_response['charge'] = pmt_response['charge']/nphotons
-    
-    # Add the dataframe
-    LT  = pd.concat([LT , pmt_response])
-    ERR = pd.concat([ERR, pmt_response])
-
-# Get the mean charge collected in each sensor for a given voxel across all events
-lt = LT.groupby(["sensor_id", "x", "y", "z"])["charge"].mean().to_frame().reset_index()
+    # Filter the PMTs, sum over the time bins, add the x, y, z positions, bin them
+    # and normalise the charge by the number of photons simulated
+    cells, charge = bin_response(sns_response, parts, nphotons, acc)
+    acc.add(cells, charge)
 
-# STD of the total charge collected in each sensor for a given voxel across all events
-err = LT.groupby(["sensor_id", "x", "y", "z"])["charge"].std().to_frame().reset_index()
+# Mean and STD of the total charge collected in each sensor for a given voxel across all events
+lt, err = acc.aggregate("S1")
 
 # Calculate error values
 err['charge'] = 100*err['charge']/lt['charge']
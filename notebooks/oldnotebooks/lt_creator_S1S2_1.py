@@ -6,8 +6,10 @@ import numpy  as np
 import pandas as pd
 import tables as tb
 
-from invisible_cities.database  import load_db
-from invisible_cities.io.dst_io import df_writer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from lt_accumulator import make_binning
+from lt_parallel    import fold_shard
+from lt_detdb       import load_table
 
 # Takes in the slim file format
 
@@ -42,8 +44,9 @@ else:
 
 
 # create config which will be saved to the file
-config = { "parameter" : ["detector",  "ACTIVE_rad", "EL_GAP"   , "table_type","signal_type","sensor","pitch_x"       ,"pitch_y", "nexus"], 
-                "value": [detector_db, str(Active_r),str(EL_GAP), "energy"     ,signal_type , pmt     ,str(SiPM_Pitch), str(SiPM_Pitch), "v7_08_00"]}
+config = { "parameter" : ["detector",  "ACTIVE_rad", "EL_GAP"   , "table_type","signal_type","sensor","pitch_x"       ,"pitch_y", "nexus", "binning"], 
+                "value": [detector_db, str(Active_r),str(EL_GAP), "energy"     ,signal_type , pmt     ,str(SiPM_Pitch), str(SiPM_Pitch), "v7_08_00",
+                          " ".join(str(b) for b in [xmin, xmax, xbw, zmin, zmax, zbw])]}
 
 config = pd.DataFrame.from_dict(config)
 
@@ -56,7 +59,7 @@ else:
 
 
 # Configure the detector database
-datapmt = load_db.DataPMT(detector_db, 0)
+datapmt = load_table(detector_db, "DataPMT")
 xpmt, ypmt = datapmt["X"].values, datapmt["Y"].values
 sensorids  = datapmt["SensorID"].values
 
@@ -72,55 +75,13 @@ zbins_centre = np.arange(zmin+zbw/2, zmax+zbw/2, zbw)
 # Load in the input file
 filename=sys.argv[1]
 
-# Load the MC Particle Tree to ger the intiial x, y, z positions sampled
-parts = pd.read_hdf(filename, 'MC/particles')
-parts = parts[['event_id', 'initial_x', 'initial_y', 'initial_z']]
+# Filter the PMTs, sum over the time bins, add the x, y, z positions, bin them
+# and normalise the charge by the number of photons simulated.
+# lt_partial.py does the same on the grid worker
+acc, nevents = fold_shard([filename], sensorids, make_binning(xmin, xmax, xbw, zmin, zmax, zbw), sum_z=False)
 
-# Get the metadata from the files
-configuration = pd.read_hdf(filename, "MC/configuration").set_index("param_key")
-num_events = int(configuration.loc["num_events"][0])
-nphotons   = int(configuration.loc["/Generator/ScintGenerator/nphotons"][0])
-
-# Get the sensor response information
-sns_response  = pd.read_hdf(filename, "MC/sns_response")
-pmt_response  = sns_response[np.isin(sns_response["sensor_id"].values, datapmt["SensorID"].values)]
-
-# Sum total charge over all time bins
-pmt_response = pmt_response.groupby(["sensor_id", "event_id"])["charge"].sum().to_frame().reset_index()
-
-# Merge the MC Particle and Sensor dataframes to add the x, y, z positions
-pmt_response = pmt_response.merge(parts, on="event_id", how = 'inner')
-
-# Now bin the x, y, z positions
-pmt_response['x'] = pd.cut(x=pmt_response['initial_x'], bins=xbins,labels=xbins_centre, include_lowest=True)
-pmt_response['y'] = pd.cut(x=pmt_response['initial_y'], bins=ybins,labels=ybins_centre, include_lowest=True)
-pmt_response['z'] = pd.cut(x=pmt_response['initial_z'], bins=zbins,labels=zbins_centre, include_lowest=True)
-
-# remove the initial x,y,z since we are done with them
-pmt_response = pmt_response.drop(columns=['initial_x', 'initial_y', 'initial_z'])
-
-# Normalise the charge in each PMT by the total number of photons simulated
-pmt_response['charge'] = pmt_response['charge']/nphotons
-
-
-# Get the count of entries
-lt_count = pmt_response.groupby(["sensor_id", "x", "y", "z"])["charge"].count().to_frame().reset_index()
-lt_count.rename(columns={'charge': 'N'}, inplace=True)
-
-# Get the sum
-lt_sum = pmt_response.groupby(["sensor_id", "x", "y", "z"])["charge"].sum().to_frame().reset_index()
-lt_sum.rename(columns={'charge': 'sum'}, inplace=True)
-
-# Get the sum of squares
-pmt_response['sum2'] = np.square(pmt_response['charge'])
-lt_sum_of_squares = pmt_response.groupby(["sensor_id", "x", "y", "z"])["sum2"].sum().to_frame().reset_index()
-
-# Merge the results from the sub-calculations
-LT = pd.merge(lt_count, lt_sum, on=["sensor_id", "x", "y","z"])
-LT = pd.merge(LT, lt_sum_of_squares, on=["sensor_id", "x", "y","z"])
-    
-# Consolodate the duplicate rows
-LT = LT.groupby(['sensor_id', 'x', 'y', 'z']).agg({'N': 'sum', 'sum': 'sum', 'sum2': 'sum'}).reset_index()
+# Get the count, sum and sum of squares of each sensor and voxel
+LT = acc.to_partial()
 
 print("Finished loading light-table")
 print("Aggregating light table...")
@@ -6,8 +6,11 @@ import numpy  as np
 import pandas as pd
 import tables as tb
 
-from invisible_cities.database  import load_db
-from invisible_cities.io.dst_io import df_writer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from lt_accumulator import LTAccumulator, make_binning
+from lt_binning     import bin_partial
+from lt_detdb       import load_table
+from lt_io          import partial_binning
 
 # Takes in the slim file format
 
@@ -18,26 +21,37 @@ detector_db = "next100"
 pmt = "PmtR11410"
 path_="../files/next100/NEXT100_S2_LT_Step1/"
 
+# Binning of the partials written before it was stored in their LT/Config
+if signal_type == "S1":
+    default_binning = [-500, 500, 20, 0, 510, 20]
+else:
+    default_binning = [-500, 500, 20, -12, 2, 1]
+
 # Load in the files -- configure the path
-column_arr = ["sensor_id", "x", "y", "z"]
 index_arr = ["x", "y", "z"]
 
 if signal_type == "S2":
     index_arr = ["x", "y"]
-    column_arr = ["sensor_id", "x", "y"]
 
 lt_dir = os.path.expandvars(path_)
 lt_filenames = glob.glob(os.path.join(lt_dir, "*.h5"))
 lt_filenames = sorted(lt_filenames)
 print(lt_filenames)
 
+# The binning of Step 1, the same for all the partials
+binnings = {tuple(b) for b in map(partial_binning, lt_filenames) if b is not None}
+if len(binnings) > 1:
+    raise ValueError(f"The partials were made with different binnings: {sorted(binnings)}")
+binning = list(binnings.pop()) if binnings else default_binning
+print(f"Binning (xmin, xmax, xbw, zmin, zmax, zbw): {binning}")
+
 # Configure the detector database
-datapmt = load_db.DataPMT(detector_db, 0)
+datapmt = load_table(detector_db, "DataPMT")
 xpmt, ypmt = datapmt["X"].values, datapmt["Y"].values
 sensorids  = datapmt["SensorID"].values
 
-LT  = pd.DataFrame()
-ERR = pd.DataFrame()
+# Dense count, mean and M2 for each sensor and voxel
+acc = LTAccumulator(sensorids, make_binning(*binning))
 
 for i, filename in enumerate(lt_filenames, 0):
     sys.stdout.write(f"Processing file {i}/{len(lt_filenames)} \r")
@@ -45,45 +59,24 @@ for i, filename in enumerate(lt_filenames, 0):
 
     # Get the metadata from the files
     config = pd.read_hdf(filename, "LT/Config")
-    lt     = pd.read_hdf(filename, "LT/LightTable")
+    lt     = pd.read_hdf(filename, "LT/LightTable", columns=['sensor_id', 'x', 'y', 'z', 'N', 'sum', 'sum2'])
 
-    # Add to the dataframe
-    LT  = pd.concat([LT , lt])
-    
-    # Consolodate the duplicate rows
-    LT = LT.groupby(['sensor_id', 'x', 'y', 'z']).agg({'N': 'sum', 'sum': 'sum', 'sum2': 'sum'}).reset_index()
-
-    
-# Consolodate the duplicate rows
-LT = LT.groupby(['sensor_id', 'x', 'y', 'z']).agg({'N': 'sum', 'sum': 'sum', 'sum2': 'sum'}).reset_index()
-ERR  = LT.copy(deep=True)
+    # Add the partial sums to the accumulators
+    acc.add_sums(bin_partial(lt, acc), lt["N"].values, lt["sum"].values, lt["sum2"].values)
 
 print("Finished loading light-table")
 print("Aggregating light table...")
 
 # LT: Sum the total charge collected in each sensor for a given voxel across all events and also over z in case of S2
 # ERR: std of the total charge collected in each sensor for a given voxel across all events also over z in case of S2
-
-# Main Light table
-lt = LT.groupby(column_arr).agg({'N': 'sum', 'sum': 'sum', 'sum2': 'sum'}).reset_index() # Sum over z values
-lt["mean"] = lt["sum"] / lt["N"]
+lt, err = acc.aggregate(signal_type, ddof=0)
 
 # Error
-err = ERR.groupby(column_arr).agg({'N': 'sum', 'sum': 'sum', 'sum2': 'sum'}).reset_index() # Sum over z values
-err["mean"] = err["sum"] / err["N"]
-err["std"] = 100*np.sqrt( (err.sum2/err.N - err["mean"]**2) )/err["mean"]
+err["charge"] = 100*err["charge"]/lt["charge"]
+err = err.rename(columns={"charge": "std"})
 
-print(lt[lt["sum"]>0])
-print(err[err["sum"]>0])
-
-lt = lt.drop(columns=['sum', 'sum2', 'N'])
-err = err.drop(columns=['sum', 'sum2', 'N', "mean"])
-
-lt['mean'].fillna(0, inplace=True)
-err['std'].fillna(0, inplace=True)
-
-# Renaming
-lt.rename(columns={'mean': 'charge'}, inplace=True)
+lt['charge'] = lt['charge'].fillna(0)
+err['std']   = err['std'].fillna(0)
 
 print(lt[lt.charge > 0].head(10))
 print(err[err["std"]>0].head(10))
@@ -113,6 +106,9 @@ ERR[pmt + f"_total"] = ERR.loc[:, ERR.columns.difference(index_arr)].sum(axis=1)
 # Save the table to an output file
 outfilename = f"NEXT100-MC_{signal_type}_LT.h5"
 
+# invisible_cities is only needed to write the tables
+from invisible_cities.io.dst_io import df_writer
+
 
 with tb.open_file(outfilename, 'w') as h5out:
     df_writer(h5out, LT, "LT", "LightTable")
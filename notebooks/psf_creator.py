@@ -0,0 +1,63 @@
+import os
+import glob
+import numpy  as np
+import pandas as pd
+import tables as tb
+
+from lt_psf   import build_psf
+from lt_detdb import load_table
+
+# Takes in the compressed nexus files from the PSF simulation (region S2_SIPM_PSF)
+# and makes the radial PSF table of the SiPMs, as psf_constructor.ipynb
+
+
+# Configure the script here
+detector_db = "next100"
+Active_r = 1000/2. # active radius in mm
+EL_GAP = 10.0 # EL gap in mm
+save=True
+nworkers=1 # number of processes used to read and bin the files
+max_memory=200 # MB of MC/sns_response read at once by each process
+
+# configure z binning, slices of the EL gap from the gate
+dz    = 1.
+zbins = np.arange(0, EL_GAP + dz, dz)
+
+# configure transverse binning
+dd    = 1
+dmax  = 500
+dbins = np.arange(0, dmax + dd, dd)
+
+# create PSF config
+config = { "parameter" : ["detector" , "ACTIVE_rad" , "EL_GAP"   , "signal_type", "sensor", "pitch_z", "nexus"],
+                "value": [detector_db, str(Active_r), str(EL_GAP), "S2"         , "SIPM"  , str(dz)  , "v7_11_00"]}
+config = pd.DataFrame.from_dict(config)
+
+# Load in the files -- configure the path
+datadir = os.path.expandvars("../files/NEXT100_PSF_LT/")
+filenames = sorted(glob.glob(os.path.join(datadir, "*.h5")))
+print(f"{len(filenames)} files")
+
+# Load in the database for SiPMs
+datasipm  = load_table(detector_db, "DataSiPM")
+sensorids = datasipm["SensorID"].values
+
+acc = build_psf(filenames, sensorids, datasipm["X"].values, datasipm["Y"].values, dbins, zbins,
+                nworkers=nworkers, max_memory=max_memory)
+
+print("Events per slice:", acc.nevents)
+
+psf = acc.table()
+
+if psf.isna().values.any():
+    raise Exception("NaN values in table!")
+
+outfilename = f"../LT/{detector_db.upper()}_PSF.h5"
+
+if save:
+    # invisible_cities is only needed to write the tables
+    from invisible_cities.io.dst_io import df_writer
+
+    with tb.open_file(outfilename, 'w') as h5out:
+        df_writer(h5out, psf, "PSF", "LightTable")
+        df_writer(h5out, config, "PSF", "Config", str_col_length=config.astype(str).apply(lambda c: c.str.len()).values.max())